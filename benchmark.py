@@ -0,0 +1,979 @@
+import contextlib
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+import tempfile
+from collections import deque
+import binary_codec
+import chunking
+import erasure
+from cache import ChunkCache, HotChunkCache
+from chunk_table import ChunkLocationTable
+from chunking import ContentDefinedChunker
+from erasure import ReedSolomon
+from metadata_log import MetadataLog
+from config import LOG_GROUP_COMMIT_DELAY, CHUNK_SIZE, CDC_MIN_SIZE, CDC_AVG_SIZE, CDC_MAX_SIZE, \
+    MASTER_HOST, MASTER_PORT, REPLICATION_FACTOR, FAILURE_TIMEOUT
+from utils import recv_all, recv_to_file, encode_message, decode_message, ENCODING_JSON, ENCODING_BINARY
+
+
+def legacy_recv_all(sock, length):
+
+    # The original implementation, kept here as the baseline
+    buffer = b''
+    while len(buffer) < length:
+        chunk = sock.recv(length - len(buffer))
+        if not chunk:
+            return None
+        buffer += chunk
+    return buffer
+
+
+def time_receiver(receive, size, rounds):
+
+    sender_sock, receiver_sock = socket.socketpair()
+    payload = b'x' * size
+
+    def sender():
+        for _ in range(rounds):
+            sender_sock.sendall(payload)
+
+    thread = threading.Thread(target=sender)
+    thread.daemon = True
+
+    start = time.perf_counter()
+    thread.start()
+    for _ in range(rounds):
+        receive(receiver_sock, size)
+    elapsed = time.perf_counter() - start
+
+    thread.join()
+    sender_sock.close()
+    receiver_sock.close()
+    return elapsed
+
+
+def bench_recv():
+
+    sizes = [4 * 1024, 64 * 1024, 1024 * 1024, 16 * 1024 * 1024]
+    total_bytes = 256 * 1024 * 1024
+
+    with tempfile.TemporaryFile() as f:
+
+        def to_file(sock, size):
+            f.seek(0)
+            return recv_to_file(sock, f, size)
+
+        receivers = [
+            ('legacy bytes +=', legacy_recv_all),
+            ('recv_all (recv_into)', recv_all),
+            ('recv_to_file', to_file),
+        ]
+
+        print(f"{'chunk size':>12}  {'implementation':<22} {'MB/s':>10}")
+        for size in sizes:
+            rounds = max(1, total_bytes // size)
+            for name, receive in receivers:
+                elapsed = time_receiver(receive, size, rounds)
+                throughput = size * rounds / elapsed / (1024 * 1024)
+                print(f"{size // 1024:>10}KB  {name:<22} {throughput:>10.1f}")
+
+
+def make_download_manifest(chunk_count):
+
+    # Shaped like a DOWNLOAD response for a file with `chunk_count` chunks
+    nodes = [['127.0.0.1', 9001], ['127.0.0.1', 9002], ['127.0.0.1', 9003]]
+    chunk_ids = [f"chunk_{i}_{i * 2654435761 % (1 << 64):016x}" for i in range(chunk_count)]
+    return {
+        'status': 'success',
+        'chunk_ids': chunk_ids,
+        'chunk_locations': {chunk_id: nodes for chunk_id in chunk_ids},
+        'request_id': 1
+    }
+
+
+def time_call(function, *args, repeat=5):
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_protocol():
+
+    codec = 'msgpack' if binary_codec.msgpack is not None else 'pure Python'
+    print(f"Binary codec: {codec}")
+    print(f"{'chunks':>8}  {'encoding':<8} {'bytes':>12} {'encode ms':>10} {'decode ms':>10}")
+
+    for chunk_count in [1000, 10000, 100000]:
+        manifest = make_download_manifest(chunk_count)
+        for encoding in (ENCODING_JSON, ENCODING_BINARY):
+            frame = encode_message(manifest, encoding)
+            header = struct.unpack("!I", frame[:4])[0]
+            body = frame[4:]
+
+            assert decode_message(header, body) == manifest
+
+            encode_time = time_call(encode_message, manifest, encoding)
+            decode_time = time_call(decode_message, header, body)
+            print(f"{chunk_count:>8}  {encoding:<8} {len(frame):>12} "
+                  f"{encode_time * 1000:>10.2f} {decode_time * 1000:>10.2f}")
+
+
+def bench_metadata_log():
+
+    # Durable appends per second as more writers share each fsync
+    records_per_writer = 200
+    print(f"{'writers':>8} {'records/s':>12} {'fsyncs':>8}")
+
+    for writers in [1, 8, 64]:
+        with tempfile.TemporaryDirectory() as directory:
+            log = MetadataLog(directory, LOG_GROUP_COMMIT_DELAY)
+            log.load()
+            log.start()
+
+            fsyncs = [0]
+            original_fsync = os.fsync
+
+            def counting_fsync(fd):
+                fsyncs[0] += 1
+                original_fsync(fd)
+
+            def writer():
+                for i in range(records_per_writer):
+                    log.wait(log.append({'op': 'report', 'chunk_id': f'chunk_{i}', 'locations': []}))
+
+            os.fsync = counting_fsync
+            try:
+                threads = [threading.Thread(target=writer) for _ in range(writers)]
+                start = time.perf_counter()
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                elapsed = time.perf_counter() - start
+            finally:
+                os.fsync = original_fsync
+                log.close()
+
+            total = writers * records_per_writer
+            print(f"{writers:>8} {total / elapsed:>12.0f} {fsyncs[0]:>8}")
+
+
+def bench_chunking():
+
+    # Split-and-hash throughput, and how many chunks survive a small insertion
+    data = os.urandom(16 * 1024 * 1024)
+    edited = data[:1000] + b'inserted' + data[1000:]
+    chunker = ContentDefinedChunker(CDC_MIN_SIZE, CDC_AVG_SIZE, CDC_MAX_SIZE)
+
+    def fixed(buffer):
+        return list(range(CHUNK_SIZE, len(buffer), CHUNK_SIZE)) + [len(buffer)]
+
+    def split(buffer, cuts):
+        return [hashlib.sha256(buffer[start:end]).digest() for start, end in zip([0] + cuts, cuts)]
+
+    methods = [('fixed', fixed)]
+    if chunking.np is not None:
+        methods.append(('cdc numpy', lambda buffer: chunker.cut_points(buffer, True)))
+    methods.append(('cdc python', lambda buffer: chunker.cut_points_python(buffer, True)))
+
+    print(f"{'method':<12} {'MB/s':>10} {'chunks':>8} {'unchanged after insert':>24}")
+    for name, cut in methods:
+        elapsed = time_call(lambda buffer: split(buffer, cut(buffer)), data, repeat=3)
+        chunks = split(data, cut(data))
+        edited_chunks = set(split(edited, cut(edited)))
+        unchanged = sum(1 for chunk in chunks if chunk in edited_chunks)
+        print(f"{name:<12} {len(data) / elapsed / (1024 * 1024):>10.1f} {len(chunks):>8} "
+              f"{unchanged:>18}/{len(chunks)}")
+
+
+def start_cluster(directory, node_count, base_port=9101):
+
+    # An in-process master and storage nodes; the master uses MASTER_PORT, so
+    # stop any running cluster first
+    from master_node import MasterNode
+    from storage_node import StorageNode
+
+    master = MasterNode(MASTER_HOST, MASTER_PORT, metadata_dir=os.path.join(directory, 'metadata'))
+    nodes = [
+        StorageNode('127.0.0.1', base_port + i, os.path.join(directory, f'node{i}'))
+        for i in range(node_count)
+    ]
+
+    threads = []
+    for server in [master] + nodes:
+        thread = threading.Thread(target=server.start)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    while len(master.get_alive_nodes()) < node_count:
+        time.sleep(0.1)
+    return master, nodes, threads
+
+
+def stop_cluster(master, nodes, threads):
+
+    for server in nodes + [master]:
+        server.running = False
+    for thread in threads:
+        thread.join()
+
+
+def bench_recovery():
+
+    # Time for the master to restore full replication after one of four
+    # storage nodes fails. The failure is injected directly, so detection
+    # time (FAILURE_TIMEOUT) is not included.
+    from client import Client
+
+    data = os.urandom(64 * CHUNK_SIZE)
+    settings = [(1, 0), (4, 0), (4, 32 * 1024 * 1024)]
+
+    print(f"{'copies':>7} {'bandwidth':>10} {'replicas':>9} {'MB':>7} {'seconds':>8} {'MB/s':>8}")
+    for concurrency, bandwidth in settings:
+        with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(io.StringIO()):
+            master, nodes, threads = start_cluster(directory, 4)
+            master.max_concurrent_replications = concurrency
+            master.replication_bandwidth = bandwidth
+
+            client = Client()
+            client.upload_stream('recovery.bin', io.BytesIO(data))
+            client.pool.close()
+
+            failed = nodes[0]
+            failed.running = False
+            time.sleep(0.2)
+            failed_id = f"{failed.host}:{failed.port}"
+            lost = sum(
+                1 for locations in master.chunk_locations.values()
+                if any(f"{loc[0]}:{loc[1]}" == failed_id for loc in locations)
+            )
+
+            start = time.perf_counter()
+            with master.nodes_lock:
+                master.storage_nodes[failed_id]['last_heartbeat'] = 0
+            master.handle_node_failures([failed_id])
+            while master.find_under_replicated(master.get_alive_nodes()):
+                time.sleep(0.01)
+            elapsed = time.perf_counter() - start
+
+            stop_cluster(master, nodes, threads)
+
+        limit = f"{bandwidth // (1024 * 1024)}MB/s" if bandwidth else 'none'
+        size = lost * CHUNK_SIZE / (1024 * 1024)
+        print(f"{concurrency:>7} {limit:>10} {lost:>9} {size:>7.0f} {elapsed:>8.2f} {size / elapsed:>8.1f}")
+
+
+def legacy_drop_nodes(chunk_locations, failed_nodes):
+
+    # The original failure handling: scan every chunk
+    affected_chunks = []
+    for chunk_id, locations in chunk_locations.items():
+
+        new_locations = [
+            loc for loc in locations
+            if f"{loc[0]}:{loc[1]}" not in failed_nodes
+        ]
+
+        if len(new_locations) != len(locations):
+            chunk_locations[chunk_id] = new_locations
+            affected_chunks.append(chunk_id)
+    return affected_chunks
+
+
+def legacy_under_replicated(chunk_locations, alive_nodes):
+
+    # The original replication check: scan every chunk
+    return [
+        chunk_id for chunk_id, locations in chunk_locations.items()
+        if sum(1 for loc in locations if f"{loc[0]}:{loc[1]}" in alive_nodes) < REPLICATION_FACTOR
+    ]
+
+
+def make_synthetic_master(chunk_count, node_count):
+
+    from master_node import MasterNode
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        master = MasterNode(MASTER_HOST, MASTER_PORT, metadata_dir=None)
+
+    nodes = [[f"10.0.{i // 250}.{i % 250}", 9000] for i in range(node_count)]
+    chunk_ids = [hashlib.sha256(i.to_bytes(8, 'big')).hexdigest() for i in range(chunk_count)]
+    chunk_locations = {
+        chunk_id: [nodes[(i + j * 7) % node_count] for j in range(REPLICATION_FACTOR)]
+        for i, chunk_id in enumerate(chunk_ids)
+    }
+    master.apply_record({
+        'op': 'commit',
+        'filename': 'synthetic.bin',
+        'chunk_ids': chunk_ids,
+        'chunk_locations': chunk_locations
+    })
+
+    # Heartbeat every node now that the (slow) setup is done
+    now = time.time()
+    for host, port in nodes:
+        master.storage_nodes[f"{host}:{port}"] = {'host': host, 'port': port, 'last_heartbeat': now}
+    return master, nodes
+
+
+def bench_failure_index():
+
+    # Node failure handling and replication checks on synthetic metadata,
+    # as full scans of chunk_locations versus the node and replica-count
+    # indexes
+    node_count = 50
+    print(f"{'chunks':>9}  {'operation':<30} {'full scan ms':>13} {'indexed ms':>11}")
+
+    for chunk_count in [1000000, 2000000]:
+        master, nodes = make_synthetic_master(chunk_count, node_count)
+        alive_nodes = set(master.get_alive_nodes())
+        failed_id = f"{nodes[0][0]}:{nodes[0][1]}"
+
+        elapsed = time_call(legacy_under_replicated, master.chunk_locations, alive_nodes, repeat=1)
+        indexed = time_call(master.find_under_replicated, alive_nodes, repeat=3)
+        print(f"{chunk_count:>9}  {'replication check, healthy':<30} {elapsed * 1000:>13.1f} {indexed * 1000:>11.3f}")
+
+        legacy_locations = dict(master.chunk_locations)
+        elapsed = time_call(legacy_drop_nodes, legacy_locations, {failed_id}, repeat=1)
+        del legacy_locations
+
+        alive_nodes.discard(failed_id)
+        with master.nodes_lock:
+            master.storage_nodes[failed_id]['last_heartbeat'] = 0
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            master.handle_node_failures([failed_id])
+        indexed = time.perf_counter() - start
+        print(f"{chunk_count:>9}  {'node failure':<30} {elapsed * 1000:>13.1f} {indexed * 1000:>11.1f}")
+
+        elapsed = time_call(legacy_under_replicated, master.chunk_locations, alive_nodes, repeat=1)
+        indexed = time_call(master.find_under_replicated, alive_nodes, repeat=3)
+        print(f"{chunk_count:>9}  {'replication check, 1 node lost':<30} {elapsed * 1000:>13.1f} {indexed * 1000:>11.1f}")
+
+        del master
+
+
+def legacy_download_manifest(master, filename):
+
+    # The original DOWNLOAD handler: rebuilds the alive-node list, under
+    # nodes_lock, for every location of every chunk
+
+    def get_alive_nodes():
+        alive_nodes = []
+        current_time = time.time()
+        with master.nodes_lock:
+            for node_id, node_info in master.storage_nodes.items():
+                if current_time - node_info['last_heartbeat'] < FAILURE_TIMEOUT:
+                    alive_nodes.append(node_id)
+        return alive_nodes
+
+    chunk_ids = master.file_metadata[filename]
+    chunk_locations = {}
+    for chunk_id in chunk_ids:
+        locations = master.chunk_locations.get(chunk_id, [])
+        chunk_locations[chunk_id] = [
+            loc for loc in locations
+            if f"{loc[0]}:{loc[1]}" in get_alive_nodes()
+        ]
+    return {'status': 'success', 'chunk_ids': chunk_ids, 'chunk_locations': chunk_locations}
+
+
+def bench_manifest():
+
+    # Time for the master to build a DOWNLOAD response
+    request = {'command': 'DOWNLOAD', 'filename': 'synthetic.bin'}
+    print(f"{'chunks':>8} {'nodes':>6} {'per-location ms':>16} {'cached set ms':>14}")
+
+    for chunk_count in [10000, 100000]:
+        for node_count in [10, 50]:
+            master, _ = make_synthetic_master(chunk_count, node_count)
+
+            legacy = time_call(legacy_download_manifest, master, 'synthetic.bin', repeat=3)
+            with contextlib.redirect_stdout(io.StringIO()):
+                assert master.handle_download_request(request)['chunk_locations'] == \
+                    legacy_download_manifest(master, 'synthetic.bin')['chunk_locations']
+                cached = time_call(master.handle_download_request, request, repeat=3)
+
+            print(f"{chunk_count:>8} {node_count:>6} {legacy * 1000:>16.1f} {cached * 1000:>14.1f}")
+
+
+def legacy_select_nodes(master, alive_nodes, count):
+
+    # The original placement: a uniform random sample
+    selected = random.sample(alive_nodes, min(count, len(alive_nodes)))
+    return [(master.storage_nodes[node_id]['host'], master.storage_nodes[node_id]['port']) for node_id in selected]
+
+
+def simulate_placement(select, choices=2, steps=200, chunks_per_step=20, seed=1):
+
+    # Discrete-time cluster of 12 nodes. Every step the master places
+    # chunks_per_step chunks with 3 replicas each, and every node writes up
+    # to `rate` queued replicas. Nodes 0-2 also serve heavy read traffic that
+    # leaves them a quarter of the write bandwidth, and nodes 8-11 have a
+    # quarter of the disk. Nodes heartbeat every 5 steps.
+    from master_node import MasterNode
+
+    random.seed(seed)
+    with contextlib.redirect_stdout(io.StringIO()):
+        master = MasterNode(MASTER_HOST, MASTER_PORT, metadata_dir=None)
+    master.placement_choices = choices
+
+    gigabyte = 1024 * 1024 * 1024
+    nodes = {}
+    for i in range(12):
+        disk_total = 4 * gigabyte if i >= 8 else 16 * gigabyte
+        nodes[f"10.0.0.{i}:9000"] = {
+            'host': f"10.0.0.{i}",
+            'port': 9000,
+            'rate': 2 if i < 3 else 8,
+            'background': 6 if i < 3 else 0,
+            'disk_total': disk_total,
+            'disk_used': disk_total // 2,
+            'chunks': 0,
+            'queue': deque()
+        }
+
+    latencies = []
+    rejected = 0
+    for step in range(steps):
+        if step % 5 == 0:
+            for node_id, node in nodes.items():
+                master.handle_heartbeat({
+                    'node_id': node_id,
+                    'host': node['host'],
+                    'port': node['port'],
+                    'disk_total': node['disk_total'],
+                    'disk_free': node['disk_total'] - node['disk_used'],
+                    'chunk_count': node['chunks'],
+                    'active_transfers': len(node['queue']) + node['background']
+                })
+
+        alive_nodes = master.get_alive_nodes()
+        for _ in range(chunks_per_step):
+            for host, port in select(master, alive_nodes, REPLICATION_FACTOR):
+                node = nodes[f"{host}:{port}"]
+                if node['disk_total'] - node['disk_used'] < CHUNK_SIZE:
+                    rejected += 1
+                    continue
+                node['disk_used'] += CHUNK_SIZE
+                node['chunks'] += 1
+                node['queue'].append(step)
+
+        for node in nodes.values():
+            for _ in range(min(node['rate'], len(node['queue']))):
+                latencies.append(step - node['queue'].popleft())
+
+    latencies.sort()
+    return {
+        'throughput': len(latencies) / steps,
+        'p50': latencies[len(latencies) // 2] if latencies else 0,
+        'p99': latencies[int(len(latencies) * 0.99)] if latencies else 0,
+        'backlog': sum(len(node['queue']) for node in nodes.values()),
+        'fullest': max(node['disk_used'] / node['disk_total'] for node in nodes.values()),
+        'rejected': rejected
+    }
+
+
+def bench_placement():
+
+    # Balance and write throughput of replica placement under skewed load
+    def select(master, alive_nodes, count):
+        return master.select_nodes_for_chunk(alive_nodes, count)
+
+    policies = [
+        ('random', legacy_select_nodes, 2),
+        ('2 choices', select, 2),
+        ('3 choices', select, 3),
+    ]
+
+    print(f"{'policy':<12} {'writes/step':>12} {'p50 steps':>10} {'p99 steps':>10} "
+          f"{'backlog':>8} {'fullest disk':>13} {'rejected':>9}")
+    for name, policy, choices in policies:
+        result = simulate_placement(policy, choices)
+        print(f"{name:<12} {result['throughput']:>12.1f} {result['p50']:>10} {result['p99']:>10} "
+              f"{result['backlog']:>8} {result['fullest'] * 100:>12.1f}% {result['rejected']:>9}")
+
+
+def bench_replica_selection():
+
+    # Reads of a 64-chunk file from 3 in-process storage nodes, one of which
+    # answers every RETRIEVE 50ms late. Compares trying replicas in the order
+    # the master lists them with ranking them by the client's node stats.
+    from client import Client
+
+    data = os.urandom(64 * CHUNK_SIZE)
+    policies = [
+        ('listed order', lambda locations, size=CHUNK_SIZE: list(locations)),
+        ('ranked', None),
+    ]
+
+    print(f"{'policy':<14} {'seconds':>8} {'MB/s':>8}  reads per node (slow node first)")
+    with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(io.StringIO()) as log:
+        master, nodes, threads = start_cluster(directory, 3)
+        client = Client()
+        client.upload_stream('replicas.bin', io.BytesIO(data))
+
+        slow = nodes[0]
+        prepare_retrieve = slow.prepare_retrieve
+
+        def slow_prepare_retrieve(request):
+            time.sleep(0.05)
+            return prepare_retrieve(request)
+
+        slow.prepare_retrieve = slow_prepare_retrieve
+        output_path = os.path.join(directory, 'out.bin')
+
+        results = []
+        for name, rank in policies:
+            client = Client()
+            if rank is not None:
+                client.node_stats.rank = rank
+
+            start = time.perf_counter()
+            client.download_file('replicas.bin', output_path)
+            elapsed = time.perf_counter() - start
+
+            with open(output_path, 'rb') as f:
+                assert f.read() == data
+            reads = [
+                client.node_stats.summary().get((node.host, node.port), {}).get('transfers', 0)
+                for node in nodes
+            ]
+            client.pool.close()
+            results.append((name, elapsed, reads))
+
+        stop_cluster(master, nodes, threads)
+
+    for name, elapsed, reads in results:
+        throughput = len(data) / elapsed / (1024 * 1024)
+        print(f"{name:<14} {elapsed:>8.2f} {throughput:>8.1f}  {reads}")
+
+
+def bench_erasure():
+
+    # Encode and worst-case decode throughput (all m lost fragments are data
+    # fragments) for one chunk, and the storage each scheme needs
+    data = os.urandom(CHUNK_SIZE)
+    numpy_module = erasure.np
+    implementations = [('numpy', numpy_module)] if numpy_module is not None else []
+    implementations.append(('python', None))
+
+    print(f"{'scheme':<10} {'xor':<8} {'encode MB/s':>12} {'decode MB/s':>12} {'storage':>8} {'tolerates':>10}")
+    print(f"{'replicate':<10} {'-':<8} {'-':>12} {'-':>12} {REPLICATION_FACTOR:>7}x "
+          f"{REPLICATION_FACTOR - 1:>10}")
+    for k, m in [(4, 2), (6, 3)]:
+        codec = ReedSolomon(k, m)
+        fragments = codec.encode(data)
+        surviving = {i: fragment for i, fragment in enumerate(fragments) if i >= m}
+
+        for name, module in implementations:
+            erasure.np = module
+            try:
+                encode_time = time_call(codec.encode, data, repeat=3)
+                decode_time = time_call(codec.decode, surviving, len(data), repeat=3)
+                assert codec.decode(surviving, len(data)) == data
+            finally:
+                erasure.np = numpy_module
+
+            megabytes = len(data) / (1024 * 1024)
+            print(f"{f'rs {k}+{m}':<10} {name:<8} {megabytes / encode_time:>12.1f} "
+                  f"{megabytes / decode_time:>12.1f} {(k + m) / k:>7.2f}x {m:>10}")
+
+
+def bench_chunk_cache():
+
+    # Five downloads of the same 32MB file from 3 in-process storage nodes,
+    # without a cache, with the memory cache and with a disk-only cache
+    from client import Client
+
+    data = os.urandom(32 * CHUNK_SIZE)
+    rounds = 5
+
+    print(f"{'cache':<8} {'first s':>8} {'repeat s':>9} {'hit rate':>9}")
+    with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(io.StringIO()) as log:
+        master, nodes, threads = start_cluster(directory, 3)
+        Client().upload_stream('cached.bin', io.BytesIO(data))
+        output_path = os.path.join(directory, 'out.bin')
+
+        caches = [
+            ('none', lambda: ChunkCache(0)),
+            ('memory', lambda: ChunkCache(len(data) * 2)),
+            ('disk', lambda: ChunkCache(0, os.path.join(directory, 'cache'), len(data) * 2)),
+        ]
+
+        results = []
+        for name, make_cache in caches:
+            client = Client()
+            client.chunk_cache = make_cache()
+
+            times = []
+            for _ in range(rounds):
+                start = time.perf_counter()
+                client.download_file('cached.bin', output_path)
+                times.append(time.perf_counter() - start)
+                with open(output_path, 'rb') as f:
+                    assert f.read() == data
+            client.pool.close()
+            results.append((name, times, client.chunk_cache.stats()['hit_rate']))
+
+        stop_cluster(master, nodes, threads)
+
+    for name, times, hit_rate in results:
+        repeat = sum(times[1:]) / (len(times) - 1)
+        print(f"{name:<8} {times[0]:>8.3f} {repeat:>9.3f} {hit_rate:>9.2f}")
+
+
+def bench_storage_cache():
+
+    # RETRIEVEs against one in-process storage node with a 16MB cache: 80% of
+    # reads go to 32 popular 256KB chunks (Zipf-like), 20% scan once through
+    # 512 other chunks. Compares no cache, plain LRU admitting every chunk
+    # read, and LRU admitting a chunk on its second read.
+    from client import Client
+
+    chunk_size = 256 * 1024
+    hot = [hashlib.sha256(b'hot%d' % i).hexdigest() for i in range(32)]
+    cold = [hashlib.sha256(b'cold%d' % i).hexdigest() for i in range(512)]
+    rng = random.Random(1)
+    weights = [1 / (rank + 1) for rank in range(len(hot))]
+    reads = []
+    for i in range(5 * len(cold)):
+        reads.append(cold[i // 5] if i % 5 == 4 else rng.choices(hot, weights)[0])
+
+    caches = [
+        ('none', lambda: HotChunkCache(0)),
+        ('lru', lambda: HotChunkCache(16 * 1024 * 1024, history=0)),
+        ('lru+2nd hit', lambda: HotChunkCache(16 * 1024 * 1024)),
+    ]
+
+    print(f"{'cache':<12} {'reads/s':>8} {'hit rate':>9} {'MB from cache':>14} {'evictions':>10}")
+    with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(io.StringIO()) as log:
+        master, nodes, threads = start_cluster(directory, 1)
+        node = nodes[0]
+        client = Client()
+        for chunk_id in hot + cold:
+            client.store_chunk(node.host, node.port, chunk_id, os.urandom(chunk_size))
+
+        results = []
+        for name, make_cache in caches:
+            node.chunk_cache = make_cache()
+            start = time.perf_counter()
+            for chunk_id in reads:
+                assert client.retrieve_chunk(node.host, node.port, chunk_id) is not None
+            elapsed = time.perf_counter() - start
+            results.append((name, len(reads) / elapsed, node.chunk_cache.stats()))
+
+        client.pool.close()
+        stop_cluster(master, nodes, threads)
+
+    for name, rate, stats in results:
+        print(f"{name:<12} {rate:>8.0f} {stats['hit_rate']:>9.2f} "
+              f"{stats['bytes_served'] / (1024 * 1024):>14.1f} {stats['evictions']:>10}")
+
+
+def bench_streaming():
+
+    # Time until the first byte can be sent to an HTTP client, for 8MB and
+    # 64MB files: assembling the file first (download_file) vs streaming
+    # chunks in order as they arrive (open_stream)
+    from client import Client
+
+    print(f"{'file MB':>8} {'assembled first byte s':>23} {'streamed first byte s':>22} {'streamed total s':>17}")
+    with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(io.StringIO()) as log:
+        master, nodes, threads = start_cluster(directory, 3)
+        output_path = os.path.join(directory, 'out.bin')
+
+        results = []
+        for megabytes in (8, 64):
+            data = os.urandom(megabytes * CHUNK_SIZE)
+            filename = f'stream{megabytes}.bin'
+            Client().upload_stream(filename, io.BytesIO(data))
+
+            # A new client each time, so nothing comes from its chunk cache
+            client = Client()
+            start = time.perf_counter()
+            client.download_file(filename, output_path)
+            assembled = time.perf_counter() - start
+            client.pool.close()
+
+            client = Client()
+            start = time.perf_counter()
+            size, chunks = client.open_stream(filename)
+            parts = [next(chunks)]
+            first_byte = time.perf_counter() - start
+            parts.extend(chunks)
+            total = time.perf_counter() - start
+            client.pool.close()
+            assert b''.join(parts) == data and size == len(data)
+
+            results.append((megabytes, assembled, first_byte, total))
+
+        stop_cluster(master, nodes, threads)
+
+    for megabytes, assembled, first_byte, total in results:
+        print(f"{megabytes:>8} {assembled:>23.3f} {first_byte:>22.3f} {total:>17.3f}")
+
+
+def bench_range():
+
+    # 100 reads of 64KB at random offsets in a 64MB file (a media player
+    # seeking): byte ranges mapped to in-chunk RETRIEVEs vs fetching every
+    # chunk the range touches in full. The client cache is off.
+    from client import Client
+
+    data = os.urandom(64 * CHUNK_SIZE)
+    rng = random.Random(1)
+    starts = [rng.randrange(len(data) - 65536) for _ in range(100)]
+
+    print(f"{'reads':<14} {'seconds':>8} {'MB moved':>9}")
+    with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(io.StringIO()) as log:
+        master, nodes, threads = start_cluster(directory, 3)
+        Client().upload_stream('media.bin', io.BytesIO(data))
+
+        results = []
+        for name, ranged in [('whole chunks', False), ('byte ranges', True)]:
+            client = Client()
+            client.chunk_cache = ChunkCache(0)
+            download_info = client.request_download('media.bin')
+            moved = []
+
+            retrieve_chunk = client.retrieve_chunk
+
+            def counting_retrieve(node_host, node_port, chunk_id, offset=0, length=None):
+                chunk_data = retrieve_chunk(node_host, node_port, chunk_id, offset, length)
+                moved.append(len(chunk_data or b''))
+                return chunk_data
+
+            client.retrieve_chunk = counting_retrieve
+            if not ranged:
+                fetch_chunk = client.fetch_chunk
+
+                def whole_chunk(chunk_id, locations, size, attempts, offset=0, length=None):
+                    chunk_data = fetch_chunk(chunk_id, locations, size, attempts)
+                    return chunk_data[offset:offset + (length or size)]
+
+                client.fetch_chunk = whole_chunk
+
+            start = time.perf_counter()
+            for offset in starts:
+                piece = b''.join(client.iter_file_data(download_info, start=offset, end=offset + 65536))
+                assert piece == data[offset:offset + 65536]
+            elapsed = time.perf_counter() - start
+
+            client.pool.close()
+            results.append((name, elapsed, sum(moved)))
+
+        stop_cluster(master, nodes, threads)
+
+    for name, elapsed, moved in results:
+        print(f"{name:<14} {elapsed:>8.3f} {moved / (1024 * 1024):>9.1f}")
+
+
+def bench_list_files():
+
+    # Master time and response size for a web page load's LIST_FILES: the
+    # whole file table (the original handler) vs the first page vs a
+    # revalidation with the current version
+    from master_node import MasterNode
+
+    print(f"{'files':>8}  {'request':<14} {'ms':>8} {'bytes':>11}")
+    for file_count in [100000, 1000000]:
+        with contextlib.redirect_stdout(io.StringIO()):
+            master = MasterNode(MASTER_HOST, MASTER_PORT, metadata_dir=None)
+        for i in range(file_count):
+            master.file_metadata[f"user{i % 1000:03d}/file{i:07d}.bin"] = []
+        master.sorted_files = sorted(master.file_metadata)
+
+        first = master.handle_list_files({})
+        requests = [
+            ('full list', lambda: {'status': 'success', 'files': list(master.file_metadata.keys())}),
+            ('first page', lambda: master.handle_list_files({})),
+            ('prefix page', lambda: master.handle_list_files({'prefix': 'user042/'})),
+            ('not modified', lambda: master.handle_list_files({'if_none_match': first['version']}))
+        ]
+        for name, handle in requests:
+            elapsed = time_call(lambda: encode_message(handle(), ENCODING_JSON), repeat=5)
+            size = len(encode_message(handle(), ENCODING_JSON))
+            print(f"{file_count:>8}  {name:<14} {elapsed * 1000:>8.3f} {size:>11}")
+
+        del master
+
+
+def bench_stat():
+
+    # What a client pays to learn a file's size: the DOWNLOAD manifest (the
+    # only way before STAT) vs STAT, plus the master's memory for one file's
+    # chunk sizes as a list of ints vs the array it now keeps
+    from array import array
+
+    print(f"{'chunks':>8}  {'request':<16} {'ms':>8} {'bytes':>11}")
+    for chunk_count in [10000, 100000]:
+        master, _ = make_synthetic_master(chunk_count, 10)
+        rng = random.Random(1)
+        chunk_sizes = [rng.randrange(CDC_MIN_SIZE, CDC_MAX_SIZE) for _ in range(chunk_count)]
+        master.apply_record({
+            'op': 'commit',
+            'filename': 'sized.bin',
+            'chunk_ids': master.file_metadata['synthetic.bin'],
+            'chunk_locations': {},
+            'chunk_sizes': chunk_sizes,
+            'digest': hashlib.sha256(b'sized').hexdigest(),
+            'time': time.time()
+        })
+
+        requests = [
+            ('DOWNLOAD', master.handle_download_request, {'filename': 'sized.bin'}),
+            ('STAT', master.handle_stat, {'filename': 'sized.bin'}),
+            ('STAT with chunks', master.handle_stat, {'filename': 'sized.bin', 'chunks': True})
+        ]
+        for name, handle, request in requests:
+            with contextlib.redirect_stdout(io.StringIO()):
+                elapsed = time_call(lambda: encode_message(handle(request), ENCODING_JSON), repeat=5)
+                size = len(encode_message(handle(request), ENCODING_JSON))
+            print(f"{chunk_count:>8}  {name:<16} {elapsed * 1000:>8.3f} {size:>11}")
+
+        list_bytes = sys.getsizeof(chunk_sizes) + sum(sys.getsizeof(size) for size in chunk_sizes)
+        array_bytes = sys.getsizeof(array('I', chunk_sizes))
+        print(f"{chunk_count:>8}  chunk sizes in memory: list {list_bytes} bytes, array {array_bytes} bytes")
+        del master
+
+
+def resident_bytes():
+
+    # Current RSS on Linux, else the peak
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def build_location_layout(layout, chunk_count, node_count, results):
+
+    # Runs in a child process so each layout is measured from a clean heap.
+    # Locations arrive as JSON, as in COMMIT_FILE, in batches of 10000.
+    nodes = [[f"10.0.{i // 250}.{i % 250}", 9000] for i in range(node_count)]
+    before = resident_bytes()
+    start = time.perf_counter()
+
+    if layout == 'dict':
+        # The original layout and its indexes
+        chunk_locations = {}
+        node_chunks = {}
+        replica_buckets = {0: set()}
+    else:
+        table = ChunkLocationTable()
+
+    for first in range(0, chunk_count, 10000):
+        batch = json.loads(json.dumps({
+            hashlib.sha256(i.to_bytes(8, 'big')).hexdigest():
+                [nodes[(i + j * 7) % node_count] for j in range(REPLICATION_FACTOR)]
+            for i in range(first, min(first + 10000, chunk_count))
+        }))
+        for chunk_id, locations in batch.items():
+            if layout == 'dict':
+                chunk_locations[chunk_id] = locations
+                for loc in locations:
+                    node_chunks.setdefault(f"{loc[0]}:{loc[1]}", set()).add(chunk_id)
+                replica_buckets[REPLICATION_FACTOR - len(locations)].add(chunk_id)
+            else:
+                table[chunk_id] = locations
+        del batch
+
+    results.send((resident_bytes() - before, time.perf_counter() - start))
+
+
+def available_bytes():
+
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def bench_location_memory():
+
+    # Master memory for chunk locations (3 replicas over 50 nodes) and their
+    # per-node index: dict of [host, port] lists vs ChunkLocationTable. A
+    # layout that would not fit in the free memory is estimated from the
+    # smaller run instead.
+    node_count = 50
+    per_chunk = {}
+    print(f"{'chunks':>9}  {'layout':<6} {'MB':>9} {'bytes/chunk':>12} {'build s':>8}")
+
+    for chunk_count in [1000000, 10000000]:
+        for layout in ['dict', 'table']:
+            available = available_bytes()
+            if layout in per_chunk and available is not None and \
+                    per_chunk[layout] * chunk_count > 0.8 * available:
+                size = per_chunk[layout] * chunk_count
+                print(f"{chunk_count:>9}  {layout:<6} {size / (1024 * 1024):>9.0f} "
+                      f"{per_chunk[layout]:>12.0f} {'(est.)':>8}")
+                continue
+
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=build_location_layout,
+                                              args=(layout, chunk_count, node_count, sender))
+            process.start()
+            size, elapsed = receiver.recv()
+            process.join()
+
+            per_chunk[layout] = size / chunk_count
+            print(f"{chunk_count:>9}  {layout:<6} {size / (1024 * 1024):>9.0f} "
+                  f"{size / chunk_count:>12.0f} {elapsed:>8.1f}")
+
+
+BENCHMARKS = {
+    'recv': bench_recv,
+    'protocol': bench_protocol,
+    'metadata_log': bench_metadata_log,
+    'chunking': bench_chunking,
+    'recovery': bench_recovery,
+    'failure_index': bench_failure_index,
+    'manifest': bench_manifest,
+    'placement': bench_placement,
+    'replica_selection': bench_replica_selection,
+    'erasure': bench_erasure,
+    'chunk_cache': bench_chunk_cache,
+    'storage_cache': bench_storage_cache,
+    'streaming': bench_streaming,
+    'range': bench_range,
+    'list_files': bench_list_files,
+    'stat': bench_stat,
+    'location_memory': bench_location_memory,
+}
+
+
+def print_usage():
+
+    print("Usage:")
+    print("  python benchmark.py <benchmark>")
+    print(f"Benchmarks: {', '.join(BENCHMARKS)}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2 or sys.argv[1] not in BENCHMARKS:
+        print_usage()
+        sys.exit(1)
+
+    BENCHMARKS[sys.argv[1]]()
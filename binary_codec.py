@@ -0,0 +1,208 @@
+import struct
+
+# Compact binary encoding for protocol messages. The format is a subset of
+# MessagePack (nil, bool, int, float, str, bin, array, map), so the optional
+# msgpack package is used when installed and this pure-Python codec otherwise;
+# both produce and accept the same bytes.
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+_pack_u8 = struct.Struct('>B').pack
+_pack_u16 = struct.Struct('>BH').pack
+_pack_u32 = struct.Struct('>BI').pack
+_pack_u64 = struct.Struct('>BQ').pack
+_pack_i8 = struct.Struct('>Bb').pack
+_pack_i16 = struct.Struct('>Bh').pack
+_pack_i32 = struct.Struct('>Bi').pack
+_pack_i64 = struct.Struct('>Bq').pack
+_pack_f64 = struct.Struct('>Bd').pack
+
+_unpack_u16 = struct.Struct('>H').unpack_from
+_unpack_u32 = struct.Struct('>I').unpack_from
+_unpack_u64 = struct.Struct('>Q').unpack_from
+_unpack_i8 = struct.Struct('>b').unpack_from
+_unpack_i16 = struct.Struct('>h').unpack_from
+_unpack_i32 = struct.Struct('>i').unpack_from
+_unpack_i64 = struct.Struct('>q').unpack_from
+_unpack_f32 = struct.Struct('>f').unpack_from
+_unpack_f64 = struct.Struct('>d').unpack_from
+
+
+def _pack_length(parts, length, fix_base, fix_limit, code8, code16, code32):
+
+    if length < fix_limit:
+        parts.append(_pack_u8(fix_base | length))
+    elif code8 is not None and length < 0x100:
+        parts.append(_pack_u8(code8) + _pack_u8(length))
+    elif length < 0x10000:
+        parts.append(_pack_u16(code16, length))
+    else:
+        parts.append(_pack_u32(code32, length))
+
+
+def _pack_int(parts, value):
+
+    if 0 <= value < 0x80:
+        parts.append(_pack_u8(value))
+    elif -32 <= value < 0:
+        parts.append(_pack_u8(value & 0xff))
+    elif value >= 0:
+        if value < 0x100:
+            parts.append(_pack_u8(0xcc) + _pack_u8(value))
+        elif value < 0x10000:
+            parts.append(_pack_u16(0xcd, value))
+        elif value < 0x100000000:
+            parts.append(_pack_u32(0xce, value))
+        else:
+            parts.append(_pack_u64(0xcf, value))
+    elif value >= -0x80:
+        parts.append(_pack_i8(0xd0, value))
+    elif value >= -0x8000:
+        parts.append(_pack_i16(0xd1, value))
+    elif value >= -0x80000000:
+        parts.append(_pack_i32(0xd2, value))
+    else:
+        parts.append(_pack_i64(0xd3, value))
+
+
+def _pack(parts, obj):
+
+    if obj is None:
+        parts.append(b'\xc0')
+    elif obj is True:
+        parts.append(b'\xc3')
+    elif obj is False:
+        parts.append(b'\xc2')
+    elif isinstance(obj, int):
+        _pack_int(parts, obj)
+    elif isinstance(obj, float):
+        parts.append(_pack_f64(0xcb, obj))
+    elif isinstance(obj, str):
+        data = obj.encode('utf-8')
+        _pack_length(parts, len(data), 0xa0, 32, 0xd9, 0xda, 0xdb)
+        parts.append(data)
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        data = bytes(obj)
+        _pack_length(parts, len(data), 0, 0, 0xc4, 0xc5, 0xc6)
+        parts.append(data)
+    elif isinstance(obj, (list, tuple)):
+        _pack_length(parts, len(obj), 0x90, 16, None, 0xdc, 0xdd)
+        for item in obj:
+            _pack(parts, item)
+    elif isinstance(obj, dict):
+        _pack_length(parts, len(obj), 0x80, 16, None, 0xde, 0xdf)
+        for key, value in obj.items():
+            _pack(parts, key)
+            _pack(parts, value)
+    else:
+        raise TypeError(f"Cannot encode object of type {type(obj).__name__}")
+
+
+def _unpack(data, pos):
+
+    code = data[pos]
+    pos += 1
+
+    if code < 0x80:
+        return code, pos
+    if code >= 0xe0:
+        return code - 0x100, pos
+    if 0xa0 <= code <= 0xbf:
+        end = pos + (code & 0x1f)
+        return data[pos:end].decode('utf-8'), end
+    if 0x90 <= code <= 0x9f:
+        return _unpack_array(data, pos, code & 0x0f)
+    if 0x80 <= code <= 0x8f:
+        return _unpack_map(data, pos, code & 0x0f)
+
+    if code == 0xc0:
+        return None, pos
+    if code == 0xc2:
+        return False, pos
+    if code == 0xc3:
+        return True, pos
+    if code == 0xcc:
+        return data[pos], pos + 1
+    if code == 0xcd:
+        return _unpack_u16(data, pos)[0], pos + 2
+    if code == 0xce:
+        return _unpack_u32(data, pos)[0], pos + 4
+    if code == 0xcf:
+        return _unpack_u64(data, pos)[0], pos + 8
+    if code == 0xd0:
+        return _unpack_i8(data, pos)[0], pos + 1
+    if code == 0xd1:
+        return _unpack_i16(data, pos)[0], pos + 2
+    if code == 0xd2:
+        return _unpack_i32(data, pos)[0], pos + 4
+    if code == 0xd3:
+        return _unpack_i64(data, pos)[0], pos + 8
+    if code == 0xca:
+        return _unpack_f32(data, pos)[0], pos + 4
+    if code == 0xcb:
+        return _unpack_f64(data, pos)[0], pos + 8
+    if code in (0xd9, 0xc4):
+        length, pos = data[pos], pos + 1
+    elif code in (0xda, 0xc5):
+        length, pos = _unpack_u16(data, pos)[0], pos + 2
+    elif code in (0xdb, 0xc6):
+        length, pos = _unpack_u32(data, pos)[0], pos + 4
+    elif code == 0xdc:
+        return _unpack_array(data, pos + 2, _unpack_u16(data, pos)[0])
+    elif code == 0xdd:
+        return _unpack_array(data, pos + 4, _unpack_u32(data, pos)[0])
+    elif code == 0xde:
+        return _unpack_map(data, pos + 2, _unpack_u16(data, pos)[0])
+    elif code == 0xdf:
+        return _unpack_map(data, pos + 4, _unpack_u32(data, pos)[0])
+    else:
+        raise ValueError(f"Unsupported type code 0x{code:02x}")
+
+    end = pos + length
+    if code >= 0xd9:
+        return data[pos:end].decode('utf-8'), end
+    return bytes(data[pos:end]), end
+
+
+def _unpack_array(data, pos, length):
+
+    items = []
+    for _ in range(length):
+        item, pos = _unpack(data, pos)
+        items.append(item)
+    return items, pos
+
+
+def _unpack_map(data, pos, length):
+
+    result = {}
+    for _ in range(length):
+        key, pos = _unpack(data, pos)
+        value, pos = _unpack(data, pos)
+        result[key] = value
+    return result, pos
+
+
+def pack(obj):
+
+    if msgpack is not None:
+        return msgpack.packb(obj, use_bin_type=True)
+
+    parts = []
+    _pack(parts, obj)
+    return b''.join(parts)
+
+
+def unpack(data):
+
+    if msgpack is not None:
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+    obj, pos = _unpack(data, 0)
+    if pos != len(data):
+        raise ValueError("Trailing data after message")
+    return obj
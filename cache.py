@@ -0,0 +1,284 @@
+import os
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    # Thread-safe cache of bytes values bounded by their total size. The
+    # least recently used entries are evicted first.
+
+    def __init__(self, max_bytes):
+
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> value, least recently used first
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def __contains__(self, key):
+
+        with self.lock:
+            return key in self.entries
+
+    def discard(self, key):
+
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.size -= len(value)
+
+    def put(self, key, value):
+
+        # Returns the [(key, value)] evicted to make room. A value larger than
+        # the whole cache is not stored and comes straight back.
+        if len(value) > self.max_bytes:
+            return [(key, value)]
+
+        evicted = []
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = value
+            self.size += len(value)
+
+            while self.size > self.max_bytes:
+                old_key, old_value = self.entries.popitem(last=False)
+                self.size -= len(old_value)
+                self.evictions += 1
+                evicted.append((old_key, old_value))
+        return evicted
+
+    def stats(self):
+
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes
+            }
+
+
+class HotChunkCache:
+    # Storage node cache of chunks that are read repeatedly. A chunk is only
+    # admitted on its second read among the last `history` chunks read from
+    # disk, so chunks read once (a large file streamed through, a replica
+    # being copied) do not push out the popular ones. With history 0 every
+    # chunk read is admitted.
+
+    def __init__(self, max_bytes, history=4096):
+
+        self.lru = LRUCache(max_bytes)
+        self.history = history
+        self.lock = threading.Lock()
+        self.seen = OrderedDict()  # chunk_id -> None, chunks read once recently
+
+        self.admissions = 0
+        self.bytes_served = 0
+
+    def get(self, chunk_id):
+
+        return self.lru.get(chunk_id)
+
+    def count_served(self, size):
+
+        with self.lock:
+            self.bytes_served += size
+
+    def admit(self, chunk_id, size):
+
+        # Whether a chunk just read from disk should be cached
+        if size > self.lru.max_bytes:
+            return False
+
+        with self.lock:
+            if self.history > 0 and chunk_id not in self.seen:
+                self.seen[chunk_id] = None
+                while len(self.seen) > self.history:
+                    self.seen.popitem(last=False)
+                return False
+            self.seen.pop(chunk_id, None)
+            self.admissions += 1
+            return True
+
+    def put(self, chunk_id, data):
+
+        self.lru.put(chunk_id, data)
+
+    def discard(self, chunk_id):
+
+        self.lru.discard(chunk_id)
+
+    def stats(self):
+
+        stats = self.lru.stats()
+        with self.lock:
+            stats['admissions'] = self.admissions
+            stats['bytes_served'] = self.bytes_served
+        return stats
+
+
+class ChunkCache:
+    # Client-side cache of chunk data keyed by chunk ID: an in-memory LRU,
+    # plus optionally a larger LRU directory on local disk that chunks move
+    # to when memory evicts them. Chunk IDs are derived from the chunk's
+    # content, so cached data never goes stale.
+
+    def __init__(self, max_bytes, directory=None, max_disk_bytes=0):
+
+        self.memory = LRUCache(max_bytes)
+
+        self.directory = directory if max_disk_bytes > 0 else None
+        self.max_disk_bytes = max_disk_bytes
+        self.disk_lock = threading.Lock()
+        self.disk = OrderedDict()  # chunk_id -> size, least recently used first
+        self.disk_size = 0
+
+        self.disk_hits = 0
+        self.misses = 0
+
+        if self.directory is not None:
+            self.load_directory()
+
+    def load_directory(self):
+
+        # Chunks left by an earlier run, oldest first
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.tmp'):
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, name, stat.st_size))
+
+        for _, name, size in sorted(entries):
+            self.disk[name] = size
+            self.disk_size += size
+        self.trim_disk()
+
+    def get(self, chunk_id):
+
+        data = self.memory.get(chunk_id)
+        if data is not None:
+            return data
+
+        if self.directory is not None:
+            data = self.read_disk(chunk_id)
+            if data is not None:
+                with self.disk_lock:
+                    self.disk_hits += 1
+                self.put_memory(chunk_id, data)
+                return data
+
+        with self.disk_lock:
+            self.misses += 1
+        return None
+
+    def put(self, chunk_id, data):
+
+        if self.memory.max_bytes > 0:
+            self.put_memory(chunk_id, data)
+        elif self.directory is not None:
+            self.write_disk(chunk_id, data)
+
+    def put_memory(self, chunk_id, data):
+
+        for evicted_id, evicted_data in self.memory.put(chunk_id, bytes(data)):
+            if self.directory is not None:
+                self.write_disk(evicted_id, evicted_data)
+
+    def read_disk(self, chunk_id):
+
+        with self.disk_lock:
+            if chunk_id not in self.disk:
+                return None
+            self.disk.move_to_end(chunk_id)
+
+        try:
+            with open(os.path.join(self.directory, chunk_id), 'rb') as f:
+                return f.read()
+        except OSError:
+            # Evicted by another thread in the meantime
+            return None
+
+    def write_disk(self, chunk_id, data):
+
+        with self.disk_lock:
+            if chunk_id in self.disk:
+                self.disk.move_to_end(chunk_id)
+                return
+        if len(data) > self.max_disk_bytes:
+            return
+
+        path = os.path.join(self.directory, chunk_id)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"Error caching chunk {chunk_id} on disk: {e}")
+            return
+
+        with self.disk_lock:
+            if chunk_id not in self.disk:
+                self.disk[chunk_id] = len(data)
+                self.disk_size += len(data)
+        self.trim_disk()
+
+    def trim_disk(self):
+
+        removed = []
+        with self.disk_lock:
+            while self.disk_size > self.max_disk_bytes:
+                chunk_id, size = self.disk.popitem(last=False)
+                self.disk_size -= size
+                removed.append(chunk_id)
+
+        for chunk_id in removed:
+            try:
+                os.remove(os.path.join(self.directory, chunk_id))
+            except OSError:
+                pass
+
+    def stats(self):
+
+        memory = self.memory.stats()
+        with self.disk_lock:
+            hits = memory['hits'] + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                'hits': hits,
+                'memory_hits': memory['hits'],
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': hits / lookups if lookups else 0.0,
+                'memory_chunks': memory['entries'],
+                'memory_bytes': memory['bytes'],
+                'memory_evictions': memory['evictions'],
+                'disk_chunks': len(self.disk),
+                'disk_bytes': self.disk_size
+            }
@@ -0,0 +1,251 @@
+def pack_chunk_id(chunk_id):
+
+    # Chunk IDs that start with a SHA-256 hex digest (content IDs, and the
+    # "<digest>-rs4-2.<i>" fragment IDs) are kept as the 32-byte digest
+    # followed by the rest of the ID; any other ID is kept as it is
+    head = chunk_id[:64]
+    if len(head) == 64 and chunk_id.isascii():
+        try:
+            digest = bytes.fromhex(head)
+        except ValueError:
+            return chunk_id
+        if digest.hex() == head:
+            return digest + chunk_id[64:].encode('ascii')
+    return chunk_id
+
+
+def unpack_chunk_id(key):
+
+    if isinstance(key, bytes):
+        return key[:32].hex() + key[32:].decode('ascii')
+    return key
+
+
+class ChunkLocationTable:
+    # The master's chunk_id -> replica locations map, laid out for millions
+    # of chunks. Storage nodes are interned as small node numbers, chunk IDs
+    # are packed with pack_chunk_id, and a chunk's replica set is a bitmask
+    # of node numbers, so a chunk costs one dict entry, a short bytes key
+    # and usually a cached small int instead of a list of [host, port]
+    # lists. Per-node sets of chunk keys let a node failure touch only its
+    # own chunks.
+    #
+    # Reads go through the same dict-style interface as before and return
+    # locations as [(host, port)] in node number order.
+
+    SHARED_MAX = 65536
+    DECODED_MAX = 65536
+
+    def __init__(self):
+
+        self.masks = {}  # packed chunk_id -> bitmask of node numbers
+        self.nodes = []  # node number -> (host, port)
+        self.node_numbers = {}  # "host:port" -> node number
+        self.node_chunks = []  # node number -> {packed chunk_id}
+
+        # Replica sets repeat across chunks, so each bitmask is stored as one
+        # shared int object (ints above 256 are not cached by Python), and
+        # decoded ones are kept. Node numbers are never reused, so entries
+        # never go stale.
+        self.shared_masks = {}  # bitmask -> the same bitmask
+        self.decoded = {}  # bitmask -> ((host, port), ...)
+
+    def node_number(self, host, port):
+
+        node_id = f"{host}:{port}"
+        number = self.node_numbers.get(node_id)
+        if number is None:
+            number = len(self.nodes)
+            self.nodes.append((host, port))
+            self.node_numbers[node_id] = number
+            self.node_chunks.append(set())
+        return number
+
+    def encode(self, locations):
+
+        mask = 0
+        for loc in locations:
+            mask |= 1 << self.node_number(loc[0], loc[1])
+        return self.share(mask)
+
+    def share(self, mask):
+
+        shared = self.shared_masks.get(mask)
+        if shared is None:
+            if len(self.shared_masks) >= self.SHARED_MAX:
+                return mask
+            shared = self.shared_masks[mask] = mask
+        return shared
+
+    def decode(self, mask):
+
+        locations = self.decoded.get(mask)
+        if locations is None:
+            if len(self.decoded) >= self.DECODED_MAX:
+                self.decoded.clear()
+            locations = []
+            rest = mask
+            while rest:
+                low = rest & -rest
+                locations.append(self.nodes[low.bit_length() - 1])
+                rest ^= low
+            locations = tuple(locations)
+            self.decoded[mask] = locations
+        return list(locations)
+
+    def get(self, chunk_id, default=None):
+
+        mask = self.masks.get(pack_chunk_id(chunk_id))
+        if mask is None:
+            return default
+        return self.decode(mask)
+
+    def __getitem__(self, chunk_id):
+
+        mask = self.masks.get(pack_chunk_id(chunk_id))
+        if mask is None:
+            raise KeyError(chunk_id)
+        return self.decode(mask)
+
+    def __setitem__(self, chunk_id, locations):
+
+        key = pack_chunk_id(chunk_id)
+        old_mask = self.masks.get(key, 0)
+        new_mask = self.encode(locations)
+        self.masks[key] = new_mask
+        self.reindex(key, old_mask, new_mask)
+
+    def pop(self, chunk_id, default=None):
+
+        key = pack_chunk_id(chunk_id)
+        mask = self.masks.pop(key, None)
+        if mask is None:
+            return default
+        self.reindex(key, mask, 0)
+        return self.decode(mask)
+
+    def reindex(self, key, old_mask, new_mask):
+
+        changed = old_mask ^ new_mask
+        while changed:
+            low = changed & -changed
+            number = low.bit_length() - 1
+            if new_mask & low:
+                self.node_chunks[number].add(key)
+            else:
+                self.node_chunks[number].discard(key)
+            changed ^= low
+
+    def __contains__(self, chunk_id):
+
+        return pack_chunk_id(chunk_id) in self.masks
+
+    def __len__(self):
+
+        return len(self.masks)
+
+    def __iter__(self):
+
+        return self.keys()
+
+    def keys(self):
+
+        for key in self.masks:
+            yield unpack_chunk_id(key)
+
+    def items(self):
+
+        for key, mask in self.masks.items():
+            yield unpack_chunk_id(key), self.decode(mask)
+
+    def values(self):
+
+        for mask in self.masks.values():
+            yield self.decode(mask)
+
+    def replica_count(self, chunk_id):
+
+        return self.masks.get(pack_chunk_id(chunk_id), 0).bit_count()
+
+    def node_mask(self, node_ids):
+
+        # Bitmask of the given "host:port" node IDs, e.g. the live nodes, to
+        # pass to live_locations() and live_count()
+        mask = 0
+        for node_id in node_ids:
+            number = self.node_numbers.get(node_id)
+            if number is not None:
+                mask |= 1 << number
+        return mask
+
+    def live_locations(self, chunk_id, node_mask, default=None):
+
+        mask = self.masks.get(pack_chunk_id(chunk_id))
+        if mask is None:
+            return default
+        return self.decode(mask & node_mask)
+
+    def live_count(self, chunk_id, node_mask):
+
+        return (self.masks.get(pack_chunk_id(chunk_id), 0) & node_mask).bit_count()
+
+    def drop_nodes(self, node_ids):
+
+        # Remove the nodes from every replica set, touching only their own
+        # chunks. Returns [(chunk_id, old replica count, new replica count)].
+        dropped = 0
+        affected = set()
+        for node_id in node_ids:
+            number = self.node_numbers.get(node_id)
+            if number is not None:
+                dropped |= 1 << number
+                affected.update(self.node_chunks[number])
+                self.node_chunks[number] = set()
+
+        changes = []
+        for key in affected:
+            mask = self.masks[key]
+            self.masks[key] = self.share(mask & ~dropped)
+            changes.append((unpack_chunk_id(key), mask.bit_count(), (mask & ~dropped).bit_count()))
+        return changes
+
+    def replica_counts(self):
+
+        for key, mask in self.masks.items():
+            yield unpack_chunk_id(key), mask.bit_count()
+
+    def node_ids(self):
+
+        # Nodes holding at least one chunk
+        return [f"{host}:{port}" for (host, port), chunks in zip(self.nodes, self.node_chunks) if chunks]
+
+    def chunks_on_node(self, node_id):
+
+        number = self.node_numbers.get(node_id)
+        if number is None:
+            return []
+        return [unpack_chunk_id(key) for key in self.node_chunks[number]]
+
+    def dump(self):
+
+        # A snapshot: {'nodes': [[host, port]], 'masks': {packed chunk_id:
+        # mask}}. Call with the owner's lock held; the copies are cheap, and
+        # the returned state stays valid once the lock is released. Keys
+        # must be unpacked with unpack_chunk_id before writing it as JSON.
+        return {'nodes': [list(node) for node in self.nodes], 'masks': dict(self.masks)}
+
+    def load(self, state):
+
+        # Inverse of dump(), also accepting a dump whose masks are keyed by
+        # unpacked chunk IDs, as read back from JSON
+        numbers = [self.node_number(host, port) for host, port in state['nodes']]
+        for chunk_id, mask in state['masks'].items():
+            key = pack_chunk_id(chunk_id) if isinstance(chunk_id, str) else chunk_id
+            remapped = 0
+            while mask:
+                low = mask & -mask
+                remapped |= 1 << numbers[low.bit_length() - 1]
+                mask ^= low
+            old_mask = self.masks.get(key, 0)
+            self.masks[key] = remapped = self.share(remapped)
+            self.reindex(key, old_mask, remapped)
@@ -0,0 +1,193 @@
+import hashlib
+
+# Content-defined chunking with a FastCDC-style Gear rolling hash.
+#
+# The hash at byte i is sum(GEAR[data[i - j]] << j for j in range(64)) mod
+# 2**64, i.e. it depends only on the 64 bytes ending at i. A chunk ends after
+# byte i when the hash has no bits in common with the mask. Like FastCDC,
+# chunking is normalized: before the average size a mask with more bits (a
+# rarer match) is used, after it a mask with fewer bits, which pulls chunk
+# sizes towards the average. Because cut points depend only on nearby
+# content, inserting bytes early in a file only changes the chunks around
+# the insertion.
+#
+# Hashes are computed with NumPy when it is installed, and with a
+# pure-Python loop otherwise; both find the same cut points.
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+WINDOW = 64
+MASK64 = (1 << 64) - 1
+
+# 256 fixed pseudo-random 64-bit values, derived deterministically so every
+# client cuts the same content at the same places
+GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], 'big') for i in range(256)]
+
+
+def make_mask(bits):
+
+    # Spread the mask bits over the upper 48 bits of the hash, which depend
+    # on the most bytes of the window
+    positions = {63 - (i * 48) // bits for i in range(bits)}
+    mask = 0
+    for position in positions:
+        mask |= 1 << position
+    return mask
+
+
+class ContentDefinedChunker:
+
+    NUMPY_BLOCK = 64 * 1024
+
+    def __init__(self, min_size, avg_size, max_size, normalization=2):
+
+        if not WINDOW <= min_size <= avg_size <= max_size:
+            raise ValueError("Chunk sizes must satisfy 64 <= min <= avg <= max")
+
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+
+        bits = max(1, avg_size.bit_length() - 1)
+        self.mask_small = make_mask(min(48, bits + normalization))
+        self.mask_large = make_mask(max(1, bits - normalization))
+
+        if np is not None:
+            self.gear_array = np.array(GEAR, dtype=np.uint64)
+
+    def iter_chunks(self, stream, read_chunk):
+
+        # Yield chunks of a stream as bytes. read_chunk(stream, size) must
+        # return exactly `size` bytes unless the stream ends.
+        block_size = max(4 * self.max_size, 8 * 1024 * 1024)
+        buffer = b''
+        eof = False
+
+        while not eof or buffer:
+            if not eof:
+                data = read_chunk(stream, block_size)
+                eof = len(data) < block_size
+                buffer = buffer + data if buffer else data
+
+            if not buffer:
+                break
+
+            # At end of stream cut_points consumes everything; otherwise the
+            # unfinished tail is carried over to the next block
+            consumed = 0
+            for end in self.cut_points(buffer, eof):
+                yield buffer[consumed:end]
+                consumed = end
+            buffer = buffer[consumed:]
+
+    def cut_points(self, data, final):
+
+        # Chunk end offsets in `data`, which must start at a chunk boundary.
+        # Unless `final`, a trailing chunk whose end depends on bytes past the
+        # end of `data` is left out.
+        if np is not None and len(data) >= WINDOW:
+            return self.cut_points_numpy(data, final)
+        return self.cut_points_python(data, final)
+
+    def cut_points_python(self, data, final):
+
+        cuts = []
+        start = 0
+        length = len(data)
+        gear = GEAR
+        mask_small = self.mask_small
+        mask_large = self.mask_large
+
+        while start < length:
+            first = start + self.min_size - 1      # earliest last byte of a chunk
+            normal = start + self.avg_size - 1     # switch to the easier mask here
+            last = min(start + self.max_size, length) - 1
+
+            end = None
+            h = 0
+            for i in range(max(start, first - WINDOW + 1), last + 1):
+                h = ((h << 1) + gear[data[i]]) & MASK64
+                if i < first:
+                    continue
+                if h & (mask_small if i < normal else mask_large) == 0:
+                    end = i + 1
+                    break
+
+            if end is None:
+                if start + self.max_size <= length:
+                    end = start + self.max_size
+                elif final:
+                    end = length
+                else:
+                    break
+
+            cuts.append(end)
+            start = end
+
+        return cuts
+
+    def find_candidates(self, data):
+
+        # Offsets where the hash matches the small and the large mask. Hashes
+        # are computed in blocks that fit in the CPU cache, each block
+        # starting WINDOW - 1 bytes early so its first hashes are complete.
+        values = np.frombuffer(data, dtype=np.uint8)
+        mask_small = np.uint64(self.mask_small)
+        mask_large = np.uint64(self.mask_large)
+        small = []
+        large = []
+
+        for offset in range(0, len(values), self.NUMPY_BLOCK):
+            begin = max(0, offset - WINDOW + 1)
+            h = self.gear_array[values[begin:offset + self.NUMPY_BLOCK]]
+
+            # Window sums by doubling: after the step with span s, h[i] covers
+            # the 2*s bytes ending at i
+            span = 1
+            while span < WINDOW:
+                h[span:] += h[:-span] << np.uint64(span)
+                span *= 2
+
+            h = h[offset - begin:]
+            small.append(np.flatnonzero((h & mask_small) == 0) + offset)
+            large.append(np.flatnonzero((h & mask_large) == 0) + offset)
+
+        return np.concatenate(small), np.concatenate(large)
+
+    def cut_points_numpy(self, data, final):
+
+        length = len(data)
+        small, large = self.find_candidates(data)
+
+        cuts = []
+        start = 0
+        while start < length:
+            first = start + self.min_size - 1
+            normal = start + self.avg_size - 1
+            last = start + self.max_size - 1
+
+            end = None
+            k = np.searchsorted(small, first)
+            if k < len(small) and small[k] < normal and small[k] < length:
+                end = int(small[k]) + 1
+            else:
+                k = np.searchsorted(large, normal)
+                if k < len(large) and large[k] <= last:
+                    end = int(large[k]) + 1
+
+            if end is None:
+                if start + self.max_size <= length:
+                    end = start + self.max_size
+                elif final:
+                    end = length
+                else:
+                    break
+
+            cuts.append(end)
+            start = end
+
+        return cuts
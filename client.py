@@ -1,9 +1,115 @@
-import socket
 import sys
 import os
+import bisect
 import hashlib
-from utils import send_json, recv_json, recv_all
-from config import MASTER_HOST, MASTER_PORT, CHUNK_SIZE
+import itertools
+import random
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from utils import ConnectionPool
+from chunking import ContentDefinedChunker
+from erasure import ReedSolomon
+from cache import ChunkCache
+from upload_sessions import UploadSessionStore
+from config import MASTER_HOST, MASTER_PORT, CHUNK_SIZE, REPLICATION_FACTOR, UPLOAD_WINDOW, \
+    DOWNLOAD_WINDOW, HEDGE_DELAY, POOL_MAX_IDLE, WIRE_ENCODING, CHUNK_ID_MODE, CHUNKING, \
+    CDC_MIN_SIZE, CDC_AVG_SIZE, CDC_MAX_SIZE, NODE_STATS_ALPHA, STORAGE_MODE, ERASURE_K, ERASURE_M, \
+    CHUNK_CACHE_SIZE, CHUNK_CACHE_DIR, CHUNK_CACHE_DISK_SIZE, UPLOAD_PART_SIZE, UPLOAD_SESSION_DIR
+
+
+def remove_partial(path):
+
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class NodeStats:
+    # What the client has learned about each storage node from its own
+    # transfers: smoothed round-trip time, throughput and error rate, and the
+    # requests it has outstanding there. Used to pick which replica to read.
+
+    def __init__(self, alpha=NODE_STATS_ALPHA):
+
+        self.alpha = alpha
+        self.lock = threading.Lock()
+        self.nodes = {}  # (host, port) -> stats
+
+    def get(self, node):
+
+        # Caller holds self.lock
+        stats = self.nodes.get(node)
+        if stats is None:
+            stats = {'rtt': None, 'throughput': None, 'error_rate': 0.0, 'in_flight': 0,
+                     'transfers': 0, 'errors': 0}
+            self.nodes[node] = stats
+        return stats
+
+    def begin(self, node):
+
+        with self.lock:
+            self.get(node)['in_flight'] += 1
+
+    def end(self, node, ok, rtt=None, size=0, transfer_time=None):
+
+        with self.lock:
+            stats = self.get(node)
+            stats['in_flight'] -= 1
+            stats['error_rate'] = self.smooth(stats['error_rate'], 0.0 if ok else 1.0)
+
+            if not ok:
+                stats['errors'] += 1
+                return
+
+            stats['transfers'] += 1
+            if rtt is not None:
+                stats['rtt'] = self.smooth(stats['rtt'], rtt)
+            if size and transfer_time:
+                stats['throughput'] = self.smooth(stats['throughput'], size / transfer_time)
+
+    def smooth(self, average, sample):
+
+        return sample if average is None else average + self.alpha * (sample - average)
+
+    def expected_time(self, node, size):
+
+        # Estimated seconds to read `size` bytes from the node: the request
+        # waits behind this client's outstanding ones, and each recent error
+        # risks a retry. Unmeasured nodes score low so they get tried.
+        stats = self.nodes.get(node)
+        if stats is None:
+            return 0.0
+
+        estimate = stats['rtt'] or 0.0
+        if stats['throughput']:
+            estimate += size / stats['throughput']
+        return estimate * (1 + stats['in_flight']) + stats['error_rate'] * HEDGE_DELAY
+
+    def rank(self, locations, size=CHUNK_SIZE):
+
+        # Order in which to try the replicas. The first is the better of two
+        # random replicas, so reads spread over the good replicas instead of
+        # all going to the single fastest one; the rest follow by score.
+        if len(locations) < 2:
+            return list(locations)
+
+        with self.lock:
+            scored = [
+                (self.expected_time((loc[0], loc[1]), size), random.random(), loc)
+                for loc in locations
+            ]
+
+        first = min(random.sample(scored, 2))
+        rest = sorted(item for item in scored if item is not first)
+        return [first[2]] + [item[2] for item in rest]
+
+    def summary(self):
+
+        with self.lock:
+            return {node: dict(stats) for node, stats in self.nodes.items()}
 
 
 class Client:
@@ -12,7 +118,19 @@ class Client:
         self.master_host = MASTER_HOST
         self.master_port = MASTER_PORT
 
-    def upload_file(self, filepath):
+        # Connections to the master and storage nodes are reused across calls
+        self.pool = ConnectionPool(max_idle=POOL_MAX_IDLE, encoding=WIRE_ENCODING)
+
+        # Per-node latency, throughput and errors seen by this client
+        self.node_stats = NodeStats()
+
+        # Downloaded chunks, so repeated downloads are served locally
+        self.chunk_cache = ChunkCache(CHUNK_CACHE_SIZE, CHUNK_CACHE_DIR, CHUNK_CACHE_DISK_SIZE)
+
+        # Unfinished resumable uploads
+        self.upload_sessions = UploadSessionStore(UPLOAD_SESSION_DIR)
+
+    def upload_file(self, filepath, progress_callback=None, storage_mode=STORAGE_MODE):
 
         if not os.path.exists(filepath):
             print(f"Error: File {filepath} not found")
@@ -21,38 +139,336 @@ class Client:
         filename = os.path.basename(filepath)
         print(f"Uploading {filename}...")
 
-        chunks = self.partition_file(filepath)
-        print(f"File partitioned into {len(chunks)} chunks")
+        with open(filepath, 'rb') as f:
+            return self.upload_stream(filename, f, progress_callback, storage_mode=storage_mode)
+
+    def upload_stream(self, filename, stream, progress_callback=None, window=UPLOAD_WINDOW,
+                      storage_mode=STORAGE_MODE):
+
+        stats = self.store_stream(stream, progress_callback, window, storage_mode)
+        if stats is None:
+            return None
+
+        if not self.commit_file(filename, stats['chunk_ids'], stats['chunk_locations'], stats['chunk_sizes'],
+                                stats['erasure'], stats['digest']):
+            print(f"Failed to commit {filename} on master")
+            return None
+
+        print(f"Upload complete: {stats['stored']}/{len(stats['chunk_ids'])} chunks stored, "
+              f"{stats['deduplicated']} already present "
+              f"({stats['bytes'] / (1024 * 1024):.2f} MB in {stats['elapsed']:.2f}s, "
+              f"{stats['throughput'] / (1024 * 1024):.2f} MB/s)")
+        return stats
+
+    def begin_upload(self, filename, storage_mode=STORAGE_MODE):
 
-        chunk_ids = [chunk['id'] for chunk in chunks]
-        chunk_assignments = self.request_upload(filename, chunk_ids)
+        # Start a resumable upload. The file is then sent as parts of
+        # part_size bytes (the last one may be shorter) with upload_part, in
+        # any order; a part that fails can simply be sent again.
+        session = self.upload_sessions.create(filename, storage_mode, UPLOAD_PART_SIZE)
+        print(f"Started upload {session['upload_id']} for {filename}")
+        return session
 
-        if not chunk_assignments:
+    def upload_part(self, upload_id, index, stream):
+
+        session = self.upload_sessions.get(upload_id)
+        if session is None:
+            print(f"Unknown upload {upload_id}")
+            return None
+
+        stats = self.store_stream(stream, storage_mode=session['storage_mode'])
+        if stats is None:
+            return None
+
+        # Every part but the last must be exactly part_size bytes, or the
+        # parts after it would land at the wrong offsets
+        part_size = session['part_size']
+        if stats['size'] > part_size or (stats['size'] < part_size and any(i > index for i in session['parts'])):
+            print(f"Upload {upload_id}: part {index} is {stats['size']} bytes, expected {part_size}")
+            return None
+
+        part = {
+            'index': index,
+            'size': stats['size'],
+            'chunk_ids': stats['chunk_ids'],
+            'chunk_sizes': stats['chunk_sizes'],
+            'chunk_locations': stats['chunk_locations'],
+            'erasure': stats['erasure']
+        }
+        if not self.upload_sessions.add_part(upload_id, part):
+            print(f"Unknown upload {upload_id}")
+            return None
+
+        print(f"Upload {upload_id}: part {index} stored ({part['size']} bytes)")
+        return part
+
+    def upload_status(self, upload_id):
+
+        # Which parts are already stored, so a client resuming an upload only
+        # sends the others
+        session = self.upload_sessions.get(upload_id)
+        if session is None:
+            return None
+
+        parts = session['parts']
+        return {
+            'upload_id': upload_id,
+            'filename': session['filename'],
+            'part_size': session['part_size'],
+            'parts': sorted(parts),
+            'invalid_parts': self.invalid_parts(session),
+            'size': sum(part['size'] for part in parts.values())
+        }
+
+    def invalid_parts(self, session):
+
+        # Parts that have to be sent again: any part other than the last one
+        # stored that is not exactly part_size bytes, and any longer part
+        parts = session['parts']
+        last = max(parts, default=None)
+        return sorted(
+            index for index, part in parts.items()
+            if part['size'] > session['part_size'] or (index != last and part['size'] != session['part_size'])
+        )
+
+    def complete_upload(self, upload_id):
+
+        session = self.upload_sessions.get(upload_id)
+        if session is None:
+            print(f"Unknown upload {upload_id}")
+            return None
+
+        parts = [session['parts'][index] for index in sorted(session['parts'])]
+        if not parts or parts[-1]['index'] != len(parts) - 1:
+            missing = sorted(set(range(parts[-1]['index'] + 1 if parts else 1)) - set(session['parts']))
+            print(f"Upload {upload_id} is missing parts {missing}")
+            return None
+
+        invalid = self.invalid_parts(session)
+        if invalid:
+            print(f"Upload {upload_id} has parts of the wrong size: {invalid}")
+            return None
+
+        erasure = parts[0]['erasure']
+        if any(part['erasure'] != erasure for part in parts):
+            print(f"Upload {upload_id} mixes storage modes")
+            return None
+
+        chunk_ids = []
+        chunk_sizes = []
+        chunk_locations = {}
+        for part in parts:
+            chunk_ids.extend(part['chunk_ids'])
+            chunk_sizes.extend(part['chunk_sizes'])
+            chunk_locations.update(part['chunk_locations'])
+
+        # Parts arrive in any order and are never held together, so there is
+        # no whole-file digest to record
+        if not self.commit_file(session['filename'], chunk_ids, chunk_locations, chunk_sizes, erasure):
+            print(f"Failed to commit {session['filename']} on master")
+            return None
+
+        self.upload_sessions.remove(upload_id)
+        size = sum(chunk_sizes)
+        print(f"Upload {upload_id} complete: {session['filename']}, {len(parts)} parts, {size} bytes")
+        return {'filename': session['filename'], 'size': size, 'parts': len(parts)}
+
+    def abort_upload(self, upload_id):
+
+        # Stored chunks stay on the nodes, like those of any uncommitted upload
+        return self.upload_sessions.remove(upload_id)
+
+    def store_stream(self, stream, progress_callback=None, window=UPLOAD_WINDOW, storage_mode=STORAGE_MODE):
+
+        # Chunks are hashed, assigned and shipped as they are read, so memory is
+        # bounded by the upload window rather than by the size of the file.
+        # Returns the upload stats plus what COMMIT_FILE needs (chunk_ids,
+        # chunk_sizes, erasure, digest), or None if any chunk could not be stored.
+        upload_state = {'chunk_ids': [], 'chunk_sizes': [], 'digest': hashlib.sha256(), 'allocation_failed': False}
+
+        erasure = None
+        if storage_mode == 'erasure':
+            # Each chunk is stored as k data + m parity fragments, one per node
+            coder = ReedSolomon(ERASURE_K, ERASURE_M)
+            erasure = {'k': coder.k, 'm': coder.m}
+            stripes = self.allocate_chunks(self.iter_stripes(self.iter_chunks(stream), coder),
+                                           upload_state, window, fragments=coder.k + coder.m)
+            chunks = self.iter_fragments(stripes, coder)
+        else:
+            chunks = self.allocate_chunks(self.iter_chunks(stream), upload_state, window)
+        stats = self.upload_chunks(chunks, progress_callback, window)
+
+        chunk_ids = upload_state['chunk_ids']
+        if upload_state['allocation_failed']:
             print("Failed to get chunk assignments from master")
-            return
+            return None
 
-        success_count = 0
-        for chunk in chunks:
-            chunk_id = chunk['id']
-            chunk_data = chunk['data']
-            assigned_nodes = chunk_assignments.get(chunk_id, [])
+        if stats['failed']:
+            print(f"Upload failed: {stats['failed']}/{stats['chunks']} chunks could not be stored")
+            return None
 
-            if not assigned_nodes:
-                print(f"No nodes assigned for chunk {chunk_id}")
-                continue
+        if erasure:
+            # The file is committed as its fragments; chunk sizes stay per stripe
+            fragment_count = erasure['k'] + erasure['m']
+            chunk_ids = [f"{chunk_id}.{index}" for chunk_id in chunk_ids for index in range(fragment_count)]
+
+        stats['chunk_ids'] = chunk_ids
+        stats['chunk_sizes'] = upload_state['chunk_sizes']
+        stats['erasure'] = erasure
+        stats['size'] = sum(upload_state['chunk_sizes'])
+        stats['digest'] = upload_state['digest'].hexdigest()
+        return stats
+
+    def allocate_chunks(self, chunks, upload_state, batch_size, fragments=None):
+
+        # Ask the master for replica assignments one batch of chunks at a time.
+        # Chunks the master already has are marked as existing and not sent.
+        # With `fragments`, each chunk gets that many distinct nodes instead.
+        batch = []
+        for chunk in itertools.chain(chunks, [None]):
+            if chunk is not None:
+                batch.append(chunk)
+                if len(batch) < max(1, batch_size):
+                    continue
+
+            if not batch:
+                break
+
+            allocation = self.request_chunk_allocation([c['id'] for c in batch], skip_existing=True,
+                                                       fragments=fragments)
+            if allocation is None:
+                upload_state['allocation_failed'] = True
+                return
 
-            stored_locations = []
-            for node_host, node_port in assigned_nodes:
-                if self.store_chunk(node_host, node_port, chunk_id, chunk_data):
-                    stored_locations.append((node_host, node_port))
+            chunk_assignments, existing_chunks = allocation
+            for c in batch:
+                c['nodes'] = chunk_assignments.get(c['id'], [])
+                c['existing'] = c['id'] in existing_chunks
+                upload_state['chunk_ids'].append(c['id'])
+                upload_state['chunk_sizes'].append(len(c['data']))
+                upload_state['digest'].update(c['data'])
+                yield c
+            batch = []
 
-            if stored_locations:
-                self.report_chunk_storage(chunk_id, stored_locations)
-                success_count += 1
+    def iter_stripes(self, chunks, coder):
 
-        print(f"Upload complete: {success_count}/{len(chunks)} chunks stored")
+        # Stripe IDs name the code, so the same content stored replicated and
+        # erasure-coded never shares IDs
+        for chunk in chunks:
+            chunk['id'] = f"{chunk['id']}-rs{coder.k}-{coder.m}"
+            yield chunk
+
+    def iter_fragments(self, stripes, coder):
+
+        # Expand each allocated stripe into its fragments, fragment i going to
+        # the stripe's i-th assigned node
+        fragment_count = coder.k + coder.m
+        for stripe in stripes:
+            nodes = stripe['nodes']
+            if stripe['existing'] or len(nodes) != fragment_count:
+                fragments = [b''] * fragment_count
+                nodes = [None] * fragment_count
+            else:
+                fragments = coder.encode(stripe['data'])
+
+            for index in range(fragment_count):
+                yield {
+                    'id': f"{stripe['id']}.{index}",
+                    'data': fragments[index],
+                    'nodes': [nodes[index]] if nodes[index] else [],
+                    'existing': stripe['existing']
+                }
+
+    def upload_chunks(self, chunks, progress_callback=None, window=UPLOAD_WINDOW):
+
+        # Every (chunk, replica) store runs as its own task, so all replicas of a
+        # chunk are written in parallel and up to `window` chunks are in flight.
+        stats = {'chunks': 0, 'stored': 0, 'deduplicated': 0, 'failed': 0, 'bytes': 0,
+                 'elapsed': 0.0, 'throughput': 0.0, 'chunk_locations': {}}
+        start_time = time.time()
+
+        pending = {}    # future -> (chunk_id, (host, port))
+        in_flight = {}  # chunk_id -> {'size': n, 'remaining': n, 'stored': [...], 'duplicates': n}
+        chunk_iter = iter(chunks)
+        completed = 0
+
+        with ThreadPoolExecutor(max_workers=max(1, window) * REPLICATION_FACTOR) as pool:
+            while True:
+                while len(in_flight) < max(1, window):
+                    chunk = next(chunk_iter, None)
+                    if chunk is None:
+                        break
+
+                    chunk_id = chunk['id']
+                    chunk_data = chunk['data']
+                    assigned_nodes = chunk.get('nodes', [])
+                    stats['chunks'] += 1
+
+                    # Content already on the storage nodes, or repeated earlier
+                    # in this file, is not sent again
+                    if chunk.get('existing') or chunk_id in stats['chunk_locations']:
+                        stats['deduplicated'] += 1
+                        completed += 1
+                        continue
+                    if chunk_id in in_flight:
+                        in_flight[chunk_id]['duplicates'] += 1
+                        continue
+
+                    if not assigned_nodes:
+                        print(f"No nodes assigned for chunk {chunk_id}")
+                        stats['failed'] += 1
+                        completed += 1
+                        continue
+
+                    in_flight[chunk_id] = {
+                        'size': len(chunk_data),
+                        'remaining': len(assigned_nodes),
+                        'stored': [],
+                        'duplicates': 0
+                    }
+                    for node_host, node_port in assigned_nodes:
+                        future = pool.submit(self.store_chunk, node_host, node_port, chunk_id, chunk_data)
+                        pending[future] = (chunk_id, (node_host, node_port))
+
+                if not pending:
+                    break
 
-    def download_file(self, filename, output_path):
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    chunk_id, location = pending.pop(future)
+                    state = in_flight[chunk_id]
+                    if future.result():
+                        state['stored'].append(location)
+                    state['remaining'] -= 1
+
+                    if state['remaining'] > 0:
+                        continue
+
+                    del in_flight[chunk_id]
+                    completed += 1 + state['duplicates']
+                    if state['stored']:
+                        # Locations are sent to the master in one batch on commit
+                        stats['chunk_locations'][chunk_id] = state['stored']
+                        stats['stored'] += 1
+                        stats['deduplicated'] += state['duplicates']
+                        stats['bytes'] += state['size']
+                    else:
+                        stats['failed'] += 1 + state['duplicates']
+
+                    elapsed = time.time() - start_time
+                    throughput = stats['bytes'] / elapsed if elapsed > 0 else 0.0
+                    if progress_callback:
+                        progress_callback(chunk_id, completed, len(state['stored']), throughput)
+                    else:
+                        print(f"  Chunk {completed} stored on "
+                              f"{len(state['stored'])} replicas ({throughput / (1024 * 1024):.2f} MB/s)")
+
+        stats['elapsed'] = time.time() - start_time
+        if stats['elapsed'] > 0:
+            stats['throughput'] = stats['bytes'] / stats['elapsed']
+        return stats
+
+    def download_file(self, filename, output_path, parallel=True):
 
         print(f"Downloading {filename}...")
 
@@ -64,9 +480,23 @@ class Client:
 
         chunk_ids = download_info['chunk_ids']
         chunk_locations = download_info['chunk_locations']
+        chunk_sizes = download_info.get('chunk_sizes')
+
+        if download_info.get('erasure'):
+            if not self.download_stripes(chunk_ids, chunk_locations, chunk_sizes, download_info['erasure'],
+                                         output_path):
+                return False
+            print(f"Download complete: {output_path}")
+            return True
 
         print(f"File has {len(chunk_ids)} chunks")
 
+        if parallel:
+            if not self.download_chunks(chunk_ids, chunk_locations, output_path, chunk_sizes):
+                return False
+            print(f"Download complete: {output_path}")
+            return True
+
         chunks = []
         for chunk_id in chunk_ids:
             locations = chunk_locations.get(chunk_id, [])
@@ -75,15 +505,17 @@ class Client:
                 print(f"No locations available for chunk {chunk_id}")
                 return
 
-            chunk_data = None
-            for node_host, node_port in locations:
-                chunk_data = self.retrieve_chunk(node_host, node_port, chunk_id)
-                if chunk_data:
-                    break
+            chunk_data = self.chunk_cache.get(chunk_id)
+            if chunk_data is None:
+                for node_host, node_port in self.node_stats.rank(locations):
+                    chunk_data = self.retrieve_chunk(node_host, node_port, chunk_id)
+                    if chunk_data:
+                        break
 
-            if not chunk_data:
-                print(f"Failed to retrieve chunk {chunk_id}")
-                return
+                if not chunk_data:
+                    print(f"Failed to retrieve chunk {chunk_id}")
+                    return
+                self.chunk_cache.put(chunk_id, chunk_data)
 
             chunks.append(chunk_data)
 
@@ -91,113 +523,510 @@ class Client:
         print(f"Download complete: {output_path}")
         return True
 
-    def list_files(self):
+    def download_chunks(self, chunk_ids, chunk_locations, output_path, chunk_sizes=None,
+                        window=DOWNLOAD_WINDOW):
+
+        for chunk_id in chunk_ids:
+            if not chunk_locations.get(chunk_id):
+                print(f"No locations available for chunk {chunk_id}")
+                return False
+
+        # Content-defined chunks vary in size, so offsets come from the sizes
+        # recorded at upload; files without them used fixed-size chunks
+        if chunk_sizes and len(chunk_sizes) == len(chunk_ids):
+            offsets = list(itertools.accumulate(chunk_sizes, initial=0))
+        else:
+            offsets = [index * CHUNK_SIZE for index in range(len(chunk_ids) + 1)]
+
+        def fetch(index, attempts):
+            chunk_id = chunk_ids[index]
+            return self.fetch_chunk(chunk_id, chunk_locations[chunk_id],
+                                    offsets[index + 1] - offsets[index], attempts)
+
+        return self.write_pieces(output_path, offsets, fetch, REPLICATION_FACTOR, window)
+
+    def download_stripes(self, fragment_ids, fragment_locations, chunk_sizes, erasure, output_path,
+                         window=DOWNLOAD_WINDOW):
+
+        # Erasure-coded file: every stripe is rebuilt from any k of its
+        # fragments
+        coder = ReedSolomon(erasure['k'], erasure['m'])
+        fragment_count = coder.k + coder.m
+        stripe_count = len(fragment_ids) // fragment_count
+        offsets = list(itertools.accumulate(chunk_sizes, initial=0))
+
+        print(f"File has {stripe_count} stripes of {coder.k}+{coder.m} fragments")
+
+        def fetch(stripe, fetches):
+            ids = fragment_ids[stripe * fragment_count:(stripe + 1) * fragment_count]
+            return self.fetch_stripe(ids, fragment_locations, coder, chunk_sizes[stripe], fetches)
+
+        return self.write_pieces(output_path, offsets, fetch, coder.k, window)
+
+    def write_pieces(self, output_path, offsets, fetch, fetch_width, window=DOWNLOAD_WINDOW):
+
+        # Fetches the pieces of a file (chunks or stripes) in parallel and
+        # writes piece i at offsets[i]. fetch(i, pool) returns the piece's
+        # data or None, and may run up to fetch_width requests at once on pool.
+        window = max(1, window)
+        write_lock = threading.Lock()
+        failed = threading.Event()
+        start_time = time.time()
+
+        # Written under a temporary name and renamed once complete, so a
+        # failed download never leaves a partial file at output_path
+        part_path = f"{output_path}.part"
+        try:
+            with open(part_path, 'wb') as f, \
+                    ThreadPoolExecutor(max_workers=window * fetch_width) as fetches:
+
+                def fetch_and_write(index):
+                    if failed.is_set():
+                        return 0
+
+                    data = fetch(index, fetches)
+                    if data is None:
+                        failed.set()
+                        return 0
+
+                    with write_lock:
+                        f.seek(offsets[index])
+                        f.write(data)
+                    return len(data)
+
+                with ThreadPoolExecutor(max_workers=window) as pool:
+                    futures = [pool.submit(fetch_and_write, index) for index in range(len(offsets) - 1)]
+                    total_bytes = sum(future.result() for future in futures)
+        except BaseException:
+            remove_partial(part_path)
+            raise
+
+        if failed.is_set():
+            remove_partial(part_path)
+            return False
+        os.replace(part_path, output_path)
+
+        elapsed = time.time() - start_time
+        if elapsed > 0:
+            print(f"Downloaded {total_bytes / (1024 * 1024):.2f} MB in {elapsed:.2f}s "
+                  f"({total_bytes / elapsed / (1024 * 1024):.2f} MB/s)")
+        return True
+
+    def open_stream(self, filename, window=DOWNLOAD_WINDOW):
 
+        # For serving a file while it is fetched: returns (size, iterator over
+        # the file's data in order), or None if the file cannot be found. The
+        # size is None for files uploaded without chunk sizes.
+        download_info = self.request_download(filename)
+        if not download_info:
+            return None
+
+        return self.file_size(download_info), self.iter_file_data(download_info, window)
+
+    def file_size(self, download_info):
+
+        if download_info.get('size') is not None:
+            return download_info['size']
+        chunk_sizes = download_info.get('chunk_sizes')
+        return sum(chunk_sizes) if chunk_sizes is not None else None
+
+    def iter_file_data(self, download_info, window=DOWNLOAD_WINDOW, start=0, end=None):
+
+        # Yield the bytes start..end (end exclusive, default the whole file) in
+        # order, fetching up to `window` chunks ahead of the consumer. The
+        # range is mapped to chunks and in-chunk offsets with the recorded
+        # chunk sizes, so partial chunks at the edges are read as byte ranges.
+        # Raises IOError naming the chunk if one cannot be fetched, so a
+        # consumer never mistakes a truncated stream for the whole file.
+        chunk_ids = download_info['chunk_ids']
+        chunk_locations = download_info['chunk_locations']
+        chunk_sizes = download_info.get('chunk_sizes')
+        erasure = download_info.get('erasure')
+        window = max(1, window)
+
+        if erasure:
+            coder = ReedSolomon(erasure['k'], erasure['m'])
+            width = coder.k + coder.m
+            count = len(chunk_ids) // width
+            attempts = ThreadPoolExecutor(max_workers=window * coder.k)
+        else:
+            count = len(chunk_ids)
+            attempts = ThreadPoolExecutor(max_workers=window * REPLICATION_FACTOR)
+
+        # (chunk index, offset in chunk, length or None for the whole chunk)
+        if chunk_sizes is None:
+            pieces = ((index, 0, None) for index in range(count))
+        else:
+            offsets = list(itertools.accumulate(chunk_sizes, initial=0))
+            end = offsets[-1] if end is None else min(end, offsets[-1])
+            first = max(0, bisect.bisect_right(offsets, start) - 1)
+            last = bisect.bisect_left(offsets, end)
+            pieces = (
+                (index, max(start - offsets[index], 0),
+                 min(end, offsets[index + 1]) - max(start, offsets[index]))
+                for index in range(first, min(last, count))
+            )
+
+        def fetch_piece(index, offset, length):
+            if erasure:
+                ids = chunk_ids[index * width:(index + 1) * width]
+                data = self.fetch_stripe(ids, chunk_locations, coder, chunk_sizes[index], attempts)
+                if data is None:
+                    raise IOError(f"Failed to rebuild stripe {ids[0].rpartition('.')[0]}")
+                if length is None or (offset == 0 and length == len(data)):
+                    return data
+                return data[offset:offset + length]
+
+            size = chunk_sizes[index] if chunk_sizes else CHUNK_SIZE
+            chunk_id = chunk_ids[index]
+            data = self.fetch_chunk(chunk_id, chunk_locations.get(chunk_id, []), size, attempts, offset, length)
+            if data is None:
+                raise IOError(f"Failed to retrieve chunk {chunk_id}")
+            return data
+
+        pool = ThreadPoolExecutor(max_workers=window)
+        pending = deque(pool.submit(fetch_piece, *piece) for piece in itertools.islice(pieces, window))
         try:
-            master_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            master_socket.connect((self.master_host, self.master_port))
+            while pending:
+                data = pending.popleft().result()
+
+                piece = next(pieces, None)
+                if piece is not None:
+                    pending.append(pool.submit(fetch_piece, *piece))
+                yield data
+        finally:
+            # The consumer may stop early, e.g. when an HTTP client disconnects
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait=False)
+            attempts.shutdown(wait=False)
+
+    def fetch_chunk(self, chunk_id, locations, size, attempts, offset=0, length=None):
+
+        # A byte range of one chunk (all of it by default), from the cache or
+        # else from the replicas, best-looking first based on what earlier
+        # reads measured. Only whole chunks are cached.
+        whole = offset == 0 and (length is None or length == size)
+
+        chunk_data = self.chunk_cache.get(chunk_id)
+        if chunk_data is not None:
+            return chunk_data if whole else chunk_data[offset:offset + length]
+
+        if whole:
+            ranked = self.node_stats.rank(locations, size)
+            chunk_data = self.fetch_chunk_hedged(chunk_id, ranked, attempts)
+        else:
+            ranked = self.node_stats.rank(locations, length)
+            chunk_data = self.fetch_chunk_hedged(chunk_id, ranked, attempts, offset, length)
+        if chunk_data is None:
+            print(f"Failed to retrieve chunk {chunk_id}")
+            return None
+
+        # One copy, shared with the cache; WSGI servers also need bytes
+        chunk_data = bytes(chunk_data)
+        if whole:
+            self.chunk_cache.put(chunk_id, chunk_data)
+        return chunk_data
+
+    def fetch_stripe(self, fragment_ids, fragment_locations, coder, size, fetches):
+
+        # One erasure-coded stripe, rebuilt from any k of its fragments. Data
+        # fragments are fetched first, as they need no decoding; parity
+        # fragments are only fetched to replace missing ones. Decoded stripes
+        # are cached under the stripe ID the fragment IDs share.
+        stripe_id = fragment_ids[0].rsplit('.', 1)[0]
+        data = self.chunk_cache.get(stripe_id)
+        if data is not None:
+            return data
+
+        def fetch_fragment(fragment_id):
+            for node_host, node_port in self.node_stats.rank(fragment_locations.get(fragment_id, [])):
+                fragment = self.retrieve_chunk(node_host, node_port, fragment_id)
+                if fragment is not None:
+                    return fragment
+            return None
+
+        fragments = {}
+        candidates = list(range(len(fragment_ids)))
+        while len(fragments) < coder.k and candidates:
+            wanted = candidates[:coder.k - len(fragments)]
+            candidates = candidates[len(wanted):]
+            futures = {index: fetches.submit(fetch_fragment, fragment_ids[index]) for index in wanted}
+            for index, future in futures.items():
+                fragment = future.result()
+                if fragment is not None:
+                    fragments[index] = fragment
+
+        if len(fragments) < coder.k:
+            print(f"Failed to retrieve stripe {stripe_id}: only {len(fragments)}/{coder.k} fragments")
+            return None
+
+        data = coder.decode(fragments, size)
+        self.chunk_cache.put(stripe_id, data)
+        return data
+
+    def fetch_chunk_hedged(self, chunk_id, locations, attempts, offset=0, length=None):
+
+        # Ask the first replica; if it has not answered within HEDGE_DELAY, or it
+        # fails, also ask the next one. The first successful answer wins and
+        # slower attempts are left to finish in the background.
+        pending = {}
+        next_location = 0
+
+        while True:
+            if next_location < len(locations):
+                node_host, node_port = locations[next_location]
+                pending[attempts.submit(self.retrieve_chunk, node_host, node_port, chunk_id, offset, length)] = \
+                    next_location
+                next_location += 1
+
+            if not pending:
+                return None
+
+            timeout = HEDGE_DELAY if next_location < len(locations) else None
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                del pending[future]
+                chunk_data = future.result()
+                if chunk_data is not None:
+                    return chunk_data
+
+    def list_files(self, prefix=''):
+
+        files = self.get_file_list(prefix, details=True)
 
-            request = {'command': 'LIST_FILES'}
-            send_json(master_socket, request)
+        if files is None:
+            print("Failed to list files")
+        elif files:
+            print("Files in storage:")
+            for f in files:
+                size = f"{f['size']} bytes" if f['size'] is not None else "size unknown"
+                print(f"  - {f['filename']} ({size})")
+        else:
+            print("No files in storage")
 
-            response = recv_json(master_socket)
-            master_socket.close()
+    def stat(self, filename):
+
+        info = self.stat_file(filename, chunks=True)
+
+        if info is None:
+            print(f"Failed to stat {filename}")
+            return
+
+        print(f"File: {info['filename']}")
+        print(f"  Size: {info['size'] if info['size'] is not None else 'unknown'}")
+        for field in ('created', 'modified'):
+            if info[field] is not None:
+                print(f"  {field.capitalize()}: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(info[field]))}")
+        print(f"  SHA-256: {info['digest'] or 'unknown'}")
+        print(f"  Chunks: {info['chunks']}" + (f" (erasure-coded, k={info['erasure']['k']}, m={info['erasure']['m']})"
+                                               if info.get('erasure') else ""))
+
+    def stat_file(self, filename, chunks=False):
+
+        # The master's record of a file: size, created and modified times and
+        # SHA-256 digest (None where unknown), chunk count and, with `chunks`,
+        # chunk_sizes and chunk_offsets
+        try:
+            response = self.master_call({'command': 'STAT', 'filename': filename, 'chunks': chunks})
 
             if response and response.get('status') == 'success':
-                files = response.get('files', [])
-                if files:
-                    print("Files in storage:")
-                    for f in files:
-                        print(f"  - {f}")
-                else:
-                    print("No files in storage")
-            else:
-                print("Failed to list files")
+                return response
+            print(f"Master error: {response.get('message', 'Unknown error') if response else 'No response'}")
+            return None
+        except Exception as e:
+            print(f"Error getting file info: {e}")
+            return None
+
+    def get_file_list(self, prefix='', details=False):
+
+        # Every filename starting with prefix (or, with details, its STAT
+        # fields), fetched page by page
+        files = []
+        after = None
+        while True:
+            page = self.get_file_page(prefix, after, details=details)
+            if page is None:
+                return None
+            files.extend(page['files'])
+            after = page.get('next')
+            if after is None:
+                return files
+
+    def get_file_page(self, prefix='', after=None, limit=None, if_none_match=None, details=False):
+
+        # One LIST_FILES page: {'status', 'files', 'version', 'next' if there
+        # are more}, or {'status': 'not_modified', 'version'} when
+        # if_none_match is still the master's metadata version. With details,
+        # files are dicts of STAT fields rather than names.
+        try:
+            request = {'command': 'LIST_FILES', 'prefix': prefix}
+            if after is not None:
+                request['after'] = after
+            if limit is not None:
+                request['limit'] = limit
+            if if_none_match is not None:
+                request['if_none_match'] = if_none_match
+            if details:
+                request['details'] = True
+
+            response = self.master_call(request)
+
+            if response and response.get('status') in ('success', 'not_modified'):
+                return response
+            return None
         except Exception as e:
             print(f"Error listing files: {e}")
+            return None
 
-    def partition_file(self, filepath):
+    def get_master_status(self, timeout=None):
 
-        chunks = []
+        try:
+            response = self.master_call({'command': 'STATUS'}, timeout)
 
-        with open(filepath, 'rb') as f:
-            chunk_number = 0
-            while True:
-                chunk_data = f.read(CHUNK_SIZE)
-                if not chunk_data:
-                    break
+            if response and response.get('status') == 'success':
+                return response
+            return None
+        except Exception as e:
+            print(f"Error getting master status: {e}")
+            return None
+
+    def iter_chunks(self, stream):
 
-                chunk_id = self.generate_chunk_id(chunk_data, chunk_number)
+        for chunk_number, chunk_data in enumerate(self.iter_chunk_data(stream)):
+            chunk_id = self.generate_chunk_id(chunk_data, chunk_number)
 
-                chunks.append({
-                    'id': chunk_id,
-                    'data': chunk_data
-                })
+            yield {
+                'id': chunk_id,
+                'data': chunk_data
+            }
 
-                chunk_number += 1
+    def iter_chunk_data(self, stream):
 
-        return chunks
+        # Content-defined boundaries follow the data, so an insertion only
+        # changes the chunks around it instead of shifting every later chunk
+        if CHUNKING == 'cdc':
+            chunker = ContentDefinedChunker(CDC_MIN_SIZE, CDC_AVG_SIZE, CDC_MAX_SIZE)
+            yield from chunker.iter_chunks(stream, self.read_chunk)
+            return
+
+        while True:
+            chunk_data = self.read_chunk(stream, CHUNK_SIZE)
+            if not chunk_data:
+                break
+            yield chunk_data
+
+    def read_chunk(self, stream, size):
+
+        # Streams such as HTTP request bodies may return short reads; keep
+        # reading so chunk boundaries do not depend on how data arrives.
+        data = stream.read(size)
+        if not data or len(data) == size:
+            return data
+
+        parts = [data]
+        remaining = size - len(data)
+        while remaining > 0:
+            data = stream.read(remaining)
+            if not data:
+                break
+            parts.append(data)
+            remaining -= len(data)
+        return b''.join(parts)
 
     def generate_chunk_id(self, chunk_data, chunk_number):
 
         hash_obj = hashlib.sha256(chunk_data)
         hash_hex = hash_obj.hexdigest()
+
+        # Content-addressed IDs are the full hash, so identical chunks in any
+        # file or at any offset share one stored copy
+        if CHUNK_ID_MODE == 'content':
+            return hash_hex
         return f"chunk_{chunk_number}_{hash_hex[:16]}"
 
-    def request_upload(self, filename, chunk_ids):
+    def master_call(self, request, timeout=None):
 
-        try:
-            master_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            master_socket.connect((self.master_host, self.master_port))
+        return self.pool.call(self.master_host, self.master_port, request, timeout)
 
+    def request_chunk_allocation(self, chunk_ids, skip_existing=False, fragments=None):
+
+        # With skip_existing, returns (chunk_assignments, existing_chunk_ids)
+        # and the master only assigns chunks it does not already have. With
+        # fragments, each chunk is an erasure-coded stripe and gets that many
+        # distinct nodes, one per fragment.
+        try:
             request = {
-                'command': 'UPLOAD',
-                'filename': filename,
-                'chunk_ids': chunk_ids
+                'command': 'ALLOCATE',
+                'chunk_ids': chunk_ids,
+                'skip_existing': skip_existing
             }
+            if fragments:
+                request['fragments'] = fragments
 
-            send_json(master_socket, request)
-            response = recv_json(master_socket)
-            master_socket.close()
+            response = self.master_call(request)
 
             if response and response.get('status') == 'success':
-                return response.get('chunk_assignments', {})
+                chunk_assignments = response.get('chunk_assignments', {})
+                if skip_existing:
+                    return chunk_assignments, set(response.get('existing_chunks', []))
+                return chunk_assignments
             else:
-                print(f"Master error: {response.get('message', 'Unknown error')}")
+                print(f"Master error: {response.get('message', 'Unknown error') if response else 'No response'}")
                 return None
         except Exception as e:
-            print(f"Error requesting upload: {e}")
+            print(f"Error requesting chunk allocation: {e}")
             return None
 
-    def request_download(self, filename):
+    def commit_file(self, filename, chunk_ids, chunk_locations, chunk_sizes=None, erasure=None, digest=None):
 
         try:
-            master_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            master_socket.connect((self.master_host, self.master_port))
+            request = {
+                'command': 'COMMIT_FILE',
+                'filename': filename,
+                'chunk_ids': chunk_ids,
+                'chunk_locations': chunk_locations
+            }
+            if chunk_sizes is not None:
+                request['chunk_sizes'] = chunk_sizes
+            if erasure:
+                request['erasure'] = erasure
+            if digest:
+                request['digest'] = digest
+
+            response = self.master_call(request)
+
+            if response and response.get('status') == 'success':
+                return True
+            print(f"Master error: {response.get('message', 'Unknown error') if response else 'No response'}")
+            return False
+        except Exception as e:
+            print(f"Error committing file: {e}")
+            return False
+
+    def request_download(self, filename):
 
+        try:
             request = {
                 'command': 'DOWNLOAD',
                 'filename': filename
             }
 
-            send_json(master_socket, request)
-            response = recv_json(master_socket)
-            master_socket.close()
+            response = self.master_call(request)
 
             if response and response.get('status') == 'success':
                 return response
             else:
-                print(f"Master error: {response.get('message', 'Unknown error')}")
+                print(f"Master error: {response.get('message', 'Unknown error') if response else 'No response'}")
                 return None
         except Exception as e:
             print(f"Error requesting download: {e}")
             return None
 
     def store_chunk(self, node_host, node_port, chunk_id, chunk_data):
-        try:
-            node_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            node_socket.connect((node_host, node_port))
 
+        def store(connection):
             # Get chunk size
             chunk_size = len(chunk_data)
 
@@ -208,18 +1037,25 @@ class Client:
                 'size': chunk_size
             }
 
-            # Send metadata via JSON
-            send_json(node_socket, request_metadata)
-
-            # Send raw binary chunk data
-            node_socket.sendall(chunk_data)
+            # Send metadata via JSON, then the raw binary chunk data
+            request_id = connection.send(request_metadata)
+            if request_id is None:
+                return None
+            connection.sendall(chunk_data)
 
             # Receive response
-            response = recv_json(node_socket)
-            node_socket.close()
+            return connection.recv(request_id)
+
+        node = (node_host, node_port)
+        self.node_stats.begin(node)
+        stored = False
+        start_time = time.perf_counter()
+        try:
+            response = self.pool.run(node_host, node_port, store)
 
             if response and response.get('status') == 'success':
                 print(f"  Stored chunk {chunk_id} on {node_host}:{node_port}")
+                stored = True
                 return True
             else:
                 print(f"  Failed to store chunk {chunk_id} on {node_host}:{node_port}")
@@ -227,68 +1063,65 @@ class Client:
         except Exception as e:
             print(f"  Error storing chunk on {node_host}:{node_port}: {e}")
             return False
+        finally:
+            # Uploads only feed the error rate; their timing includes the
+            # node's disk write and says little about read latency
+            self.node_stats.end(node, stored)
 
-    def retrieve_chunk(self, node_host, node_port, chunk_id):
-        try:
-            node_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            node_socket.connect((node_host, node_port))
+    def retrieve_chunk(self, node_host, node_port, chunk_id, offset=0, length=None):
+
+        timing = {}
 
+        def retrieve(connection):
             # Send retrieve request
             request = {
                 'command': 'RETRIEVE',
                 'chunk_id': chunk_id
             }
-
-            send_json(node_socket, request)
+            if offset or length is not None:
+                request['offset'] = offset
+                request['length'] = length
 
             # Receive metadata response
-            response = recv_json(node_socket)
+            timing['start'] = time.perf_counter()
+            response = connection.call(request)
+            timing['response'] = time.perf_counter()
 
-            if response and response.get('status') == 'success':
-                # Get chunk size from response
-                chunk_size = response.get('size')
+            if not response or response.get('status') != 'success':
+                return None
 
-                if chunk_size is None:
-                    print(f"  Error: No size in response for chunk {chunk_id}")
-                    node_socket.close()
-                    return None
+            # Get chunk size from response
+            chunk_size = response.get('size')
 
-                # Receive raw binary chunk data
-                chunk_data = recv_all(node_socket, chunk_size)
+            if chunk_size is None:
+                print(f"  Error: No size in response for chunk {chunk_id}")
+                connection.close()
+                return None
 
-                node_socket.close()
+            # Receive raw binary chunk data
+            return connection.recv_all(chunk_size)
 
-                if chunk_data is None:
-                    print(f"  Failed to receive data for chunk {chunk_id} from {node_host}:{node_port}")
-                    return None
+        node = (node_host, node_port)
+        self.node_stats.begin(node)
+        chunk_data = None
+        try:
+            chunk_data = self.pool.run(node_host, node_port, retrieve)
 
-                print(f"  Retrieved chunk {chunk_id} from {node_host}:{node_port}")
-                return chunk_data
-            else:
+            if chunk_data is None:
                 print(f"  Failed to retrieve chunk {chunk_id} from {node_host}:{node_port}")
-                node_socket.close()
                 return None
+
+            print(f"  Retrieved chunk {chunk_id} from {node_host}:{node_port}")
+            return chunk_data
         except Exception as e:
             print(f"  Error retrieving chunk from {node_host}:{node_port}: {e}")
             return None
-
-    def report_chunk_storage(self, chunk_id, locations):
-
-        try:
-            master_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            master_socket.connect((self.master_host, self.master_port))
-
-            request = {
-                'command': 'REPORT_CHUNK',
-                'chunk_id': chunk_id,
-                'locations': locations
-            }
-
-            send_json(master_socket, request)
-            response = recv_json(master_socket)
-            master_socket.close()
-        except Exception as e:
-            print(f"Error reporting chunk storage: {e}")
+        finally:
+            if chunk_data is None:
+                self.node_stats.end(node, False)
+            else:
+                self.node_stats.end(node, True, timing['response'] - timing['start'], len(chunk_data),
+                                    time.perf_counter() - timing['response'])
 
     def reassemble_file(self, chunks, output_path):
 
@@ -300,9 +1133,10 @@ class Client:
 def print_usage():
 
     print("Usage:")
-    print("  python client.py upload <filepath>")
+    print("  python client.py upload <filepath> [replicate|erasure]")
     print("  python client.py download <filename> <output_path>")
-    print("  python client.py list")
+    print("  python client.py list [prefix]")
+    print("  python client.py stat <filename>")
 
 
 if __name__ == "__main__":
@@ -314,11 +1148,12 @@ if __name__ == "__main__":
     command = sys.argv[1].lower()
 
     if command == 'upload':
-        if len(sys.argv) != 3:
-            print("Usage: python client.py upload <filepath>")
+        if len(sys.argv) not in (3, 4) or (len(sys.argv) == 4 and sys.argv[3] not in ('replicate', 'erasure')):
+            print("Usage: python client.py upload <filepath> [replicate|erasure]")
             sys.exit(1)
         filepath = sys.argv[2]
-        client.upload_file(filepath)
+        storage_mode = sys.argv[3] if len(sys.argv) == 4 else STORAGE_MODE
+        client.upload_file(filepath, storage_mode=storage_mode)
 
     elif command == 'download':
         if len(sys.argv) != 4:
@@ -329,7 +1164,13 @@ if __name__ == "__main__":
         client.download_file(filename, output_path)
 
     elif command == 'list':
-        client.list_files()
+        client.list_files(sys.argv[2] if len(sys.argv) > 2 else '')
+
+    elif command == 'stat':
+        if len(sys.argv) != 3:
+            print("Usage: python client.py stat <filename>")
+            sys.exit(1)
+        client.stat(sys.argv[2])
 
     else:
         print(f"Unknown command: {command}")
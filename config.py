@@ -11,3 +11,103 @@ CHUNK_SIZE = 1024 * 1024
 REPLICATION_FACTOR = 3
 HEARTBEAT_INTERVAL = 5
 FAILURE_TIMEOUT = 15
+
+# Number of chunks the client keeps in flight while uploading
+UPLOAD_WINDOW = 8
+
+# Number of chunks the client fetches concurrently while downloading
+DOWNLOAD_WINDOW = 8
+# Seconds to wait on a replica before also asking the next one
+HEDGE_DELAY = 0.5
+
+# Idle persistent connections the client keeps per node
+POOL_MAX_IDLE = 16
+# Seconds a pooled connection waits to connect to, send to or hear from a
+# peer before giving up on it
+CONNECTION_TIMEOUT = 30
+
+# Server implementation for master and storage nodes: 'threaded' or 'asyncio'
+SERVER_MODE = 'threaded'
+# Pending-connection backlog passed to listen()
+SERVER_BACKLOG = 128
+# Connections served at once in asyncio mode; extra connections wait their turn
+MAX_CONNECTIONS = 4096
+# Threads the asyncio master runs request handlers on; a commit holds one
+# until its metadata record is on disk
+MASTER_HANDLER_THREADS = 64
+
+# Message encoding clients ask for on new connections: 'binary', 'json', or
+# 'auto' (binary when the msgpack package is installed, JSON otherwise).
+# Nodes that do not support the binary encoding fall back to JSON.
+WIRE_ENCODING = 'auto'
+
+# Directory for the master's metadata log and snapshots
+METADATA_DIR = './master_metadata'
+# Seconds between metadata snapshots
+SNAPSHOT_INTERVAL = 60
+# Seconds the log writer waits to gather more records into one fsync
+LOG_GROUP_COMMIT_DELAY = 0.002
+
+# How chunk IDs are derived: 'content' uses the full SHA-256 of the chunk so
+# identical content is stored once; 'positional' prefixes the chunk number
+CHUNK_ID_MODE = 'content'
+
+# How files are split into chunks: 'fixed' cuts every CHUNK_SIZE bytes, 'cdc'
+# cuts at content-defined boundaries so edits only change nearby chunks
+CHUNKING = 'fixed'
+# Minimum, target average and maximum chunk sizes for 'cdc' chunking
+CDC_MIN_SIZE = 256 * 1024
+CDC_AVG_SIZE = 1024 * 1024
+CDC_MAX_SIZE = 4 * 1024 * 1024
+
+# Seconds between scans for under-replicated chunks; a node failure also
+# starts a scan right away
+REPLICATION_CHECK_INTERVAL = 10
+# Chunk copies the master runs at once while restoring replicas
+REPLICATION_MAX_CONCURRENT = 4
+# Bytes per second shared by all re-replication copies (0 for no limit)
+REPLICATION_BANDWIDTH = 50 * 1024 * 1024
+
+# Storage nodes with less free disk than this only get new replicas when no
+# other node is left
+PLACEMENT_MIN_FREE = 256 * 1024 * 1024
+# Candidate nodes drawn per replica; the least loaded one gets the replica
+PLACEMENT_CHOICES = 2
+
+# Weight of the newest sample in the client's per-node latency, throughput
+# and error-rate averages
+NODE_STATS_ALPHA = 0.2
+
+# How new files are stored: 'replicate' keeps REPLICATION_FACTOR copies of
+# every chunk; 'erasure' splits each chunk into ERASURE_K data and ERASURE_M
+# parity fragments on distinct nodes, any ERASURE_K of which rebuild it
+STORAGE_MODE = 'replicate'
+ERASURE_K = 4
+ERASURE_M = 2
+
+# Client-side cache of downloaded chunks: bytes kept in memory, and an
+# optional directory (None to disable) holding up to CHUNK_CACHE_DISK_SIZE
+# bytes of chunks evicted from memory
+CHUNK_CACHE_SIZE = 256 * 1024 * 1024
+CHUNK_CACHE_DIR = None
+CHUNK_CACHE_DISK_SIZE = 2 * 1024 * 1024 * 1024
+
+# Memory each storage node uses to cache chunks read more than once (0 to
+# disable), and how many recently read chunks it remembers to spot a
+# second read
+STORAGE_CACHE_SIZE = 256 * 1024 * 1024
+STORAGE_CACHE_HISTORY = 4096
+
+# Resumable uploads: size of the parts a file is sent in (a multiple of
+# CHUNK_SIZE), and where unfinished upload sessions are kept
+UPLOAD_PART_SIZE = 16 * CHUNK_SIZE
+UPLOAD_SESSION_DIR = './upload_sessions'
+
+# Filenames per LIST_FILES page by default, and the most a client can ask for
+LIST_PAGE_SIZE = 1000
+LIST_MAX_PAGE_SIZE = 10000
+# Seconds the web frontend reuses the master's status before asking again
+WEB_STATUS_CACHE_TTL = 5
+# Seconds the web frontend waits for the master's status before reporting
+# it offline
+WEB_STATUS_TIMEOUT = 2
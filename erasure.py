@@ -0,0 +1,155 @@
+# Reed-Solomon erasure coding over GF(2^8).
+#
+# A chunk is split into k data fragments and m parity fragments; any k of
+# the k + m fragments are enough to rebuild it. The code is systematic (the
+# data fragments are the chunk itself, padded), and the parity rows of the
+# encoding matrix form a Cauchy matrix, so every k x k submatrix of the full
+# matrix is invertible.
+#
+# Multiplying a fragment by a constant is a byte-for-byte table lookup, done
+# with bytes.translate; fragments are XORed with NumPy when it is installed
+# and as big integers otherwise.
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+PRIMITIVE_POLYNOMIAL = 0x11d
+
+EXP = [0] * 512
+LOG = [0] * 256
+
+_value = 1
+for _power in range(255):
+    EXP[_power] = _value
+    LOG[_value] = _power
+    _value <<= 1
+    if _value & 0x100:
+        _value ^= PRIMITIVE_POLYNOMIAL
+for _power in range(255, 512):
+    EXP[_power] = EXP[_power - 255]
+
+
+def gf_mul(a, b):
+
+    if a == 0 or b == 0:
+        return 0
+    return EXP[LOG[a] + LOG[b]]
+
+
+def gf_inv(a):
+
+    if a == 0:
+        raise ZeroDivisionError("0 has no inverse in GF(256)")
+    return EXP[255 - LOG[a]]
+
+
+# MUL_TABLES[c] maps every byte v to c * v, for use with bytes.translate
+MUL_TABLES = [bytes(gf_mul(c, v) for v in range(256)) for c in range(256)]
+
+
+def invert_matrix(matrix):
+
+    # Gauss-Jordan elimination over GF(256)
+    size = len(matrix)
+    rows = [list(row) + [1 if i == j else 0 for j in range(size)] for i, row in enumerate(matrix)]
+
+    for column in range(size):
+        pivot = next((r for r in range(column, size) if rows[r][column]), None)
+        if pivot is None:
+            raise ValueError("Matrix is singular")
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+
+        scale = gf_inv(rows[column][column])
+        rows[column] = [gf_mul(scale, value) for value in rows[column]]
+
+        for r in range(size):
+            factor = rows[r][column]
+            if r != column and factor:
+                rows[r] = [value ^ gf_mul(factor, pivot_value)
+                           for value, pivot_value in zip(rows[r], rows[column])]
+
+    return [row[size:] for row in rows]
+
+
+class ReedSolomon:
+
+    def __init__(self, k, m):
+
+        if k < 1 or m < 0 or k + m > 256:
+            raise ValueError("Need k >= 1, m >= 0 and k + m <= 256")
+
+        self.k = k
+        self.m = m
+
+        # Row i of the k+m x k encoding matrix gives fragment i as a
+        # combination of the data fragments
+        self.matrix = [[1 if i == j else 0 for j in range(k)] for i in range(k)]
+        for i in range(m):
+            self.matrix.append([gf_inv((k + i) ^ j) for j in range(k)])
+
+    def fragment_size(self, length):
+
+        return max(1, -(-length // self.k))
+
+    def encode(self, data):
+
+        # Returns k + m fragments of equal size; decode() needs the original
+        # length to strip the padding again
+        size = self.fragment_size(len(data))
+        padded = bytes(data) + bytes(size * self.k - len(data))
+        fragments = [padded[i * size:(i + 1) * size] for i in range(self.k)]
+
+        for row in self.matrix[self.k:]:
+            fragments.append(combine(row, fragments))
+        return fragments
+
+    def decode(self, fragments, length):
+
+        # fragments: {index: bytes} with at least k entries
+        if all(i in fragments for i in range(self.k)):
+            return b''.join(fragments[i] for i in range(self.k))[:length]
+
+        indexes = sorted(fragments)[:self.k]
+        if len(indexes) < self.k:
+            raise ValueError(f"Need {self.k} fragments, have {len(fragments)}")
+
+        inverse = invert_matrix([self.matrix[i] for i in indexes])
+        available = [fragments[i] for i in indexes]
+
+        data = []
+        for i in range(self.k):
+            if i in fragments:
+                data.append(fragments[i])
+            else:
+                data.append(combine(inverse[i], available))
+        return b''.join(data)[:length]
+
+
+def combine(coefficients, fragments):
+
+    # XOR of coefficient * fragment over all fragments, which must have the
+    # same size
+    products = []
+    for coefficient, fragment in zip(coefficients, fragments):
+        if coefficient == 1:
+            products.append(fragment)
+        elif coefficient:
+            products.append(fragment.translate(MUL_TABLES[coefficient]))
+
+    size = len(fragments[0])
+    if not products:
+        return bytes(size)
+
+    if np is not None:
+        result = np.frombuffer(products[0], dtype=np.uint8).copy()
+        for product in products[1:]:
+            np.bitwise_xor(result, np.frombuffer(product, dtype=np.uint8), out=result)
+        return result.tobytes()
+
+    result = int.from_bytes(products[0], 'little')
+    for product in products[1:]:
+        result ^= int.from_bytes(product, 'little')
+    return result.to_bytes(size, 'little')
@@ -1,27 +1,334 @@
+import asyncio
+import bisect
+import itertools
+import os
+import random
 import socket
+import sys
 import threading
 import time
+from array import array
 from collections import defaultdict
-from utils import send_json, recv_json
-from config import MASTER_HOST, MASTER_PORT, REPLICATION_FACTOR, FAILURE_TIMEOUT
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from metadata_log import MetadataLog
+from chunk_table import ChunkLocationTable, unpack_chunk_id
+from utils import recv_json, reply, read_json, reply_async, negotiate_encoding, ConnectionPool, ENCODING_JSON
+from config import MASTER_HOST, MASTER_PORT, REPLICATION_FACTOR, FAILURE_TIMEOUT, \
+    SERVER_MODE, SERVER_BACKLOG, MAX_CONNECTIONS, METADATA_DIR, SNAPSHOT_INTERVAL, LOG_GROUP_COMMIT_DELAY, \
+    POOL_MAX_IDLE, WIRE_ENCODING, REPLICATION_CHECK_INTERVAL, REPLICATION_MAX_CONCURRENT, REPLICATION_BANDWIDTH, \
+    PLACEMENT_MIN_FREE, PLACEMENT_CHOICES, LIST_PAGE_SIZE, LIST_MAX_PAGE_SIZE, MASTER_HANDLER_THREADS
 
 
 class MasterNode:
-    def __init__(self, host, port):
+    def __init__(self, host, port, server_mode=SERVER_MODE, metadata_dir=METADATA_DIR):
 
         self.host = host
         self.port = port
+        self.server_mode = server_mode
         self.running = True
 
         self.file_metadata = {}  # filename -> [chunk_ids]
-        self.chunk_locations = defaultdict(list)  # chunk_id -> [(host, port)]
-        self.storage_nodes = {}  # node_id -> {'host': x, 'port': y, 'last_heartbeat': time}
+        self.file_chunk_sizes = {}  # filename -> array('I') of chunk sizes, when the client sent them
+        self.file_info = {}  # filename -> (size, created, modified, digest bytes or None)
+        self.file_erasure = {}  # filename -> {'k': k, 'm': m} for erasure-coded files
+        self.chunk_locations = ChunkLocationTable()  # chunk_id -> [(host, port)]
+        self.chunk_refs = {}  # chunk_id -> number of file references
+        self.chunk_targets = {}  # chunk_id -> wanted replicas, if not REPLICATION_FACTOR
+
+        # Filenames in sorted order for paginated listings, and a version that
+        # changes whenever a file is committed. Clients use the version as an
+        # etag; the random epoch keeps versions from before a restart apart.
+        self.sorted_files = []
+        self.files_version = 0
+        self.metadata_epoch = os.urandom(4).hex()
+
+        # Under-replicated chunks by number of missing replicas, kept in step
+        # by set_chunk_locations(), so replication checks only touch these and
+        # the chunks of failed nodes (which chunk_locations indexes per node)
+        self.replica_buckets = defaultdict(set)  # missing replicas -> {chunk_id}
+        self.storage_nodes = {}  # node_id -> {'host': x, 'port': y, 'last_heartbeat': time, load stats...}
 
         self.metadata_lock = threading.Lock()
         self.nodes_lock = threading.Lock()
 
+        # Cached set of live node IDs, rebuilt when a node joins, fails or its
+        # heartbeat could have expired (see get_alive_node_set)
+        self.alive_nodes_cache = None
+        self.alive_nodes_expires = 0.0
+
+        # Lost replicas are restored by copying chunks between storage nodes.
+        # A node failure wakes the scheduler instead of waiting for the next scan.
+        self.node_pool = ConnectionPool(max_idle=POOL_MAX_IDLE, encoding=WIRE_ENCODING)
+        self.replication_wakeup = threading.Event()
+        self.max_concurrent_replications = REPLICATION_MAX_CONCURRENT
+        self.replication_bandwidth = REPLICATION_BANDWIDTH
+        self.placement_choices = PLACEMENT_CHOICES
+        # Lost erasure fragments already reported; they cannot be copied, so
+        # they are left out of later rounds until they are live again
+        self.reported_fragments = set()
+
+        # File and chunk metadata survive restarts through an operation log
+        # and snapshots; node liveness is rebuilt from heartbeats
+        self.metadata_log = None
+        self.snapshot_seq = 0
+        if metadata_dir:
+            self.metadata_log = MetadataLog(metadata_dir, LOG_GROUP_COMMIT_DELAY)
+            self.load_metadata()
+            self.metadata_log.start()
+
         print(f"Master Node initialized at {host}:{port}")
 
+    def load_metadata(self):
+
+        start_time = time.time()
+        state, records = self.metadata_log.load()
+
+        if state:
+            self.file_metadata = state['file_metadata']
+            if 'chunk_table' in state:
+                self.chunk_locations.load(state['chunk_table'])
+            else:
+                # Snapshots from before the compact table
+                for chunk_id, locations in state['chunk_locations'].items():
+                    self.chunk_locations[chunk_id] = locations
+            self.file_chunk_sizes = {
+                filename: array('I', chunk_sizes) for filename, chunk_sizes in state.get('file_chunk_sizes', {}).items()
+            }
+            self.file_info = {
+                filename: (size, created, modified, bytes.fromhex(digest) if digest else None)
+                for filename, (size, created, modified, digest) in state.get('file_info', {}).items()
+            }
+            self.file_erasure = state.get('file_erasure', {})
+            # Snapshots from before file_info only know the size
+            for filename in self.file_metadata:
+                if filename not in self.file_info:
+                    chunk_sizes = self.file_chunk_sizes.get(filename)
+                    self.file_info[filename] = (sum(chunk_sizes) if chunk_sizes is not None else None,
+                                                None, None, None)
+            for filename in self.file_erasure:
+                for chunk_id in self.file_metadata.get(filename, []):
+                    self.chunk_targets[chunk_id] = 1
+            for chunk_id, replicas in self.chunk_locations.replica_counts():
+                self.index_chunk(chunk_id, replicas)
+
+        self.sorted_files = sorted(self.file_metadata)
+
+        # Reference counts are derived from the file table, not persisted
+        for chunk_ids in self.file_metadata.values():
+            self.add_chunk_refs(chunk_ids, 1)
+
+        for record in records:
+            self.apply_record(record)
+
+        self.snapshot_seq = self.metadata_log.snapshot_seq
+        print(f"Loaded metadata for {len(self.file_metadata)} files and {len(self.chunk_locations)} chunks "
+              f"({len(records)} log records replayed in {time.time() - start_time:.2f}s)")
+
+    def apply_record(self, record):
+
+        # Apply one metadata operation. Used both for live requests and when
+        # replaying the log, so it must not depend on anything but the record.
+        # Returns the chunk IDs whose locations changed.
+        op = record['op']
+
+        if op == 'commit':
+            # Each fragment of an erasure-coded file is stored once
+            if record.get('erasure'):
+                for chunk_id in record['chunk_ids']:
+                    self.set_replica_target(chunk_id, 1)
+
+            for chunk_id, locations in record['chunk_locations'].items():
+                if locations:
+                    self.set_chunk_locations(chunk_id, locations)
+
+            # Overwriting a file releases its old chunks
+            old_chunk_ids = self.file_metadata.get(record['filename'])
+            self.add_chunk_refs(record['chunk_ids'], 1)
+            if old_chunk_ids:
+                self.add_chunk_refs(old_chunk_ids, -1)
+
+            if old_chunk_ids is None:
+                bisect.insort(self.sorted_files, record['filename'])
+            self.files_version += 1
+
+            self.file_metadata[record['filename']] = record['chunk_ids']
+            size = None
+            if record.get('chunk_sizes') is not None:
+                chunk_sizes = array('I', record['chunk_sizes'])
+                self.file_chunk_sizes[record['filename']] = chunk_sizes
+                size = sum(chunk_sizes)
+            else:
+                self.file_chunk_sizes.pop(record['filename'], None)
+
+            # Overwriting a file keeps its creation time
+            modified = record.get('time')
+            old_info = self.file_info.get(record['filename'])
+            created = old_info[1] if old_info and old_chunk_ids is not None else modified
+            digest = bytes.fromhex(record['digest']) if record.get('digest') else None
+            self.file_info[record['filename']] = (size, created, modified, digest)
+
+            if record.get('erasure'):
+                self.file_erasure[record['filename']] = record['erasure']
+            else:
+                self.file_erasure.pop(record['filename'], None)
+            return list(record['chunk_locations'])
+
+        if op == 'report':
+            self.set_chunk_locations(record['chunk_id'], record['locations'])
+            return [record['chunk_id']]
+
+        if op == 'add_location':
+            chunk_id = record['chunk_id']
+            locations = self.chunk_locations.get(chunk_id)
+            location = record['location']
+            if locations is None or any(loc[0] == location[0] and loc[1] == location[1] for loc in locations):
+                return []
+            self.set_chunk_locations(chunk_id, locations + [location])
+            return [chunk_id]
+
+        if op == 'drop_nodes':
+            changes = self.chunk_locations.drop_nodes(set(record['node_ids']))
+            for chunk_id, old_replicas, new_replicas in changes:
+                self.unindex_chunk(chunk_id, old_replicas)
+                self.index_chunk(chunk_id, new_replicas)
+            return [chunk_id for chunk_id, _, _ in changes]
+
+        raise ValueError(f"Unknown metadata operation {op}")
+
+    def add_chunk_refs(self, chunk_ids, delta):
+
+        for chunk_id in chunk_ids:
+            refs = self.chunk_refs.get(chunk_id, 0) + delta
+            if refs > 0:
+                self.chunk_refs[chunk_id] = refs
+            else:
+                # Unreferenced chunks are forgotten; their data stays on the
+                # storage nodes, as there is no delete command yet
+                self.chunk_refs.pop(chunk_id, None)
+                self.set_chunk_locations(chunk_id, None)
+                self.chunk_targets.pop(chunk_id, None)
+
+    def replica_target(self, chunk_id):
+
+        return self.chunk_targets.get(chunk_id, REPLICATION_FACTOR)
+
+    def set_replica_target(self, chunk_id, target):
+
+        # The replica buckets are keyed by missing replicas, so an indexed
+        # chunk is re-indexed under its new target
+        if self.replica_target(chunk_id) == target:
+            return
+        indexed = chunk_id in self.chunk_locations
+        if indexed:
+            replicas = self.chunk_locations.replica_count(chunk_id)
+            self.unindex_chunk(chunk_id, replicas)
+        self.chunk_targets[chunk_id] = target
+        if indexed:
+            self.index_chunk(chunk_id, replicas)
+
+    def set_chunk_locations(self, chunk_id, locations):
+
+        # Replace a chunk's locations, or forget the chunk if locations is
+        # None, updating the replica-count index (the table keeps its own
+        # per-node index)
+        if chunk_id in self.chunk_locations:
+            self.unindex_chunk(chunk_id, self.chunk_locations.replica_count(chunk_id))
+
+        if locations is None:
+            self.chunk_locations.pop(chunk_id, None)
+            return
+
+        self.chunk_locations[chunk_id] = locations
+        self.index_chunk(chunk_id, self.chunk_locations.replica_count(chunk_id))
+
+    def index_chunk(self, chunk_id, replicas):
+
+        missing = self.replica_target(chunk_id) - replicas
+        if missing > 0:
+            self.replica_buckets[missing].add(chunk_id)
+
+    def unindex_chunk(self, chunk_id, replicas):
+
+        missing = self.replica_target(chunk_id) - replicas
+        bucket = self.replica_buckets.get(missing)
+        if bucket is not None:
+            bucket.discard(chunk_id)
+            if not bucket:
+                del self.replica_buckets[missing]
+
+    def log_record(self, record):
+
+        # Caller holds metadata_lock and has already applied the record.
+        # Returns a sequence number to pass to sync() once the lock is released.
+        if self.metadata_log is None:
+            return 0
+        return self.metadata_log.append(record)
+
+    def sync(self, seq):
+
+        # Wait until a logged record is durable. Waiting outside metadata_lock
+        # lets concurrent requests share one fsync.
+        if self.metadata_log is None or not seq:
+            return True
+        return self.metadata_log.wait(seq)
+
+    def log_failed(self):
+
+        # Once a log write has failed nothing more reaches disk, so callers
+        # must refuse changes rather than apply them only in memory
+        return self.metadata_log is not None and self.metadata_log.failed
+
+    def take_snapshot(self):
+
+        if self.metadata_log is None or self.metadata_log.failed:
+            return
+
+        with self.metadata_lock:
+            if self.metadata_log.last_seq == self.snapshot_seq:
+                return
+            seq = self.metadata_log.start_snapshot()
+            # Stored lists are replaced, never mutated, so shallow copies are
+            # a consistent view
+            state = {
+                'file_metadata': dict(self.file_metadata),
+                'file_erasure': dict(self.file_erasure)
+            }
+            chunk_table = self.chunk_locations.dump()
+            chunk_sizes = dict(self.file_chunk_sizes)
+            file_info = dict(self.file_info)
+
+        # Packed chunk IDs, arrays and digests are converted outside the lock;
+        # arrays and file info tuples are replaced on commit, never mutated
+        state['chunk_table'] = {
+            'nodes': chunk_table['nodes'],
+            'masks': {unpack_chunk_id(key): mask for key, mask in chunk_table['masks'].items()}
+        }
+        state['file_chunk_sizes'] = {filename: list(sizes) for filename, sizes in chunk_sizes.items()}
+        state['file_info'] = {
+            filename: [size, created, modified, digest.hex() if digest else None]
+            for filename, (size, created, modified, digest) in file_info.items()
+        }
+
+        # Every record up to seq must be on disk first, or the snapshot would
+        # persist changes whose clients were told they failed
+        if not self.metadata_log.wait(seq):
+            print(f"Skipping metadata snapshot at seq {seq}: metadata log has failed")
+            return
+
+        start_time = time.time()
+        self.metadata_log.write_snapshot(state, seq)
+        self.snapshot_seq = seq
+        print(f"Metadata snapshot at seq {seq} written in {time.time() - start_time:.2f}s")
+
+    def snapshot_metadata(self):
+
+        while self.running:
+            time.sleep(SNAPSHOT_INTERVAL)
+            try:
+                self.take_snapshot()
+            except Exception as e:
+                print(f"Error writing metadata snapshot: {e}")
+
     def start(self):
         monitor_thread = threading.Thread(target=self.monitor_node_health)
         monitor_thread.daemon = True
@@ -31,10 +338,23 @@ class MasterNode:
         replication_thread.daemon = True
         replication_thread.start()
 
+        snapshot_thread = threading.Thread(target=self.snapshot_metadata)
+        snapshot_thread.daemon = True
+        snapshot_thread.start()
+
+        if self.server_mode == 'asyncio':
+            try:
+                asyncio.run(self.serve_async())
+            except KeyboardInterrupt:
+                print("\nShutting down Master Node...")
+            finally:
+                self.take_snapshot()
+            return
+
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         server_socket.bind((self.host, self.port))
-        server_socket.listen(10)
+        server_socket.listen(SERVER_BACKLOG)
 
         print(f"Master Node listening on {self.host}:{self.port}")
 
@@ -56,35 +376,117 @@ class MasterNode:
             print("\nShutting down Master Node...")
         finally:
             server_socket.close()
+            self.take_snapshot()
 
     def handle_client(self, client_socket):
 
+        # Connections are persistent: keep serving requests, in order, until the
+        # client closes its end.
+        encoding = ENCODING_JSON
         try:
-            request = recv_json(client_socket)
-            if not request:
-                return
+            while self.running:
+                request = recv_json(client_socket)
+                if not request:
+                    return
 
-            command = request.get('command')
-
-            if command == 'HEARTBEAT':
-                self.handle_heartbeat(client_socket, request)
-            elif command == 'UPLOAD':
-                self.handle_upload_request(client_socket, request)
-            elif command == 'DOWNLOAD':
-                self.handle_download_request(client_socket, request)
-            elif command == 'LIST_FILES':
-                self.handle_list_files(client_socket)
-            elif command == 'REPORT_CHUNK':
-                self.handle_chunk_report(client_socket, request)
-            else:
-                response = {'status': 'error', 'message': 'Unknown command'}
-                send_json(client_socket, response)
+                if request.get('command') == 'HELLO':
+                    # Answer in the old encoding, then switch the connection
+                    new_encoding, response = negotiate_encoding(request)
+                    if not reply(client_socket, request, response, encoding):
+                        return
+                    encoding = new_encoding
+                    continue
+
+                response = self.dispatch(request)
+                if not reply(client_socket, request, response, encoding):
+                    return
         except Exception as e:
             print(f"Error handling client: {e}")
         finally:
             client_socket.close()
 
-    def handle_heartbeat(self, client_socket, request):
+    async def serve_async(self):
+
+        # One event loop serves every connection instead of a thread each;
+        # the semaphore caps how many are served at once.
+        connection_slots = asyncio.Semaphore(MAX_CONNECTIONS)
+        self.handler_pool = ThreadPoolExecutor(max_workers=MASTER_HANDLER_THREADS)
+
+        async def handle(reader, writer):
+            async with connection_slots:
+                await self.handle_client_async(reader, writer)
+
+        server = await asyncio.start_server(
+            handle, self.host, self.port, backlog=SERVER_BACKLOG, reuse_address=True
+        )
+
+        print(f"Master Node listening on {self.host}:{self.port} (asyncio)")
+
+        async with server:
+            await server.serve_forever()
+
+    async def handle_client_async(self, reader, writer):
+
+        encoding = ENCODING_JSON
+        try:
+            while self.running:
+                request = await read_json(reader)
+                if not request:
+                    return
+
+                if request.get('command') == 'HELLO':
+                    new_encoding, response = negotiate_encoding(request)
+                    if not await reply_async(writer, request, response, encoding):
+                        return
+                    encoding = new_encoding
+                    continue
+
+                # Heartbeats only update node state under a short lock and run
+                # on the event loop. Other handlers can wait on metadata_lock or
+                # for the metadata log to reach disk, so they run on the handler
+                # threads, where concurrent commits share one fsync as in
+                # threaded mode.
+                if request.get('command') == 'HEARTBEAT':
+                    response = self.dispatch(request)
+                else:
+                    response = await asyncio.get_running_loop().run_in_executor(
+                        self.handler_pool, self.dispatch, request
+                    )
+                if not await reply_async(writer, request, response, encoding):
+                    return
+        except Exception as e:
+            print(f"Error handling client: {e}")
+        finally:
+            writer.close()
+
+    def dispatch(self, request):
+
+        command = request.get('command')
+
+        if command == 'HEARTBEAT':
+            return self.handle_heartbeat(request)
+        elif command == 'UPLOAD':
+            return self.handle_upload_request(request)
+        elif command == 'DOWNLOAD':
+            return self.handle_download_request(request)
+        elif command == 'LIST_FILES':
+            return self.handle_list_files(request)
+        elif command == 'STAT':
+            return self.handle_stat(request)
+        elif command == 'STATUS':
+            return self.handle_status(request)
+        elif command == 'REPORT_CHUNK':
+            return self.handle_chunk_report(request)
+        elif command == 'ALLOCATE':
+            return self.handle_allocate_request(request)
+        elif command == 'COMMIT_FILE':
+            return self.handle_commit_file(request)
+        elif command == 'HAS_CHUNKS':
+            return self.handle_has_chunks(request)
+        else:
+            return {'status': 'error', 'message': 'Unknown command'}
+
+    def handle_heartbeat(self, request):
 
         node_id = request.get('node_id')
         host = request.get('host')
@@ -94,107 +496,387 @@ class MasterNode:
             self.storage_nodes[node_id] = {
                 'host': host,
                 'port': port,
-                'last_heartbeat': time.time()
+                'last_heartbeat': time.time(),
+                'disk_total': request.get('disk_total'),
+                'disk_free': request.get('disk_free'),
+                'chunk_count': request.get('chunk_count', 0),
+                'active_connections': request.get('active_connections', 0),
+                'active_transfers': request.get('active_transfers', 0),
+                # Replicas placed on the node since this heartbeat, which
+                # its reported figures do not include yet
+                'assigned': 0
             }
 
+            # A heartbeat from a live node only pushes its expiry later, which
+            # the cache can ignore; a new or returning node changes the set
+            if self.alive_nodes_cache is not None and node_id not in self.alive_nodes_cache:
+                self.alive_nodes_cache = None
+
         response = {'status': 'success', 'message': 'Heartbeat received'}
-        send_json(client_socket, response)
+        return response
 
-    def handle_upload_request(self, client_socket, request):
+    def handle_upload_request(self, request):
 
-        try:
-            filename = request.get('filename')
-            chunk_ids = request.get('chunk_ids')
+        # UPLOAD used to publish the file before any chunk existed. Files now
+        # only appear on COMMIT_FILE, so an UPLOAD caller that went on to
+        # STORE and REPORT_CHUNK would never see its file; refuse it instead.
+        response = {
+            'status': 'error',
+            'message': 'UPLOAD is no longer supported; use ALLOCATE, then COMMIT_FILE once the chunks are stored'
+        }
+        return response
 
-            if not filename or not chunk_ids:
-                response = {'status': 'error', 'message': 'Missing filename or chunk_ids'}
-                send_json(client_socket, response)
-                return
+    def handle_allocate_request(self, request):
 
-            alive_nodes = self.get_alive_nodes()
+        try:
+            chunk_ids = request.get('chunk_ids')
 
-            if len(alive_nodes) < REPLICATION_FACTOR:
+            if not chunk_ids:
+                response = {'status': 'error', 'message': 'Missing chunk_ids'}
+                return response
+
+            # With fragments, every chunk is an erasure-coded stripe whose
+            # fragments <chunk_id>.<i> each go to a different node
+            fragments = request.get('fragments')
+
+            # With skip_existing, chunks that are already stored are reported
+            # back instead of being assigned again
+            existing_chunks = []
+            if request.get('skip_existing'):
+                if fragments:
+                    existing_chunks = self.find_existing_stripes(chunk_ids, fragments)
+                else:
+                    existing_chunks = self.find_existing_chunks(chunk_ids)
+                existing = set(existing_chunks)
+                chunk_ids = [chunk_id for chunk_id in chunk_ids if chunk_id not in existing]
+
+            replicas = fragments or REPLICATION_FACTOR
+            chunk_assignments, error = self.assign_chunks(chunk_ids, replicas) if chunk_ids else ({}, None)
+
+            if chunk_assignments is None:
+                response = {'status': 'error', 'message': error}
+            else:
                 response = {
-                    'status': 'error',
-                    'message': f'Not enough storage nodes. Need {REPLICATION_FACTOR}, have {len(alive_nodes)}'
+                    'status': 'success',
+                    'chunk_assignments': chunk_assignments,
+                    'existing_chunks': existing_chunks
                 }
-                send_json(client_socket, response)
-                return
+            return response
+        except Exception as e:
+            print(f"Error handling allocate request: {e}")
+            response = {'status': 'error', 'message': str(e)}
+            return response
 
-            chunk_assignments = {}
-            for chunk_id in chunk_ids:
+    def handle_has_chunks(self, request):
 
-                selected_nodes = self.select_nodes_for_chunk(alive_nodes, REPLICATION_FACTOR)
-                chunk_assignments[chunk_id] = selected_nodes
+        chunk_ids = request.get('chunk_ids')
 
-            with self.metadata_lock:
-                self.file_metadata[filename] = chunk_ids
+        if chunk_ids is None:
+            response = {'status': 'error', 'message': 'Missing chunk_ids'}
+            return response
 
-            response = {
-                'status': 'success',
-                'chunk_assignments': chunk_assignments
-            }
-            send_json(client_socket, response)
+        response = {
+            'status': 'success',
+            'existing_chunks': self.find_existing_chunks(chunk_ids)
+        }
+        return response
+
+    def handle_commit_file(self, request):
+
+        try:
+            filename = request.get('filename')
+            chunk_ids = request.get('chunk_ids')
+            chunk_locations = request.get('chunk_locations') or {}  # chunk_id -> [(host, port), ...]
+            chunk_sizes = request.get('chunk_sizes')
+            erasure = request.get('erasure')  # {'k': k, 'm': m}; chunk_ids are then fragments
+            digest = request.get('digest')  # SHA-256 of the whole file, hex
+
+            if not filename or chunk_ids is None:
+                response = {'status': 'error', 'message': 'Missing filename or chunk_ids'}
+                return response
 
-            print(f"Upload request for {filename} with {len(chunk_ids)} chunks")
+            # The record is applied before it is logged, so anything that
+            # could fail part-way through apply_record is rejected up front
+            error = self.check_commit_request(filename, chunk_ids, chunk_locations, chunk_sizes, erasure, digest)
+            if error:
+                response = {'status': 'error', 'message': error}
+                return response
+
+            # Record every chunk location and publish the file under a single
+            # lock acquisition, so readers never see a partially stored file.
+            with self.metadata_lock:
+                missing = [
+                    chunk_id for chunk_id in chunk_ids
+                    if not chunk_locations.get(chunk_id) and not self.chunk_locations.get(chunk_id)
+                ]
+                if missing:
+                    response = {
+                        'status': 'error',
+                        'message': f'{len(missing)} chunks have no stored replicas, e.g. {missing[0]}'
+                    }
+                    return response
+
+                record = {
+                    'op': 'commit',
+                    'filename': filename,
+                    'chunk_ids': chunk_ids,
+                    'chunk_locations': chunk_locations
+                }
+                if chunk_sizes is not None:
+                    record['chunk_sizes'] = chunk_sizes
+                if erasure:
+                    record['erasure'] = {'k': erasure['k'], 'm': erasure['m']}
+                if digest:
+                    record['digest'] = digest
+                # The commit time goes in the record so replaying it gives the
+                # same modification time
+                record['time'] = time.time()
+                if self.log_failed():
+                    response = {'status': 'error', 'message': 'Metadata log has failed; refusing changes'}
+                    return response
+                self.apply_record(record)
+                seq = self.log_record(record)
+
+            if not self.sync(seq):
+                response = {'status': 'error', 'message': 'Failed to persist metadata'}
+                return response
+
+            response = {'status': 'success', 'message': f'File {filename} committed'}
+
+            print(f"Committed {filename} with {len(chunk_ids)} chunks")
+            return response
         except Exception as e:
-            print(f"Error handling upload request: {e}")
+            print(f"Error handling commit: {e}")
             response = {'status': 'error', 'message': str(e)}
-            send_json(client_socket, response)
-
-    def handle_download_request(self, client_socket, request):
+            return response
+
+    def check_commit_request(self, filename, chunk_ids, chunk_locations, chunk_sizes, erasure, digest):
+
+        # Returns an error message, or None if the commit is well formed
+        if not isinstance(filename, str):
+            return 'filename must be a string'
+
+        if not isinstance(chunk_ids, list) or not all(isinstance(c, str) and c for c in chunk_ids):
+            return 'chunk_ids must be a list of chunk IDs'
+
+        if not isinstance(chunk_locations, dict):
+            return 'chunk_locations must map chunk IDs to locations'
+        for chunk_id, locations in chunk_locations.items():
+            if not self.valid_locations(locations):
+                return f'Locations of chunk {chunk_id} must be a list of [host, port]'
+
+        # Locations of chunks the file does not reference would never be
+        # released, as nothing holds a reference to them
+        unreferenced = set(chunk_locations).difference(chunk_ids)
+        if unreferenced:
+            return f'chunk_locations names {len(unreferenced)} chunks not in chunk_ids, e.g. {min(unreferenced)}'
+
+        if erasure and not (
+                isinstance(erasure, dict) and all(
+                    isinstance(erasure.get(key), int) and not isinstance(erasure.get(key), bool)
+                    for key in ('k', 'm'))
+                and erasure['k'] >= 1 and erasure['m'] >= 0):
+            return 'erasure must be {"k": k, "m": m}'
+
+        # Sizes are per chunk, or per stripe of k + m fragments
+        stripe_width = erasure['k'] + erasure['m'] if erasure else 1
+        if len(chunk_ids) % stripe_width:
+            return 'chunk_ids is not a whole number of stripes'
+
+        if chunk_sizes is not None:
+            if not isinstance(chunk_sizes, list) or not all(
+                    isinstance(size, int) and not isinstance(size, bool) and 0 <= size < 2 ** 32
+                    for size in chunk_sizes):
+                return 'chunk_sizes must be a list of sizes'
+            if len(chunk_sizes) != len(chunk_ids) // stripe_width:
+                return 'chunk_sizes does not match chunk_ids'
+
+        if erasure and chunk_sizes is None:
+            return 'Erasure-coded files need chunk_sizes'
+
+        if digest:
+            if not isinstance(digest, str) or len(digest) != 64:
+                return 'digest must be a SHA-256 hex digest'
+            try:
+                bytes.fromhex(digest)
+            except ValueError:
+                return 'digest must be a SHA-256 hex digest'
+        return None
+
+    def valid_locations(self, locations):
+
+        return isinstance(locations, list) and all(
+            isinstance(loc, (list, tuple)) and len(loc) == 2 and isinstance(loc[0], str)
+            and isinstance(loc[1], int) and not isinstance(loc[1], bool)
+            for loc in locations
+        )
+
+    def handle_download_request(self, request):
 
         try:
             filename = request.get('filename')
 
             if not filename:
                 response = {'status': 'error', 'message': 'Missing filename'}
-                send_json(client_socket, response)
-                return
+                return response
 
             with self.metadata_lock:
                 if filename not in self.file_metadata:
                     response = {'status': 'error', 'message': f'File {filename} not found'}
-                    send_json(client_socket, response)
-                    return
+                    return response
 
                 chunk_ids = self.file_metadata[filename]
+                chunk_sizes = self.file_chunk_sizes.get(filename)
+                erasure = self.file_erasure.get(filename)
+                info = self.file_info.get(filename)
+
+            alive_mask = self.chunk_locations.node_mask(self.get_alive_node_set())
 
             chunk_locations = {}
             for chunk_id in chunk_ids:
-                locations = self.chunk_locations.get(chunk_id, [])
-
-                alive_locations = [
-                    loc for loc in locations
-                    if f"{loc[0]}:{loc[1]}" in self.get_alive_nodes()
-                ]
-                chunk_locations[chunk_id] = alive_locations
+                chunk_locations[chunk_id] = self.chunk_locations.live_locations(chunk_id, alive_mask, [])
 
             response = {
                 'status': 'success',
                 'chunk_ids': chunk_ids,
                 'chunk_locations': chunk_locations
             }
-            send_json(client_socket, response)
+            if chunk_sizes is not None:
+                response['chunk_sizes'] = list(chunk_sizes)
+            if erasure:
+                response['erasure'] = erasure
+            if info is not None:
+                response.update(self.describe_file(filename, info))
 
             print(f"Download request for {filename}")
+            return response
         except Exception as e:
             print(f"Error handling download request: {e}")
             response = {'status': 'error', 'message': str(e)}
-            send_json(client_socket, response)
+            return response
+
+    def describe_file(self, filename, info):
+
+        size, created, modified, digest = info
+        return {
+            'filename': filename,
+            'size': size,
+            'created': created,
+            'modified': modified,
+            'digest': digest.hex() if digest else None
+        }
+
+    def handle_stat(self, request):
+
+        # A file's size, times and digest without its chunk list. With
+        # 'chunks', also the size and byte offset of every chunk (of every
+        # stripe, for erasure-coded files), e.g. to plan range reads.
+        try:
+            filename = request.get('filename')
+
+            if not filename:
+                response = {'status': 'error', 'message': 'Missing filename'}
+                return response
+
+            if not isinstance(filename, str):
+                response = {'status': 'error', 'message': 'filename must be a string'}
+                return response
+
+            with self.metadata_lock:
+                if filename not in self.file_metadata:
+                    response = {'status': 'error', 'message': f'File {filename} not found'}
+                    return response
+
+                info = self.file_info.get(filename, (None, None, None, None))
+                chunk_sizes = self.file_chunk_sizes.get(filename)
+                chunk_count = len(self.file_metadata[filename])
+                erasure = self.file_erasure.get(filename)
+
+            response = {'status': 'success'}
+            response.update(self.describe_file(filename, info))
+            response['chunks'] = len(chunk_sizes) if chunk_sizes is not None else chunk_count
+            if erasure:
+                response['erasure'] = erasure
+            if request.get('chunks') and chunk_sizes is not None:
+                response['chunk_sizes'] = list(chunk_sizes)
+                response['chunk_offsets'] = list(itertools.accumulate(chunk_sizes, initial=0))[:-1]
+            return response
+        except Exception as e:
+            print(f"Error handling stat request: {e}")
+            response = {'status': 'error', 'message': str(e)}
+            return response
+
+    def metadata_version(self):
+
+        return f"{self.metadata_epoch}-{self.files_version}"
 
-    def handle_list_files(self, client_socket):
+    def handle_list_files(self, request):
+
+        # One page of filenames in sorted order: those starting with `prefix`,
+        # after the `after` cursor (the last name of the previous page). If
+        # `if_none_match` is the current version nothing has changed since
+        # the client's last listing, and no names are sent. With 'details',
+        # each entry is the file's STAT fields instead of just its name.
+        prefix = request.get('prefix') or ''
+        after = request.get('after')
+        limit = request.get('limit') or LIST_PAGE_SIZE
+
+        if not isinstance(prefix, str) or (after is not None and not isinstance(after, str)):
+            response = {'status': 'error', 'message': 'prefix and after must be strings'}
+            return response
+
+        if not isinstance(limit, int) or isinstance(limit, bool):
+            response = {'status': 'error', 'message': 'limit must be an integer'}
+            return response
+        limit = min(max(1, limit), LIST_MAX_PAGE_SIZE)
 
         with self.metadata_lock:
-            files = list(self.file_metadata.keys())
+            version = self.metadata_version()
+            if request.get('if_none_match') == version:
+                return {'status': 'not_modified', 'version': version}
+
+            if after is not None and after >= prefix:
+                start = bisect.bisect_right(self.sorted_files, after)
+            else:
+                start = bisect.bisect_left(self.sorted_files, prefix)
+            files = self.sorted_files[start:start + limit + 1]
+            if request.get('details'):
+                infos = [self.file_info.get(filename, (None, None, None, None)) for filename in files]
+
+        if prefix and files and not files[-1].startswith(prefix):
+            # Names with the prefix are contiguous; cut at the first other one
+            files = files[:bisect.bisect_left(files, prefix + '\U0010ffff')]
 
         response = {
             'status': 'success',
-            'files': files
+            'files': files[:limit],
+            'version': version
         }
-        send_json(client_socket, response)
+        if request.get('details'):
+            response['files'] = [self.describe_file(filename, info) for filename, info in zip(files[:limit], infos)]
+        if len(files) > limit:
+            response['next'] = files[limit - 1]
+        return response
 
-    def handle_chunk_report(self, client_socket, request):
+    def handle_status(self, request):
+
+        try:
+            with self.metadata_lock:
+                version = self.metadata_version()
+                file_count = len(self.file_metadata)
+
+            return {
+                'status': 'success',
+                'version': version,
+                'files': file_count,
+                'storage_nodes': len(self.get_alive_node_set())
+            }
+        except Exception as e:
+            print(f"Error handling status request: {e}")
+            response = {'status': 'error', 'message': str(e)}
+            return response
+
+    def handle_chunk_report(self, request):
 
         try:
             chunk_id = request.get('chunk_id')
@@ -202,46 +884,154 @@ class MasterNode:
 
             if not chunk_id or not locations:
                 response = {'status': 'error', 'message': 'Missing chunk_id or locations'}
-                send_json(client_socket, response)
-                return
+                return response
+
+            if not self.valid_locations(locations):
+                response = {'status': 'error', 'message': 'locations must be a list of [host, port]'}
+                return response
 
             with self.metadata_lock:
-                self.chunk_locations[chunk_id] = locations
+                # Only chunks a file references are tracked; locations of any
+                # other chunk would never be released
+                if self.chunk_refs.get(chunk_id, 0) <= 0:
+                    response = {'status': 'error', 'message': f'Chunk {chunk_id} is not part of any file'}
+                    return response
+
+                if self.log_failed():
+                    response = {'status': 'error', 'message': 'Metadata log has failed; refusing changes'}
+                    return response
+
+                record = {'op': 'report', 'chunk_id': chunk_id, 'locations': locations}
+                self.apply_record(record)
+                seq = self.log_record(record)
+
+            if not self.sync(seq):
+                response = {'status': 'error', 'message': 'Failed to persist metadata'}
+                return response
 
             response = {'status': 'success', 'message': 'Chunk location recorded'}
-            send_json(client_socket, response)
 
             print(f"Recorded locations for chunk {chunk_id}: {locations}")
+            return response
         except Exception as e:
             print(f"Error handling chunk report: {e}")
             response = {'status': 'error', 'message': str(e)}
-            send_json(client_socket, response)
+            return response
+
+    def find_existing_chunks(self, chunk_ids):
+
+        # A chunk exists if a committed file references it and at least one
+        # replica is on a live node
+        alive_nodes = self.get_alive_node_set()
+        existing_chunks = []
+
+        with self.metadata_lock:
+            alive_mask = self.chunk_locations.node_mask(alive_nodes)
+            for chunk_id in dict.fromkeys(chunk_ids):
+                if self.chunk_refs.get(chunk_id, 0) <= 0:
+                    continue
+                if self.chunk_locations.live_count(chunk_id, alive_mask):
+                    existing_chunks.append(chunk_id)
+
+        return existing_chunks
+
+    def find_existing_stripes(self, stripe_ids, fragments):
+
+        # A stripe exists if all of its fragments do
+        fragment_ids = [f"{stripe_id}.{index}" for stripe_id in stripe_ids for index in range(fragments)]
+        existing_fragments = set(self.find_existing_chunks(fragment_ids))
+        return [
+            stripe_id for stripe_id in dict.fromkeys(stripe_ids)
+            if all(f"{stripe_id}.{index}" in existing_fragments for index in range(fragments))
+        ]
+
+    def assign_chunks(self, chunk_ids, replicas=REPLICATION_FACTOR):
+
+        alive_nodes = self.get_alive_nodes()
+
+        if len(alive_nodes) < replicas:
+            return None, f'Not enough storage nodes. Need {replicas}, have {len(alive_nodes)}'
+
+        chunk_assignments = {}
+        for chunk_id in chunk_ids:
+
+            selected_nodes = self.select_nodes_for_chunk(alive_nodes, replicas)
+            chunk_assignments[chunk_id] = selected_nodes
+
+        return chunk_assignments, None
 
     def get_alive_nodes(self):
 
-        alive_nodes = []
+        return list(self.get_alive_node_set())
+
+    def get_alive_node_set(self):
+
+        # The set of live nodes only changes when a node heartbeats for the
+        # first time (or again after failing) or when the oldest heartbeat
+        # passes FAILURE_TIMEOUT. The cached frozenset is reused until then.
         current_time = time.time()
 
         with self.nodes_lock:
-            for node_id, node_info in self.storage_nodes.items():
-                if current_time - node_info['last_heartbeat'] < FAILURE_TIMEOUT:
-                    alive_nodes.append(node_id)
+            if self.alive_nodes_cache is None or current_time >= self.alive_nodes_expires:
+                alive_nodes = []
+                expires = current_time + FAILURE_TIMEOUT
+                for node_id, node_info in self.storage_nodes.items():
+                    deadline = node_info['last_heartbeat'] + FAILURE_TIMEOUT
+                    if current_time < deadline:
+                        alive_nodes.append(node_id)
+                        expires = min(expires, deadline)
 
-        return alive_nodes
+                self.alive_nodes_cache = frozenset(alive_nodes)
+                self.alive_nodes_expires = expires
 
-    def select_nodes_for_chunk(self, alive_nodes, count):
+            return self.alive_nodes_cache
 
-        import random
-        selected_node_ids = random.sample(alive_nodes, min(count, len(alive_nodes)))
+    def invalidate_alive_nodes(self):
 
+        with self.nodes_lock:
+            self.alive_nodes_cache = None
+
+    def select_nodes_for_chunk(self, alive_nodes, count):
+
+        # Power of two choices: for each replica draw placement_choices (2 by
+        # default) candidate nodes, weighted by free disk space so nodes fill
+        # at the same relative rate, and keep the least loaded one. Load is
+        # the node's last reported transfers plus what has been placed on it
+        # since, so a burst of allocations between heartbeats does not all
+        # land on the node that looked idlest.
         selected_nodes = []
         with self.nodes_lock:
-            for node_id in selected_node_ids:
-                node_info = self.storage_nodes[node_id]
+            candidates = [node_id for node_id in alive_nodes if node_id in self.storage_nodes]
+
+            while candidates and len(selected_nodes) < count:
+                weights = [self.placement_weight(self.storage_nodes[node_id]) for node_id in candidates]
+                known_weights = [weight for weight in weights if weight is not None]
+                default_weight = max(known_weights) if known_weights else 1.0
+                weights = [default_weight if weight is None else weight for weight in weights]
+                choices = random.choices(range(len(candidates)), weights=weights, k=self.placement_choices)
+                best = min(choices, key=lambda i: (self.node_load(self.storage_nodes[candidates[i]]), -weights[i]))
+
+                node_info = self.storage_nodes[candidates.pop(best)]
+                node_info['assigned'] = node_info.get('assigned', 0) + 1
                 selected_nodes.append((node_info['host'], node_info['port']))
 
         return selected_nodes
 
+    def placement_weight(self, node_info):
+
+        # Free bytes; nodes nearly out of space are only used when nothing
+        # else is left. None for nodes that have not reported disk figures.
+        disk_free = node_info.get('disk_free')
+        if disk_free is None:
+            return None
+        if disk_free < PLACEMENT_MIN_FREE:
+            return 1e-6
+        return float(disk_free)
+
+    def node_load(self, node_info):
+
+        return node_info.get('active_transfers', 0) + node_info.get('assigned', 0)
+
     def monitor_node_health(self):
 
         while self.running:
@@ -262,33 +1052,235 @@ class MasterNode:
 
     def handle_node_failures(self, failed_nodes):
 
-        with self.metadata_lock:
+        self.invalidate_alive_nodes()
 
-            affected_chunks = []
-            for chunk_id, locations in self.chunk_locations.items():
+        with self.metadata_lock:
+            if self.log_failed():
+                print(f"Not dropping {len(failed_nodes)} failed nodes: metadata log has failed")
+                return
 
-                new_locations = [
-                    loc for loc in locations
-                    if f"{loc[0]}:{loc[1]}" not in failed_nodes
-                ]
+            record = {'op': 'drop_nodes', 'node_ids': failed_nodes}
+            affected_chunks = self.apply_record(record)
 
-                if len(new_locations) != len(locations):
-                    self.chunk_locations[chunk_id] = new_locations
-                    affected_chunks.append((chunk_id, new_locations))
+            # Nodes stay failed until they heartbeat again, so only log a
+            # drop when it actually changed something
+            seq = self.log_record(record) if affected_chunks else 0
 
             print(f"Found {len(affected_chunks)} chunks affected by node failures")
 
+        self.sync(seq)
+        if affected_chunks:
+            self.replication_wakeup.set()
+
     def check_replication(self):
 
-        while self.running:
-            time.sleep(30)  # Check every 30 seconds
+        # Re-replication scheduler: each round copies under-replicated chunks,
+        # fewest replicas first, with a cap on concurrent copies
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_replications) as copies:
+            while self.running:
+                self.replication_wakeup.wait(REPLICATION_CHECK_INTERVAL)
+                self.replication_wakeup.clear()
+                try:
+                    self.run_replication_round(copies)
+                except Exception as e:
+                    print(f"Error re-replicating chunks: {e}")
 
-            with self.metadata_lock:
-                for chunk_id, locations in self.chunk_locations.items():
-                    if len(locations) < REPLICATION_FACTOR:
-                        print(f"WARNING: Chunk {chunk_id} under-replicated: {len(locations)}/{REPLICATION_FACTOR}")
+    def run_replication_round(self, copies):
+
+        alive_nodes = self.get_alive_node_set()
+        queue = self.find_under_replicated(alive_nodes)
+
+        # Forget fragments that are live again or whose file was deleted
+        self.reported_fragments &= {
+            chunk_id for live, chunk_id in queue
+            if not live and self.fragment_stripe(chunk_id) is not None
+        }
+        queue = [item for item in queue if item[1] not in self.reported_fragments]
+        if not queue:
+            return
+
+        print(f"Re-replicating {len(queue)} under-replicated chunks")
+        start_time = time.time()
+        pending = set()
+        restored = 0
+        copied_bytes = 0
+        unrecoverable = 0
+
+        # The bandwidth budget is shared by the copies running at once
+        rate_limit = None
+        if self.replication_bandwidth:
+            rate_limit = self.replication_bandwidth / self.max_concurrent_replications
+
+        def collect(done):
+            nonlocal restored, copied_bytes
+            for future in done:
+                pending.discard(future)
+                size = future.result()
+                if size is not None:
+                    restored += 1
+                    copied_bytes += size
+
+        # Erasure fragments are stored once, so a lost fragment has no replica
+        # to copy from; rebuilding it from the rest of its stripe is not done
+        # yet. Each lost fragment is reported once.
+        lost_stripes = {}  # stripe_id -> (k, m)
+        lost_fragments = 0
+
+        for live, chunk_id in queue:
+            stripe = self.fragment_stripe(chunk_id)
+            if stripe is not None and not live:
+                stripe_id, k, m = stripe
+                lost_stripes[stripe_id] = (k, m)
+                lost_fragments += 1
+                self.reported_fragments.add(chunk_id)
+                continue
+
+            while len(pending) >= self.max_concurrent_replications:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+
+            copy = self.plan_replication(chunk_id, alive_nodes)
+            if copy is None:
+                unrecoverable += 1
+                continue
+
+            source, target = copy
+            pending.add(copies.submit(self.replicate_chunk, chunk_id, source, target, rate_limit))
+
+        collect(wait(pending).done)
+
+        elapsed = time.time() - start_time
+        remaining = sum(
+            1 for _, chunk_id in self.find_under_replicated(alive_nodes)
+            if chunk_id not in self.reported_fragments
+        )
+        print(f"Re-replication round: {restored} replicas restored ({copied_bytes / (1024 * 1024):.2f} MB) "
+              f"in {elapsed:.2f}s, {remaining} chunks still under-replicated")
+        if unrecoverable:
+            print(f"WARNING: {unrecoverable} chunks have no live replica or no free node to copy to")
+        if lost_fragments:
+            undecodable = self.count_undecodable_stripes(lost_stripes, alive_nodes)
+            print(f"{lost_fragments} erasure fragments lost from {len(lost_stripes)} stripes "
+                  f"(fragments are not rebuilt)")
+            if undecodable:
+                print(f"WARNING: {undecodable} erasure-coded stripes have fewer than k live fragments")
+
+        # Chunks missing more than one replica get one copy per round, so go
+        # again right away while progress is being made
+        if restored and remaining:
+            self.replication_wakeup.set()
+
+    def fragment_stripe(self, chunk_id):
+
+        # Erasure fragments are named "<stripe_id>.<i>" and stripe IDs end in
+        # "-rs<k>-<m>". Returns (stripe_id, k, m), or None for other chunks.
+        stripe_id, dot, index = chunk_id.rpartition('.')
+        code = stripe_id.rpartition('-rs')[2].split('-')
+        if not dot or not index.isdigit() or len(code) != 2 or not all(part.isdigit() for part in code):
+            return None
+        return stripe_id, int(code[0]), int(code[1])
+
+    def count_undecodable_stripes(self, stripes, alive_nodes):
+
+        # Stripes ({stripe_id: (k, m)}) with fewer than k live fragments
+        undecodable = 0
+        with self.metadata_lock:
+            alive_mask = self.chunk_locations.node_mask(alive_nodes)
+            for stripe_id, (k, m) in stripes.items():
+                live = sum(
+                    1 for index in range(k + m)
+                    if self.chunk_locations.live_count(f"{stripe_id}.{index}", alive_mask)
+                )
+                if live < k:
+                    undecodable += 1
+        return undecodable
+
+    def find_under_replicated(self, alive_nodes):
+
+        # [(live replica count, chunk_id)] for referenced chunks below their
+        # replica target, most urgent first. Only chunks with too few
+        # recorded replicas, or with a replica on a node that stopped
+        # heartbeating but has not been dropped yet, are looked at.
+        alive_nodes = set(alive_nodes)
+        by_count = [[] for _ in range(REPLICATION_FACTOR)]
+
+        with self.metadata_lock:
+            alive_mask = self.chunk_locations.node_mask(alive_nodes)
+            candidates = set()
+            for missing, chunk_ids in self.replica_buckets.items():
+                if missing > 0:
+                    candidates.update(chunk_ids)
+            for node_id in self.chunk_locations.node_ids():
+                if node_id not in alive_nodes:
+                    candidates.update(self.chunk_locations.chunks_on_node(node_id))
+
+            for chunk_id in candidates:
+                if self.chunk_refs.get(chunk_id, 0) <= 0:
+                    continue
+                live = self.chunk_locations.live_count(chunk_id, alive_mask)
+                if live < self.replica_target(chunk_id):
+                    by_count[live].append((live, chunk_id))
+
+        return [item for bucket in by_count for item in bucket]
+
+    def plan_replication(self, chunk_id, alive_nodes):
+
+        # Pick a live replica to copy from and a live node without the chunk
+        # to copy to; returns None if there is no such pair
+        with self.metadata_lock:
+            locations = self.chunk_locations.get(chunk_id, [])
+            target = self.replica_target(chunk_id)
+
+        holders = {f"{loc[0]}:{loc[1]}" for loc in locations}
+        sources = [loc for loc in locations if f"{loc[0]}:{loc[1]}" in alive_nodes]
+        candidates = [node_id for node_id in alive_nodes if node_id not in holders]
+
+        if not sources or len(sources) >= target or not candidates:
+            return None
+
+        target = self.select_nodes_for_chunk(candidates, 1)
+        if not target:
+            return None
+        return random.choice(sources), target[0]
+
+    def replicate_chunk(self, chunk_id, source, target, rate_limit=None):
+
+        # Ask `source` to copy the chunk to `target`, then record the new
+        # replica. Returns the bytes copied, or None on failure.
+        request = {
+            'command': 'REPLICATE',
+            'chunk_id': chunk_id,
+            'target': list(target),
+            'rate_limit': rate_limit
+        }
+
+        try:
+            response = self.node_pool.call(source[0], source[1], request)
+        except Exception as e:
+            print(f"Error copying chunk {chunk_id} from {source[0]}:{source[1]}: {e}")
+            return None
+
+        if not response or response.get('status') != 'success':
+            message = response.get('message', 'Unknown error') if response else 'No response'
+            print(f"Failed to copy chunk {chunk_id} from {source[0]}:{source[1]}: {message}")
+            return None
+
+        with self.metadata_lock:
+            if self.log_failed():
+                return None
+            record = {'op': 'add_location', 'chunk_id': chunk_id, 'location': list(target)}
+            seq = self.log_record(record) if self.apply_record(record) else 0
+
+        if not self.sync(seq):
+            return None
+        return response.get('size', 0)
 
 
 if __name__ == "__main__":
-    master = MasterNode(MASTER_HOST, MASTER_PORT)
+    server_mode = sys.argv[1] if len(sys.argv) > 1 else SERVER_MODE
+    if server_mode not in ('threaded', 'asyncio'):
+        print("Usage: python master_node.py [threaded|asyncio]")
+        sys.exit(1)
+
+    master = MasterNode(MASTER_HOST, MASTER_PORT, server_mode)
     master.start()
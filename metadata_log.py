@@ -0,0 +1,214 @@
+import json
+import os
+import threading
+import time
+
+
+class MetadataLog:
+    # Append-only operation log plus periodic snapshots for master metadata.
+    #
+    # Records get increasing sequence numbers and are appended to segment
+    # files named metadata.log.<first_seq>. A background writer thread
+    # group-commits them: every record queued while the previous fsync was
+    # running is written and made durable by a single fsync. A snapshot holds
+    # the full state up to some sequence number; taking one starts a new
+    # segment, and older segments are deleted once the snapshot is on disk.
+
+    SNAPSHOT_NAME = 'metadata.snapshot'
+    SEGMENT_PREFIX = 'metadata.log.'
+
+    def __init__(self, directory, group_commit_delay=0.0):
+
+        self.directory = directory
+        self.group_commit_delay = group_commit_delay
+
+        self.lock = threading.Condition()
+        self.file_lock = threading.Lock()
+        self.pending = []        # [(seq, line)] waiting to be written
+        self.last_seq = 0        # last sequence number handed out
+        self.durable_seq = 0     # every record up to here is fsynced
+        self.snapshot_seq = 0    # sequence number covered by the loaded snapshot
+        self.failed = False
+        self.running = True
+
+        self.segment_file = None
+        self.writer_thread = None
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def load(self):
+
+        # Returns (snapshot_state, records) where records are the log entries
+        # newer than the snapshot, in order. Call once, before start().
+        snapshot_state = None
+        snapshot_seq = 0
+
+        snapshot_path = os.path.join(self.directory, self.SNAPSHOT_NAME)
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+            snapshot_state = snapshot['state']
+            snapshot_seq = snapshot['seq']
+
+        records = []
+        last_seq = snapshot_seq
+        for _, path in self.list_segments():
+            good_size = 0
+            with open(path, 'rb') as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError('unterminated record')
+                        record = json.loads(line)
+                    except ValueError:
+                        # A torn write at the tail of a segment; nothing after
+                        # it in this segment was acknowledged
+                        break
+                    good_size += len(line)
+                    if record['seq'] > snapshot_seq:
+                        records.append(record)
+                        last_seq = max(last_seq, record['seq'])
+
+            # Cut the torn tail off, or the next records appended to this
+            # segment would continue its broken line and be lost on replay
+            if good_size < os.path.getsize(path):
+                print(f"Truncating torn write at byte {good_size} of {path}")
+                with open(path, 'r+b') as f:
+                    f.truncate(good_size)
+                    f.flush()
+                    os.fsync(f.fileno())
+
+        records.sort(key=lambda record: record['seq'])
+
+        self.snapshot_seq = snapshot_seq
+        self.last_seq = last_seq
+        self.durable_seq = last_seq
+        return snapshot_state, records
+
+    def start(self):
+
+        with self.file_lock:
+            self.open_segment(self.last_seq + 1)
+
+        self.writer_thread = threading.Thread(target=self.write_loop)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+
+    def append(self, record):
+
+        # Queue a record and return its sequence number without waiting for
+        # it to reach disk. Callers that must not acknowledge an operation
+        # before it is durable pass the result to wait().
+        with self.lock:
+            self.last_seq += 1
+            record = dict(record)
+            record['seq'] = self.last_seq
+            self.pending.append((self.last_seq, json.dumps(record, separators=(',', ':')) + '\n'))
+            self.lock.notify_all()
+            return self.last_seq
+
+    def wait(self, seq):
+
+        with self.lock:
+            while self.durable_seq < seq and not self.failed:
+                self.lock.wait()
+            return self.durable_seq >= seq
+
+    def write_loop(self):
+
+        last_batch_size = 0
+        while self.running:
+            with self.lock:
+                while not self.pending and self.running:
+                    self.lock.wait()
+
+            # Under concurrent load, give other writers a moment to join this
+            # batch; a lone writer is not delayed
+            if self.group_commit_delay and last_batch_size > 1:
+                time.sleep(self.group_commit_delay)
+
+            with self.lock:
+                batch = self.pending
+                self.pending = []
+
+            last_batch_size = len(batch)
+            if not batch:
+                continue
+
+            try:
+                with self.file_lock:
+                    self.segment_file.write(''.join(line for _, line in batch))
+                    self.segment_file.flush()
+                    os.fsync(self.segment_file.fileno())
+            except OSError as e:
+                print(f"ERROR: Failed to write metadata log: {e}")
+                with self.lock:
+                    self.failed = True
+                    self.lock.notify_all()
+                return
+
+            with self.lock:
+                self.durable_seq = max(self.durable_seq, batch[-1][0])
+                self.lock.notify_all()
+
+    def write_snapshot(self, state, seq):
+
+        # `state` must reflect exactly the records up to `seq`. Call
+        # start_snapshot() while holding the same lock used to apply records,
+        # copy the state, then call this without the lock.
+        snapshot_path = os.path.join(self.directory, self.SNAPSHOT_NAME)
+        temp_path = snapshot_path + '.tmp'
+
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'seq': seq, 'state': state}, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, snapshot_path)
+
+        # Everything in segments that start at or before seq is now covered
+        # by the snapshot, except the current segment
+        for first_seq, path in self.list_segments():
+            if first_seq <= seq and path != self.segment_file.name:
+                os.remove(path)
+
+    def start_snapshot(self):
+
+        # Switch to a new segment and return the sequence number the snapshot
+        # will cover. No record can be appended in between, so every record
+        # after seq lands in the new segment.
+        with self.lock:
+            seq = self.last_seq
+            with self.file_lock:
+                self.open_segment(seq + 1)
+        return seq
+
+    def open_segment(self, first_seq):
+
+        if self.segment_file is not None:
+            self.segment_file.flush()
+            os.fsync(self.segment_file.fileno())
+            self.segment_file.close()
+
+        path = os.path.join(self.directory, f"{self.SEGMENT_PREFIX}{first_seq:020d}")
+        self.segment_file = open(path, 'a', encoding='utf-8')
+
+    def list_segments(self):
+
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.startswith(self.SEGMENT_PREFIX):
+                segments.append((int(name[len(self.SEGMENT_PREFIX):]), os.path.join(self.directory, name)))
+        return sorted(segments)
+
+    def close(self):
+
+        with self.lock:
+            self.running = False
+            self.lock.notify_all()
+        if self.writer_thread is not None:
+            self.writer_thread.join()
+        with self.file_lock:
+            if self.segment_file is not None:
+                self.segment_file.close()
+                self.segment_file = None
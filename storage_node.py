@@ -1,23 +1,45 @@
+import asyncio
 import socket
 import threading
 import time
 import os
+import shutil
 import sys
-from utils import send_json, recv_json, recv_all
-from config import MASTER_HOST, MASTER_PORT, HEARTBEAT_INTERVAL
+from utils import recv_json, recv_to_file, reply, ConnectionPool, read_json, reply_async, RECV_BUFFER_SIZE, \
+    negotiate_encoding, ENCODING_JSON
+from cache import HotChunkCache
+from config import MASTER_HOST, MASTER_PORT, HEARTBEAT_INTERVAL, SERVER_MODE, SERVER_BACKLOG, \
+    MAX_CONNECTIONS, WIRE_ENCODING, STORAGE_CACHE_SIZE, STORAGE_CACHE_HISTORY
+
+
+# Bytes the asyncio server gathers before each write of a chunk being stored
+STORE_WRITE_SIZE = 4 * RECV_BUFFER_SIZE
 
 
 class StorageNode:
-    def __init__(self, host, port, storage_dir):
+    def __init__(self, host, port, storage_dir, server_mode=SERVER_MODE):
 
         self.host = host
         self.port = port
         self.storage_dir = storage_dir
+        self.server_mode = server_mode
         self.running = True
 
+        # Connections to other storage nodes, used to copy chunks on request
+        self.peer_pool = ConnectionPool(encoding=WIRE_ENCODING)
+
+        # Chunks read more than once are served from memory
+        self.chunk_cache = HotChunkCache(STORAGE_CACHE_SIZE, STORAGE_CACHE_HISTORY)
+
         if not os.path.exists(storage_dir):
             os.makedirs(storage_dir)
 
+        # Load figures reported to the master with every heartbeat
+        self.stats_lock = threading.Lock()
+        self.active_connections = 0
+        self.active_transfers = 0
+        self.chunk_count = sum(1 for name in os.listdir(storage_dir) if not name.endswith('.tmp'))
+
         print(f"Storage Node initialized at {host}:{port}")
         print(f"Storage directory: {storage_dir}")
 
@@ -28,10 +50,17 @@ class StorageNode:
         heartbeat_thread.daemon = True
         heartbeat_thread.start()
 
+        if self.server_mode == 'asyncio':
+            try:
+                asyncio.run(self.serve_async())
+            except KeyboardInterrupt:
+                print("\nShutting down Storage Node...")
+            return
+
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         server_socket.bind((self.host, self.port))
-        server_socket.listen(5)
+        server_socket.listen(SERVER_BACKLOG)
 
         print(f"Storage Node listening on {self.host}:{self.port}")
 
@@ -42,6 +71,10 @@ class StorageNode:
                     client_socket, addr = server_socket.accept()
                     print(f"Connection from {addr}")
 
+                    # A RETRIEVE reply is a header then the data; without
+                    # NODELAY a short tail waits for the client's delayed ACK
+                    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
                     client_thread = threading.Thread(
                         target=self.handle_client,
                         args=(client_socket,)
@@ -57,118 +90,437 @@ class StorageNode:
 
     def handle_client(self, client_socket):
 
+        # Connections are persistent: keep serving requests, in order, until the
+        # client closes its end or a transfer leaves the stream out of sync.
+        encoding = ENCODING_JSON
+        self.update_stats('active_connections', 1)
         try:
-            request = recv_json(client_socket)
-            if not request:
-                return
-
-            command = request.get('command')
-
-            if command == 'STORE':
-                self.handle_store(client_socket, request)
-            elif command == 'RETRIEVE':
-                self.handle_retrieve(client_socket, request)
-            else:
-                response = {'status': 'error', 'message': 'Unknown command'}
-                send_json(client_socket, response)
+            while self.running:
+                request = recv_json(client_socket)
+                if not request:
+                    return
+
+                command = request.get('command')
+
+                if command == 'HELLO':
+                    new_encoding, response = negotiate_encoding(request)
+                    keep_alive = reply(client_socket, request, response, encoding)
+                    encoding = new_encoding
+                elif command == 'STORE':
+                    keep_alive = self.track_transfer(self.handle_store, client_socket, request, encoding)
+                elif command == 'RETRIEVE':
+                    keep_alive = self.track_transfer(self.handle_retrieve, client_socket, request, encoding)
+                elif command == 'REPLICATE':
+                    response = self.track_transfer(self.handle_replicate, request)
+                    keep_alive = reply(client_socket, request, response, encoding)
+                elif command == 'STATS':
+                    response = self.handle_stats()
+                    keep_alive = reply(client_socket, request, response, encoding)
+                else:
+                    response = {'status': 'error', 'message': 'Unknown command'}
+                    keep_alive = reply(client_socket, request, response, encoding)
+
+                if not keep_alive:
+                    return
         except Exception as e:
             print(f"Error handling client: {e}")
         finally:
+            self.update_stats('active_connections', -1)
             client_socket.close()
 
-    def handle_store(self, client_socket, request):
+    def handle_store(self, client_socket, request, encoding=ENCODING_JSON):
+        temp_path = None
         try:
             chunk_id = request.get('chunk_id')
             chunk_size = request.get('size')
 
             if not chunk_id or chunk_size is None:
                 response = {'status': 'error', 'message': 'Missing chunk_id or size'}
-                send_json(client_socket, response)
-                return
+                reply(client_socket, request, response, encoding)
+                return False
 
-            # Receive raw binary chunk data
-            chunk_data = recv_all(client_socket, chunk_size)
+            # Stream raw binary chunk data to a temporary file, then move it into
+            # place so a failed transfer never leaves a truncated chunk behind
+            chunk_path = os.path.join(self.storage_dir, chunk_id)
+            temp_path = f"{chunk_path}.{threading.get_ident()}.tmp"
+            with open(temp_path, 'wb') as f:
+                received = recv_to_file(client_socket, f, chunk_size)
 
-            if chunk_data is None:
+            if received is None:
+                os.remove(temp_path)
                 response = {'status': 'error', 'message': 'Failed to receive chunk data'}
-                send_json(client_socket, response)
-                return
+                reply(client_socket, request, response, encoding)
+                return False
 
-            # Write raw chunk data to file
-            chunk_path = os.path.join(self.storage_dir, chunk_id)
-            with open(chunk_path, 'wb') as f:
-                f.write(chunk_data)
+            self.store_received(chunk_id, temp_path, chunk_path)
 
-            print(f"Stored chunk {chunk_id} ({len(chunk_data)} bytes)")
+            print(f"Stored chunk {chunk_id} ({received} bytes)")
 
             response = {'status': 'success', 'message': f'Chunk {chunk_id} stored'}
-            send_json(client_socket, response)
+            return reply(client_socket, request, response, encoding)
         except Exception as e:
             print(f"Error storing chunk: {e}")
+            self.remove_temp(temp_path)
             response = {'status': 'error', 'message': str(e)}
-            send_json(client_socket, response)
+            reply(client_socket, request, response, encoding)
+            return False
+
+    def store_received(self, chunk_id, temp_path, chunk_path):
 
-    def handle_retrieve(self, client_socket, request):
+        # Move a fully received chunk into place
+        is_new = not os.path.exists(chunk_path)
+        os.replace(temp_path, chunk_path)
+        self.chunk_cache.discard(chunk_id)
+        if is_new:
+            self.update_stats('chunk_count', 1)
+
+    def write_temp(self, temp_path, data, append, chunk_id=None, chunk_path=None):
+
+        # Write (or append) data to a chunk's temp file; with chunk_path, the
+        # data is the last of the chunk and the file is moved into place
+        with open(temp_path, 'ab' if append else 'wb') as f:
+            f.write(data)
+        if chunk_path is not None:
+            self.store_received(chunk_id, temp_path, chunk_path)
+
+    def remove_temp(self, temp_path):
+
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    def handle_retrieve(self, client_socket, request, encoding=ENCODING_JSON):
+        try:
+            response, chunk_path, chunk_data = self.prepare_retrieve(request)
+            if not reply(client_socket, request, response, encoding):
+                return False
+
+            if chunk_data is not None:
+                start = response['offset']
+                client_socket.sendall(memoryview(chunk_data)[start:start + response['size']])
+            elif chunk_path is not None:
+                # Stream raw chunk data straight from disk to the socket
+                with open(chunk_path, 'rb') as f:
+                    client_socket.sendfile(f, response['offset'], response['size'])
+            return True
+        except Exception as e:
+            print(f"Error retrieving chunk: {e}")
+            response = {'status': 'error', 'message': str(e)}
+            reply(client_socket, request, response, encoding)
+            return False
+
+    def prepare_retrieve(self, request):
+
+        # Validate a RETRIEVE request; returns the metadata response, the chunk
+        # path to send from and the chunk data if it is in memory. On error
+        # both of the latter are None.
+        chunk_id = request.get('chunk_id')
+
+        if not chunk_id:
+            return {'status': 'error', 'message': 'Missing chunk_id'}, None, None
+
+        chunk_path = os.path.join(self.storage_dir, chunk_id)
+
+        # Hot chunks are served from memory without touching the disk; a
+        # chunk read from disk for the second time is loaded into the cache
+        chunk_data = self.chunk_cache.get(chunk_id)
+        cache_hit = chunk_data is not None
+        if not cache_hit:
+            if not os.path.exists(chunk_path):
+                return {'status': 'error', 'message': f'Chunk {chunk_id} not found'}, None, None
+            chunk_size = os.path.getsize(chunk_path)
+            if self.chunk_cache.admit(chunk_id, chunk_size):
+                with open(chunk_path, 'rb') as f:
+                    chunk_data = f.read()
+                chunk_size = len(chunk_data)
+                self.chunk_cache.put(chunk_id, chunk_data)
+        else:
+            chunk_size = len(chunk_data)
+
+        # Optional byte range within the chunk
+        offset = request.get('offset') or 0
+        length = request.get('length')
+
+        if length is None:
+            length = chunk_size - offset
+
+        if offset < 0 or length < 0 or offset > chunk_size:
+            return {'status': 'error', 'message': f'Invalid range for chunk {chunk_id}'}, None, None
+
+        length = min(length, chunk_size - offset)
+        if cache_hit:
+            self.chunk_cache.count_served(length)
+
+        print(f"Retrieved chunk {chunk_id} ({length} bytes at offset {offset})")
+
+        response = {
+            'status': 'success',
+            'chunk_id': chunk_id,
+            'size': length,
+            'offset': offset,
+            'chunk_size': chunk_size
+        }
+        return response, chunk_path, chunk_data
+
+    def handle_replicate(self, request):
+
+        # Copy a local chunk to another storage node, sent as a normal STORE.
+        # The master uses this to restore replicas lost with a failed node.
         try:
             chunk_id = request.get('chunk_id')
+            target = request.get('target')  # (host, port)
+            rate_limit = request.get('rate_limit')  # bytes per second, or None
 
-            if not chunk_id:
-                response = {'status': 'error', 'message': 'Missing chunk_id'}
-                send_json(client_socket, response)
-                return
+            if not chunk_id or not target:
+                return {'status': 'error', 'message': 'Missing chunk_id or target'}
 
             chunk_path = os.path.join(self.storage_dir, chunk_id)
-
             if not os.path.exists(chunk_path):
-                response = {'status': 'error', 'message': f'Chunk {chunk_id} not found'}
-                send_json(client_socket, response)
-                return
+                return {'status': 'error', 'message': f'Chunk {chunk_id} not found'}
 
-            # Read raw chunk data from file
-            with open(chunk_path, 'rb') as f:
-                chunk_data = f.read()
+            start_time = time.time()
+            response = self.peer_pool.run(
+                target[0], target[1],
+                lambda connection: self.push_chunk(connection, chunk_id, chunk_path, rate_limit)
+            )
 
-            # Get chunk size
-            chunk_size = len(chunk_data)
+            if not response or response.get('status') != 'success':
+                message = response.get('message', 'Unknown error') if response else 'No response'
+                return {'status': 'error', 'message': f'Target {target[0]}:{target[1]} failed: {message}'}
 
-            print(f"Retrieved chunk {chunk_id} ({chunk_size} bytes)")
+            elapsed = time.time() - start_time
+            size = os.path.getsize(chunk_path)
+            print(f"Replicated chunk {chunk_id} to {target[0]}:{target[1]} ({size} bytes in {elapsed:.2f}s)")
 
-            # Send metadata response
-            response = {
-                'status': 'success',
-                'chunk_id': chunk_id,
-                'size': chunk_size
-            }
-            send_json(client_socket, response)
+            return {'status': 'success', 'chunk_id': chunk_id, 'size': size, 'elapsed': elapsed}
+        except Exception as e:
+            print(f"Error replicating chunk: {e}")
+            return {'status': 'error', 'message': str(e)}
+
+    def push_chunk(self, connection, chunk_id, chunk_path, rate_limit=None):
+
+        size = os.path.getsize(chunk_path)
+        request_id = connection.send({'command': 'STORE', 'chunk_id': chunk_id, 'size': size})
+        if request_id is None:
+            return None
+
+        start_time = time.time()
+        sent = 0
+        with open(chunk_path, 'rb') as f:
+            while sent < size:
+                data = f.read(min(RECV_BUFFER_SIZE, size - sent))
+                if not data:
+                    connection.close()
+                    return None
+                connection.sendall(data)
+                sent += len(data)
+
+                # Throttle: sleep until the average rate is back under the limit
+                if rate_limit:
+                    delay = sent / rate_limit - (time.time() - start_time)
+                    if delay > 0:
+                        time.sleep(delay)
+
+        return connection.recv(request_id)
+
+    async def serve_async(self):
+
+        # One event loop serves every connection instead of a thread each;
+        # the semaphore caps how many are served at once.
+        connection_slots = asyncio.Semaphore(MAX_CONNECTIONS)
 
-            # Send raw binary chunk data
-            client_socket.sendall(chunk_data)
+        async def handle(reader, writer):
+            async with connection_slots:
+                await self.handle_client_async(reader, writer)
+
+        server = await asyncio.start_server(
+            handle, self.host, self.port, backlog=SERVER_BACKLOG, reuse_address=True
+        )
+
+        print(f"Storage Node listening on {self.host}:{self.port} (asyncio)")
+
+        async with server:
+            await server.serve_forever()
+
+    async def handle_client_async(self, reader, writer):
+
+        encoding = ENCODING_JSON
+        self.update_stats('active_connections', 1)
+        try:
+            while self.running:
+                request = await read_json(reader)
+                if not request:
+                    return
+
+                command = request.get('command')
+
+                if command == 'HELLO':
+                    new_encoding, response = negotiate_encoding(request)
+                    keep_alive = await reply_async(writer, request, response, encoding)
+                    encoding = new_encoding
+                elif command == 'STORE':
+                    keep_alive = await self.track_transfer_async(
+                        self.handle_store_async(reader, writer, request, encoding)
+                    )
+                elif command == 'RETRIEVE':
+                    keep_alive = await self.track_transfer_async(
+                        self.handle_retrieve_async(writer, request, encoding)
+                    )
+                elif command == 'REPLICATE':
+                    # The copy blocks on another node, so run it off the event loop
+                    response = await self.track_transfer_async(asyncio.get_running_loop().run_in_executor(
+                        None, self.handle_replicate, request
+                    ))
+                    keep_alive = await reply_async(writer, request, response, encoding)
+                elif command == 'STATS':
+                    response = self.handle_stats()
+                    keep_alive = await reply_async(writer, request, response, encoding)
+                else:
+                    response = {'status': 'error', 'message': 'Unknown command'}
+                    keep_alive = await reply_async(writer, request, response, encoding)
+
+                if not keep_alive:
+                    return
+        except Exception as e:
+            print(f"Error handling client: {e}")
+        finally:
+            self.update_stats('active_connections', -1)
+            writer.close()
+
+    async def handle_store_async(self, reader, writer, request, encoding=ENCODING_JSON):
+        # Disk work runs on the default executor so a slow disk does not
+        # stall every other connection on the event loop
+        loop = asyncio.get_running_loop()
+        temp_path = None
+        try:
+            chunk_id = request.get('chunk_id')
+            chunk_size = request.get('size')
+
+            if not chunk_id or chunk_size is None:
+                response = {'status': 'error', 'message': 'Missing chunk_id or size'}
+                await reply_async(writer, request, response, encoding)
+                return False
+
+            chunk_path = os.path.join(self.storage_dir, chunk_id)
+            temp_path = f"{chunk_path}.{id(writer)}.tmp"
+
+            # Received data is gathered into writes of up to STORE_WRITE_SIZE,
+            # as each trip to the executor costs more than a small write; a
+            # chunk that fits in one is written and moved into place at once
+            remaining = chunk_size
+            pending = bytearray()
+            written = False
+            while remaining > 0:
+                data = await reader.read(min(remaining, RECV_BUFFER_SIZE))
+                if not data:
+                    break
+                pending += data
+                remaining -= len(data)
+                if len(pending) >= STORE_WRITE_SIZE and remaining > 0:
+                    await loop.run_in_executor(None, self.write_temp, temp_path, pending, written)
+                    pending = bytearray()
+                    written = True
+
+            if remaining > 0:
+                await loop.run_in_executor(None, self.remove_temp, temp_path)
+                response = {'status': 'error', 'message': 'Failed to receive chunk data'}
+                await reply_async(writer, request, response, encoding)
+                return False
+
+            await loop.run_in_executor(None, self.write_temp, temp_path, pending, written, chunk_id, chunk_path)
+
+            print(f"Stored chunk {chunk_id} ({chunk_size} bytes)")
+
+            response = {'status': 'success', 'message': f'Chunk {chunk_id} stored'}
+            return await reply_async(writer, request, response, encoding)
+        except Exception as e:
+            print(f"Error storing chunk: {e}")
+            await loop.run_in_executor(None, self.remove_temp, temp_path)
+            response = {'status': 'error', 'message': str(e)}
+            await reply_async(writer, request, response, encoding)
+            return False
+
+    async def handle_retrieve_async(self, writer, request, encoding=ENCODING_JSON):
+        loop = asyncio.get_running_loop()
+        try:
+            # prepare_retrieve may read the whole chunk from disk into the cache
+            response, chunk_path, chunk_data = await loop.run_in_executor(None, self.prepare_retrieve, request)
+            if not await reply_async(writer, request, response, encoding):
+                return False
+
+            if chunk_data is not None:
+                start = response['offset']
+                writer.write(memoryview(chunk_data)[start:start + response['size']])
+                await writer.drain()
+            elif chunk_path is not None:
+                # loop.sendfile uses os.sendfile on the transport's socket when it can
+                f = await loop.run_in_executor(None, open, chunk_path, 'rb')
+                try:
+                    await loop.sendfile(writer.transport, f, response['offset'], response['size'])
+                finally:
+                    f.close()
+            return True
         except Exception as e:
             print(f"Error retrieving chunk: {e}")
             response = {'status': 'error', 'message': str(e)}
-            send_json(client_socket, response)
+            await reply_async(writer, request, response, encoding)
+            return False
+
+    def update_stats(self, name, delta):
+
+        with self.stats_lock:
+            setattr(self, name, getattr(self, name) + delta)
+
+    def track_transfer(self, handler, *args):
+
+        self.update_stats('active_transfers', 1)
+        try:
+            return handler(*args)
+        finally:
+            self.update_stats('active_transfers', -1)
+
+    async def track_transfer_async(self, awaitable):
+
+        self.update_stats('active_transfers', 1)
+        try:
+            return await awaitable
+        finally:
+            self.update_stats('active_transfers', -1)
+
+    def get_stats(self):
+
+        usage = shutil.disk_usage(self.storage_dir)
+        with self.stats_lock:
+            return {
+                'disk_total': usage.total,
+                'disk_free': usage.free,
+                'chunk_count': self.chunk_count,
+                'active_connections': self.active_connections,
+                'active_transfers': self.active_transfers
+            }
+
+    def handle_stats(self):
+
+        return {'status': 'success', 'node': self.get_stats(), 'cache': self.chunk_cache.stats()}
 
     def send_heartbeats(self):
 
+        # Heartbeats reuse one persistent connection to the master
+        master_pool = ConnectionPool(max_idle=1, encoding=WIRE_ENCODING)
+
         while self.running:
             try:
-                master_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                master_socket.connect((MASTER_HOST, MASTER_PORT))
-
                 heartbeat = {
                     'command': 'HEARTBEAT',
                     'node_id': f"{self.host}:{self.port}",
                     'host': self.host,
                     'port': self.port
                 }
+                heartbeat.update(self.get_stats())
 
-                send_json(master_socket, heartbeat)
-                response = recv_json(master_socket)
+                response = master_pool.call(MASTER_HOST, MASTER_PORT, heartbeat)
 
                 if response and response.get('status') == 'success':
                     print(f"Heartbeat sent to master")
-
-                master_socket.close()
             except Exception as e:
                 print(f"Failed to send heartbeat: {e}")
 
@@ -176,15 +528,16 @@ class StorageNode:
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 4:
-        print("Usage: python storage_node.py <host> <port> <storage_dir>")
+    if len(sys.argv) not in (4, 5) or (len(sys.argv) == 5 and sys.argv[4] not in ('threaded', 'asyncio')):
+        print("Usage: python storage_node.py <host> <port> <storage_dir> [threaded|asyncio]")
         print("Example: python storage_node.py 127.0.0.1 9001 ./node1_storage")
         sys.exit(1)
 
     host = sys.argv[1]
     port = int(sys.argv[2])
     storage_dir = sys.argv[3]
+    server_mode = sys.argv[4] if len(sys.argv) == 5 else SERVER_MODE
 
-    node = StorageNode(host, port, storage_dir)
+    node = StorageNode(host, port, storage_dir, server_mode)
     node.start()
 
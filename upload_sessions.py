@@ -0,0 +1,106 @@
+import json
+import os
+import threading
+import uuid
+
+
+class UploadSessionStore:
+    # Resumable upload sessions. A session collects the parts of one file;
+    # each part is stored on the storage nodes as soon as it arrives, and the
+    # file is only committed on the master once every part is there. Each
+    # session is an append-only file of JSON lines in `directory`, a header
+    # followed by one line per stored part, so an interrupted upload can be
+    # resumed after a restart without resending the parts already stored.
+
+    SUFFIX = '.session'
+
+    def __init__(self, directory):
+
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.sessions = None  # upload_id -> session, read from disk on first use
+
+    def load(self):
+
+        # Call with self.lock held
+        if self.sessions is not None:
+            return
+        self.sessions = {}
+
+        if not os.path.exists(self.directory):
+            return
+
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.SUFFIX):
+                continue
+
+            session = None
+            with open(os.path.join(self.directory, name), 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A torn write at the tail; that part was never acknowledged
+                        break
+                    if session is None:
+                        session = dict(record, parts={})
+                    else:
+                        session['parts'][record['index']] = record
+
+            if session is not None:
+                self.sessions[session['upload_id']] = session
+
+    def create(self, filename, storage_mode, part_size):
+
+        header = {
+            'upload_id': uuid.uuid4().hex,
+            'filename': filename,
+            'storage_mode': storage_mode,
+            'part_size': part_size
+        }
+
+        with self.lock:
+            self.load()
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            self.append(header['upload_id'], header)
+            self.sessions[header['upload_id']] = dict(header, parts={})
+        return dict(header)
+
+    def get(self, upload_id):
+
+        with self.lock:
+            self.load()
+            return self.sessions.get(upload_id)
+
+    def add_part(self, upload_id, part):
+
+        # A part sent again replaces the earlier copy
+        with self.lock:
+            self.load()
+            session = self.sessions.get(upload_id)
+            if session is None:
+                return False
+            self.append(upload_id, part)
+            session['parts'][part['index']] = part
+            return True
+
+    def remove(self, upload_id):
+
+        with self.lock:
+            self.load()
+            if self.sessions.pop(upload_id, None) is None:
+                return False
+            os.remove(self.session_path(upload_id))
+            return True
+
+    def append(self, upload_id, record):
+
+        with open(self.session_path(upload_id), 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, separators=(',', ':')) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def session_path(self, upload_id):
+
+        return os.path.join(self.directory, upload_id + self.SUFFIX)
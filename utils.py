@@ -1,43 +1,95 @@
+import asyncio
 import socket
 import json
 import struct
+import threading
+import binary_codec
+from config import CONNECTION_TIMEOUT
 
-def recv_all(sock, length):
-    buffer = b''
-    while len(buffer) < length:
+ENCODING_JSON = 'json'
+ENCODING_BINARY = 'binary'
+ENCODING_AUTO = 'auto'
+SUPPORTED_ENCODINGS = (ENCODING_BINARY, ENCODING_JSON)
+BINARY_FLAG = 0x80000000
+
+# Size of the reusable buffer used when streaming received bytes to a file
+RECV_BUFFER_SIZE = 256 * 1024
+
+def recv_into(sock, buffer):
+    # Fill a preallocated buffer in place; returns the buffer, or None if the
+    # socket closed or failed before it was full. A socket timeout is raised,
+    # so callers can tell a peer that stopped answering from one that left.
+    view = memoryview(buffer)
+    received = 0
+    while received < len(view):
         try:
-            chunk = sock.recv(length - len(buffer))
-            if not chunk:
+            count = sock.recv_into(view[received:])
+            if count == 0:
                 # Socket closed
                 return None
-            buffer += chunk
+            received += count
+        except socket.timeout:
+            raise
         except socket.error as e:
             print(f"Error receiving data: {e}")
             return None
     return buffer
 
-def send_json(sock, data):
-    try:
-        # Serialize data to JSON byte string
-        message = json.dumps(data).encode('utf-8')
+def recv_all(sock, length):
+    # Returns a bytearray so the data is received with a single allocation
+    buffer = bytearray(length)
+    if recv_into(sock, buffer) is None:
+        return None
+    return buffer
+
+def recv_to_file(sock, f, length, buffer_size=RECV_BUFFER_SIZE):
+    # Stream exactly `length` bytes from the socket into an open binary file
+    buffer = bytearray(min(length, buffer_size))
+    view = memoryview(buffer)
+    remaining = length
+    while remaining > 0:
+        try:
+            count = sock.recv_into(view, min(remaining, len(view)))
+            if count == 0:
+                # Socket closed
+                return None
+            f.write(view[:count])
+            remaining -= count
+        except socket.timeout:
+            raise
+        except socket.error as e:
+            print(f"Error receiving data: {e}")
+            return None
+    return length
 
-        # Get the length of the message
-        length = len(message)
+def encode_message(data, encoding=ENCODING_JSON):
+    # Serialize a message and prefix it with its 4-byte length header. The top
+    # bit of the header marks a binary-encoded body.
+    if encoding == ENCODING_BINARY:
+        message = binary_codec.pack(data)
+        return struct.pack("!I", len(message) | BINARY_FLAG) + message
 
-        # Pack the length into a 4-byte header (network byte order)
-        header = struct.pack("!I", length)
+    message = json.dumps(data).encode('utf-8')
+    return struct.pack("!I", len(message)) + message
 
-        # Send the 4-byte length header
-        sock.sendall(header)
+def decode_message(header, message_bytes):
+    if header & BINARY_FLAG:
+        return binary_codec.unpack(message_bytes)
+    return json.loads(message_bytes.decode('utf-8'))
 
-        # Send the JSON message
-        sock.sendall(message)
-    except (socket.error, json.JSONDecodeError) as e:
+def send_json(sock, data, encoding=ENCODING_JSON):
+    try:
+        # Header and body go out in a single sendall
+        sock.sendall(encode_message(data, encoding))
+    except socket.timeout:
+        raise
+    except (socket.error, TypeError, ValueError) as e:
         print(f"Error sending message: {e}")
         return False
     return True
 
 def recv_json(sock):
+    # Receives a message in either encoding; the header says which
     try:
         # Read 4-byte length prefix
         header_bytes = recv_all(sock, 4)
@@ -45,15 +97,241 @@ def recv_json(sock):
             return None
 
         # Unpack the header to get message length
-        length = struct.unpack("!I", header_bytes)[0]
+        header = struct.unpack("!I", header_bytes)[0]
 
-        # Read the full JSON message
-        message_bytes = recv_all(sock, length)
+        # Read the full message
+        message_bytes = recv_all(sock, header & ~BINARY_FLAG)
         if message_bytes is None:
             return None
 
-        # Decode and parse JSON
-        return json.loads(message_bytes.decode('utf-8'))
-    except (socket.error, json.JSONDecodeError) as e:
+        return decode_message(header, message_bytes)
+    except socket.timeout:
+        raise
+    except (socket.error, ValueError, IndexError, struct.error) as e:
+        print(f"Error receiving message: {e}")
+        return None
+
+def reply(sock, request, response, encoding=ENCODING_JSON):
+    # Echo the request ID so pipelining clients can match responses to requests
+    if 'request_id' in request:
+        response['request_id'] = request['request_id']
+    return send_json(sock, response, encoding)
+
+def negotiate_encoding(request):
+    # Handle a HELLO request: pick the first encoding the client offers that
+    # this node supports. Returns the chosen encoding and the response.
+    offered = request.get('encodings') or [ENCODING_JSON]
+    encoding = next((e for e in offered if e in SUPPORTED_ENCODINGS), ENCODING_JSON)
+    return encoding, {'status': 'success', 'encoding': encoding}
+
+
+async def read_json(reader):
+    # asyncio counterpart of recv_json, using the same length-prefixed framing
+    try:
+        header_bytes = await reader.readexactly(4)
+        header = struct.unpack("!I", header_bytes)[0]
+        message_bytes = await reader.readexactly(header & ~BINARY_FLAG)
+        return decode_message(header, message_bytes)
+    except asyncio.IncompleteReadError:
+        # Socket closed
+        return None
+    except (ConnectionError, ValueError, IndexError, struct.error) as e:
         print(f"Error receiving message: {e}")
         return None
+
+async def write_json(writer, data, encoding=ENCODING_JSON):
+    # asyncio counterpart of send_json
+    try:
+        writer.write(encode_message(data, encoding))
+        await writer.drain()
+    except (ConnectionError, TypeError, ValueError) as e:
+        print(f"Error sending message: {e}")
+        return False
+    return True
+
+async def reply_async(writer, request, response, encoding=ENCODING_JSON):
+    if 'request_id' in request:
+        response['request_id'] = request['request_id']
+    return await write_json(writer, response, encoding)
+
+
+class Connection:
+    # A persistent connection that can carry many requests. Every request gets
+    # an ID, and servers answer requests on a connection strictly in order.
+
+    def __init__(self, sock, address):
+
+        self.sock = sock
+        self.address = address
+        self.broken = False
+        self.next_request_id = 1
+        self.encoding = ENCODING_JSON
+
+    def negotiate(self, encoding):
+
+        # Ask the server to switch this connection to `encoding`. Servers that
+        # do not know HELLO answer with an error and the connection stays JSON.
+        if encoding == ENCODING_JSON:
+            return ENCODING_JSON
+
+        response = self.call({'command': 'HELLO', 'encodings': [encoding, ENCODING_JSON]})
+        if response and response.get('status') == 'success':
+            self.encoding = response.get('encoding', ENCODING_JSON)
+        return self.encoding
+
+    def send(self, request):
+
+        request = dict(request)
+        request['request_id'] = self.next_request_id
+        self.next_request_id += 1
+
+        try:
+            sent = send_json(self.sock, request, self.encoding)
+        except socket.timeout:
+            self.broken = True
+            raise
+        if not sent:
+            self.broken = True
+            return None
+        return request['request_id']
+
+    def recv(self, request_id=None):
+
+        try:
+            response = recv_json(self.sock)
+        except socket.timeout:
+            self.broken = True
+            raise
+        if response is None:
+            self.broken = True
+            return None
+
+        if request_id is not None and response.get('request_id', request_id) != request_id:
+            print(f"Out-of-order response from {self.address[0]}:{self.address[1]}")
+            self.broken = True
+            return None
+        return response
+
+    def call(self, request):
+
+        request_id = self.send(request)
+        if request_id is None:
+            return None
+        return self.recv(request_id)
+
+    def sendall(self, data):
+
+        try:
+            self.sock.sendall(data)
+        except socket.error:
+            self.broken = True
+            raise
+
+    def recv_all(self, length):
+
+        try:
+            data = recv_all(self.sock, length)
+        except socket.timeout:
+            self.broken = True
+            raise
+        if data is None:
+            self.broken = True
+        return data
+
+    def close(self):
+
+        self.broken = True
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+class ConnectionPool:
+    # Keeps idle connections per (host, port) so repeated calls skip the TCP
+    # handshake. Connections are handed to one thread at a time.
+
+    def __init__(self, max_idle=8, timeout=CONNECTION_TIMEOUT, encoding=ENCODING_JSON):
+
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.encoding = encoding
+
+        # The pure-Python codec is smaller on the wire but slower than the json
+        # module, so 'auto' only asks for binary when msgpack is available
+        if encoding == ENCODING_AUTO:
+            self.encoding = ENCODING_BINARY if binary_codec.msgpack is not None else ENCODING_JSON
+        self.idle = {}  # (host, port) -> [Connection]
+        self.lock = threading.Lock()
+
+    def acquire(self, host, port):
+
+        address = (host, port)
+        with self.lock:
+            idle = self.idle.get(address)
+            if idle:
+                return idle.pop(), True
+
+        sock = socket.create_connection(address, timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = Connection(sock, address)
+        connection.negotiate(self.encoding)
+        return connection, False
+
+    def release(self, connection):
+
+        if connection.broken:
+            connection.close()
+            return
+
+        with self.lock:
+            idle = self.idle.setdefault(connection.address, [])
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def run(self, host, port, operation):
+
+        # Run operation(connection). A pooled connection may have been closed by
+        # the server while idle, so a failure on a reused connection is retried
+        # once on a fresh one. A timeout is not retried: the peer is there but
+        # not answering, and the caller has already waited the full timeout.
+        while True:
+            connection, reused = self.acquire(host, port)
+            try:
+                result = operation(connection)
+            except Exception as e:
+                connection.close()
+                if reused and isinstance(e, socket.error) and not isinstance(e, socket.timeout):
+                    continue
+                raise
+
+            self.release(connection)
+            if connection.broken and reused:
+                continue
+            return result
+
+    def call(self, host, port, request, timeout=None):
+
+        # A timeout given here only applies to this call; the connection goes
+        # back to the pool with the pool's timeout
+        if timeout is None:
+            return self.run(host, port, lambda connection: connection.call(request))
+
+        def operation(connection):
+            connection.sock.settimeout(timeout)
+            try:
+                return connection.call(request)
+            finally:
+                connection.sock.settimeout(self.timeout)
+
+        return self.run(host, port, operation)
+
+    def close(self):
+
+        with self.lock:
+            connections = [c for idle in self.idle.values() for c in idle]
+            self.idle = {}
+        for connection in connections:
+            connection.close()
@@ -1,69 +1,298 @@
-from flask import Flask, render_template, request, jsonify, send_file
-import os
-import sys
-import hashlib
+from flask import Flask, render_template, request, jsonify, Response
+import threading
+import time
 from client import Client
-import tempfile
+from config import WEB_STATUS_CACHE_TTL, WEB_STATUS_TIMEOUT
+from werkzeug.http import http_date
+from werkzeug.sansio.multipart import MultipartDecoder, File, Data, Epilogue, NEED_DATA
 from werkzeug.utils import secure_filename
 
 app = Flask(__name__)
-app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB max file size
-app.config['UPLOAD_FOLDER'] = tempfile.gettempdir()
+app.config['MAX_CONTENT_LENGTH'] = None  # Uploads are streamed chunk by chunk, so no size cap
 
 client = Client()
 
+# Last file list page per (prefix, after, limit); it is revalidated against
+# the master's metadata version rather than fetched again
+file_pages = {}
+file_pages_lock = threading.Lock()
+FILE_PAGES_MAX = 256
+
+# Master status, reused for WEB_STATUS_CACHE_TTL seconds. One request at a
+# time refreshes it, outside the lock; the others answer with the last one.
+status_cache = {'response': None, 'expires': 0.0, 'refreshing': False}
+status_lock = threading.Lock()
+
 @app.route('/')
 def index():
 
     return render_template('index.html')
 
+class MultipartFileReader:
+    # Reads the 'file' part of a multipart/form-data body as the body arrives.
+    # request.files would have werkzeug spool the whole upload to a temporary
+    # file first; this decodes the body incrementally and hands the part's
+    # bytes to upload_stream through read().
+
+    def __init__(self, stream, boundary, read_size=64 * 1024):
+
+        self.stream = stream
+        self.decoder = MultipartDecoder(boundary)
+        self.read_size = read_size
+        self.buffer = bytearray()
+        self.done = False
+
+    def next_event(self):
+
+        # A body that ends early makes the decoder raise ValueError, so a
+        # truncated upload fails instead of being committed short
+        while True:
+            event = self.decoder.next_event()
+            if event is not NEED_DATA:
+                return event
+            self.decoder.receive_data(self.stream.read(self.read_size) or None)
+
+    def open(self):
+
+        # Skip ahead to the 'file' part; returns its filename, or None if the
+        # body has no such part
+        while True:
+            event = self.next_event()
+            if isinstance(event, File) and event.name == 'file':
+                return event.filename
+            if isinstance(event, Epilogue):
+                return None
+
+    def read(self, size):
+
+        while len(self.buffer) < size and not self.done:
+            event = self.next_event()
+            if isinstance(event, Data):
+                self.buffer += event.data
+                self.done = not event.more_data
+            else:
+                self.done = True
+
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
 @app.route('/api/upload', methods=['POST'])
 def upload_file():
 
+    # Form uploads from the page; the file part is streamed to the storage
+    # nodes like a PUT body rather than saved first
     try:
-        if 'file' not in request.files:
-            return jsonify({'status': 'error', 'message': 'No file provided'}), 400
+        boundary = request.mimetype_params.get('boundary')
+        if request.mimetype != 'multipart/form-data' or not boundary:
+            return jsonify({'status': 'error', 'message': 'Expected a multipart/form-data upload'}), 400
 
-        file = request.files['file']
-        if file.filename == '':
+        file = MultipartFileReader(request.stream, boundary.encode('latin-1'))
+        filename = file.open()
+        if filename is None:
+            return jsonify({'status': 'error', 'message': 'No file provided'}), 400
+        if not secure_filename(filename):
             return jsonify({'status': 'error', 'message': 'No file selected'}), 400
 
-        filename = secure_filename(file.filename)
-        temp_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(temp_path)
+        return upload_stream(secure_filename(filename), file)
+
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/api/upload/<filename>', methods=['PUT'])
+def upload_raw(filename):
+
+    # The request body is the file itself; it is chunked and shipped to the
+    # storage nodes as it arrives instead of being saved first
+    try:
+        filename = secure_filename(filename)
+        if not filename:
+            return jsonify({'status': 'error', 'message': 'Invalid filename'}), 400
+
+        return upload_stream(filename, request.stream)
+
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+def upload_stream(filename, stream):
+
+    stats = client.upload_stream(filename, stream)
+
+    if not stats:
+        return jsonify({'status': 'error', 'message': f'Upload of "{filename}" failed'}), 500
+
+    return jsonify({
+        'status': 'success',
+        'message': f'File "{filename}" uploaded successfully',
+        'filename': filename,
+        'size': stats['size'],
+        'digest': stats['digest']
+    })
 
-        file_size = os.path.getsize(temp_path)
+@app.route('/api/download/<filename>', methods=['GET'])
+def download_file(filename):
+
+    try:
+
+        download_info = client.request_download(filename)
+
+        if not download_info:
+            return jsonify({'status': 'error', 'message': 'Download failed. All storage nodes may be offline.'}), 500
+
+        size = client.file_size(download_info)
+        headers = {'Content-Disposition': f'attachment; filename="{secure_filename(filename)}"'}
+        if download_info.get('digest'):
+            headers['ETag'] = f'"{download_info["digest"]}"'
+        if download_info.get('modified'):
+            headers['Last-Modified'] = http_date(download_info['modified'])
+        status = 200
+        start, end = 0, size
+
+        # A single byte range (e.g. a media player seeking) is answered with
+        # just those bytes; sizes are needed to map it onto chunks
+        if size is not None:
+            headers['Accept-Ranges'] = 'bytes'
+            if request.range is not None and len(request.range.ranges) == 1:
+                span = request.range.range_for_length(size)
+                if span is None:
+                    headers['Content-Range'] = f'bytes */{size}'
+                    return Response(status=416, headers=headers)
+                start, end = span
+                headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+                status = 206
+            headers['Content-Length'] = str(end - start)
+
+        # Chunks are sent in order as they are fetched, so the first bytes go
+        # out before the rest of the file has been read. A chunk that cannot be
+        # fetched raises mid-stream, which aborts the connection rather than
+        # ending a short body as if it were complete.
+        chunks = client.iter_file_data(download_info, start=start, end=end)
+        return Response(chunks, status=status, mimetype='application/octet-stream', headers=headers)
+
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/api/stat/<filename>', methods=['GET'])
+def stat_file(filename):
+
+    # Size, times and digest from the master, without touching storage nodes;
+    # ?chunks=1 adds chunk sizes and offsets
+    try:
+        info = client.stat_file(filename, chunks=request.args.get('chunks') == '1')
+
+        if info is None:
+            return jsonify({'status': 'error', 'message': f'File "{filename}" not found'}), 404
+        info.pop('request_id', None)
+        return jsonify(info)
+
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
 
-        client.upload_file(temp_path)
+@app.route('/api/uploads/<filename>', methods=['POST'])
+def begin_upload(filename):
 
-        os.remove(temp_path)
+    # Resumable uploads: start a session, PUT each part to
+    # /api/uploads/<upload_id>/<index>, then POST .../complete. After a
+    # failure, GET /api/uploads/<upload_id> lists the parts already stored.
+    try:
+        filename = secure_filename(filename)
+        if not filename:
+            return jsonify({'status': 'error', 'message': 'Invalid filename'}), 400
 
+        session = client.begin_upload(filename)
         return jsonify({
             'status': 'success',
-            'message': f'File "{filename}" uploaded successfully',
+            'upload_id': session['upload_id'],
             'filename': filename,
-            'size': file_size
+            'part_size': session['part_size']
         })
 
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
-@app.route('/api/download/<filename>', methods=['GET'])
-def download_file(filename):
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
 
     try:
+        status = client.upload_status(upload_id)
+
+        if status is None:
+            return jsonify({'status': 'error', 'message': f'Unknown upload {upload_id}'}), 404
+
+        return jsonify(dict(status, status='success'))
 
-        temp_path = os.path.join(app.config['UPLOAD_FOLDER'], f'download_{filename}')
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
 
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
+@app.route('/api/uploads/<upload_id>/<int:index>', methods=['PUT'])
+def upload_part(upload_id, index):
 
-        success = client.download_file(filename, temp_path)
+    try:
+        status = client.upload_status(upload_id)
+        if status is None:
+            return jsonify({'status': 'error', 'message': f'Unknown upload {upload_id}'}), 404
 
-        if not success:
-            return jsonify({'status': 'error', 'message': 'Download failed. All storage nodes may be offline.'}), 500
+        # Only the last part may be shorter than part_size; with a
+        # Content-Length a wrong-sized part is refused before it is stored
+        part_size = status['part_size']
+        length = request.content_length
+        if length is not None and (length > part_size or
+                                   (length < part_size and any(i > index for i in status['parts']))):
+            return jsonify({
+                'status': 'error',
+                'message': f'Part {index} is {length} bytes; every part but the last must be {part_size} bytes',
+                'index': index
+            }), 409
+
+        part = client.upload_part(upload_id, index, request.stream)
 
-        return send_file(temp_path, as_attachment=True, download_name=filename)
+        if part is None:
+            return jsonify({'status': 'error', 'message': f'Part {index} could not be stored'}), 500
+
+        return jsonify({'status': 'success', 'index': index, 'size': part['size']})
+
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+def complete_upload(upload_id):
+
+    try:
+        status = client.upload_status(upload_id)
+        if status is None:
+            return jsonify({'status': 'error', 'message': f'Unknown upload {upload_id}'}), 404
+
+        result = client.complete_upload(upload_id)
+
+        if result is None:
+            response = {
+                'status': 'error',
+                'message': f'Upload {upload_id} could not be completed',
+                'parts': status['parts']
+            }
+            if status['invalid_parts']:
+                response['message'] = f'Parts {status["invalid_parts"]} are not part_size bytes; send them again'
+                response['invalid_parts'] = status['invalid_parts']
+            return jsonify(response), 409
+
+        return jsonify({
+            'status': 'success',
+            'message': f'File "{result["filename"]}" uploaded successfully',
+            'filename': result['filename'],
+            'size': result['size']
+        })
+
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+def abort_upload(upload_id):
+
+    try:
+        if not client.abort_upload(upload_id):
+            return jsonify({'status': 'error', 'message': f'Unknown upload {upload_id}'}), 404
+
+        return jsonify({'status': 'success', 'message': f'Upload {upload_id} aborted'})
 
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
@@ -71,50 +300,79 @@ def download_file(filename):
 @app.route('/api/files', methods=['GET'])
 def list_files():
 
+    # Optional ?prefix=, ?limit= and ?after=<next from the previous page>.
+    # The master's metadata version is the ETag, so an unchanged listing costs
+    # the master one comparison and the browser a 304.
     try:
-        import socket
-        from utils import send_json, recv_json
-        from config import MASTER_HOST, MASTER_PORT
+        prefix = request.args.get('prefix', '')
+        after = request.args.get('after')
+        limit = request.args.get('limit', type=int)
+        key = (prefix, after, limit)
 
-        master_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        master_socket.connect((MASTER_HOST, MASTER_PORT))
+        with file_pages_lock:
+            cached = file_pages.get(key)
 
-        request_data = {'command': 'LIST_FILES'}
-        send_json(master_socket, request_data)
+        page = client.get_file_page(prefix, after, limit, cached['version'] if cached else None, details=True)
 
-        response = recv_json(master_socket)
-        master_socket.close()
+        if page is None:
+            return jsonify({'status': 'error', 'message': 'Failed to list files'}), 500
 
-        if response and response.get('status') == 'success':
-            files = response.get('files', [])
-            return jsonify({'status': 'success', 'files': files})
+        if page['status'] == 'not_modified':
+            page = cached
         else:
-            return jsonify({'status': 'error', 'message': 'Failed to list files'}), 500
+            with file_pages_lock:
+                if len(file_pages) >= FILE_PAGES_MAX:
+                    file_pages.clear()
+                file_pages[key] = page
+
+        headers = {'ETag': f'"{page["version"]}"', 'Cache-Control': 'no-cache'}
+        if request.if_none_match.contains(page['version']):
+            return Response(status=304, headers=headers)
+
+        response = jsonify({'status': 'success', 'files': page['files'], 'next': page.get('next')})
+        response.headers.update(headers)
+        return response
 
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+@app.route('/api/cache', methods=['GET'])
+def cache_stats():
+
+    return jsonify({'status': 'success', 'cache': client.chunk_cache.stats()})
+
 @app.route('/api/status', methods=['GET'])
 def get_status():
 
+    # Asked over the client's pooled master connection, and at most once per
+    # WEB_STATUS_CACHE_TTL however many pages are polling
     try:
-        import socket
-        from config import MASTER_HOST, MASTER_PORT
-
-        try:
-            master_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            master_socket.settimeout(2)
-            master_socket.connect((MASTER_HOST, MASTER_PORT))
-            master_socket.close()
-            master_status = 'online'
-        except:
-            master_status = 'offline'
-
-        return jsonify({
+        with status_lock:
+            refresh = time.time() >= status_cache['expires'] and not status_cache['refreshing']
+            if refresh:
+                status_cache['refreshing'] = True
+            master = status_cache['response']
+
+        if refresh:
+            try:
+                master = client.get_master_status(timeout=WEB_STATUS_TIMEOUT)
+            finally:
+                with status_lock:
+                    status_cache['response'] = master
+                    status_cache['expires'] = time.time() + WEB_STATUS_CACHE_TTL
+                    status_cache['refreshing'] = False
+
+        master_status = 'online' if master else 'offline'
+
+        response = {
             'status': 'success',
             'master': master_status,
             'message': 'System is ' + ('ready' if master_status == 'online' else 'not ready')
-        })
+        }
+        if master:
+            response['storage_nodes'] = master['storage_nodes']
+            response['files'] = master['files']
+        return jsonify(response)
 
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500